@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import socket
+import torch
+
+
+NETCHUNKS = [1024*2**k for k in range(3, 9)]   # 8k .. 256k points
+CHUNKS = [1024*2**k for k in range(0, 7)]      # 1k .. 64k rays
+
+
+def tune_key(args, train_rays=None):
+    """Identifies the host, the torch setup, whether chunks are tuned for training
+    (and with how many rays per backward) or rendering, and everything about the
+    model that changes the cost of a chunk.
+    """
+    device = torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu'
+    shape = [args.netdepth, args.netwidth, args.netdepth_fine, args.netwidth_fine,
+             args.N_samples, args.N_importance, args.multires, args.multires_views,
+             args.use_viewdirs, args.i_embed, args.model_type]
+    if args.i_embed == 1:
+        shape += [args.hash_levels, args.hash_log2_size, args.hash_base_res, args.hash_finest_res]
+    if args.model_type == 'tensorf':
+        shape += [args.tensorf_mode, args.tensorf_density_comp, args.tensorf_app_comp,
+                  args.tensorf_res_init, args.tensorf_res_final]
+    if train_rays is not None:
+        # What autograd keeps for backward
+        shape += [train_rays, args.grad_checkpoint, args.fused_composite]
+    return '{}|{}|threads={}|torch={}|{}|{}'.format(socket.gethostname(), device, torch.get_num_threads(),
+                                                   torch.__version__, 'render' if train_rays is None else 'train',
+                                                   ','.join(str(v) for v in shape))
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_cache(path, key, entry):
+    # Reread so that concurrent runs sharing basedir only add their own entry
+    cache = load_cache(path)
+    cache[key] = entry
+    tmp = path + '.{}.tmp'.format(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(cache, f, indent=2)
+    os.replace(tmp, path)
+
+
+def _proc_status_kb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return None
+
+
+def _can_reset_rss_peak():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return _proc_status_kb('VmHWM') is not None
+    except OSError:
+        return False
+
+
+class PeakMemory:
+    """Extra memory (MB) allocated at peak while inside the context: the CUDA
+    allocator peak on GPU, the resident set high-water mark on Linux (reset through
+    /proc/self/clear_refs). `mb` is None where neither is available.
+    """
+    cpu_supported = None
+
+    def __enter__(self):
+        self.mb = None
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.base = torch.cuda.memory_allocated()
+        else:
+            if PeakMemory.cpu_supported is None:
+                PeakMemory.cpu_supported = _can_reset_rss_peak()
+            if PeakMemory.cpu_supported:
+                with open('/proc/self/clear_refs', 'w') as f:
+                    f.write('5')
+                self.base = _proc_status_kb('VmRSS')
+        return self
+
+    def __exit__(self, *exc):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+            self.mb = (torch.cuda.max_memory_allocated() - self.base) / 2**20
+        elif PeakMemory.cpu_supported:
+            self.mb = (_proc_status_kb('VmHWM') - self.base) / 2**10
+        return False
+
+
+def free_memory_mb():
+    if torch.cuda.is_available():
+        free, total = torch.cuda.mem_get_info()
+        return free / 2**20
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    return None
+
+
+def _probe(fn, n_items, repeat=2):
+    """Best of `repeat` timed calls after one warm-up call. Returns (items/s, peak MB, seconds).
+    """
+    with PeakMemory() as mem:
+        fn()
+    best = float('inf')
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - t)
+    return n_items / best, mem.mb, best
+
+
+def _sweep(name, candidates, make_fn, budget_mb, max_seconds):
+    """Tries increasing sizes until one exceeds the memory budget, runs out of
+    memory, takes longer than max_seconds or stops getting faster. Returns the
+    fastest size that fit.
+    """
+    best, best_rate = None, 0.
+    slower = 0
+    for size in candidates:
+        fn, n_items = make_fn(size)
+        try:
+            rate, mb, seconds = _probe(fn, n_items)
+        except RuntimeError as e:
+            # CUDA and CPU allocators both raise RuntimeError when out of memory
+            print('autotune: {}={} failed ({})'.format(name, size, str(e).split('\n')[0]))
+            break
+        finally:
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        print('autotune: {}={:7d}  {:12.1f} /s  peak {} MB'.format(name, size, rate,
+              'n/a' if mb is None else '{:.0f}'.format(mb)))
+        if budget_mb is not None and mb is not None and mb > budget_mb:
+            break
+        if rate > best_rate * 1.03:
+            best, best_rate, slower = size, rate, 0
+        else:
+            slower += 1
+            if slower >= 2:
+                break
+        if seconds > max_seconds:
+            break
+    return best if best is not None else candidates[0], best_rate
+
+
+def _cap(candidates, largest):
+    """Candidates below `largest`, then `largest` itself: a larger chunk would
+    only ever hold `largest` items.
+    """
+    return [c for c in candidates if c < largest] + [largest]
+
+
+def autotune(args, render_kwargs, batchify_rays, budget_mb=None, max_seconds=10., train_rays=None):
+    """Picks netchunk by timing network_query_fn on random points, then chunk by
+    timing batchify_rays on random rays, each time the fastest size whose peak
+    memory fits in budget_mb. Sets args.netchunk and args.chunk; network_query_fn
+    reads args.netchunk on every call.
+
+    train_rays: rays rendered per backward in a training step. Autograd keeps the
+    graph of all of them until backward, whatever the chunk, so every probe then
+    runs the whole batch with backward and sizes above the batch are not tried.
+    """
+    if budget_mb is None:
+        free = free_memory_mb()
+        budget_mb = None if free is None else .5 * free
+    print('autotune: memory budget', 'none' if budget_mb is None else '{:.0f} MB'.format(budget_mb))
+
+    kwargs = {k : v for k, v in render_kwargs.items() if k not in ['ndc', 'use_viewdirs']}
+    near, far = float(kwargs.pop('near', 2.)), float(kwargs.pop('far', 6.))
+    query_fn = kwargs['network_query_fn']
+    network = kwargs['network_fine'] if kwargs.get('network_fine') is not None else kwargs['network_fn']
+    use_viewdirs = args.use_viewdirs
+    n_per_ray = args.N_samples + args.N_importance
+    train = train_rays is not None
+    params = [p for k in ['network_fn', 'network_fine'] if kwargs.get(k) is not None for p in kwargs[k].parameters()]
+
+    def run(forward):
+        if not train:
+            with torch.no_grad():
+                forward()
+            return
+        with torch.enable_grad():
+            out = forward()
+            sum(v.float().sum() for v in out.values() if v.requires_grad).backward()
+        for p in params:
+            p.grad = None
+
+    def make_query(netchunk):
+        args.netchunk = netchunk
+        n_rays = train_rays if train else max(1, 2 * netchunk // n_per_ray)
+        pts = torch.rand(n_rays, n_per_ray, 3) * 2. - 1.
+        viewdirs = torch.nn.functional.normalize(torch.randn(n_rays, 3), dim=-1) if use_viewdirs else None
+        def fn():
+            run(lambda : {'raw' : query_fn(pts, viewdirs, network)})
+        return fn, n_rays * n_per_ray
+
+    def make_render(chunk):
+        n_rays = train_rays if train else chunk
+        rays_o = torch.randn(n_rays, 3) * .1
+        rays_d = torch.nn.functional.normalize(torch.randn(n_rays, 3), dim=-1)
+        rays = [rays_o, rays_d, near * torch.ones_like(rays_d[...,:1]), far * torch.ones_like(rays_d[...,:1])]
+        if use_viewdirs:
+            rays.append(rays_d)
+        rays = torch.cat(rays, -1)
+        def fn():
+            run(lambda : batchify_rays(rays, chunk, **kwargs))
+        return fn, n_rays
+
+    netchunks, chunks = NETCHUNKS, CHUNKS
+    if train:
+        netchunks = _cap(NETCHUNKS, train_rays * n_per_ray)
+        chunks = _cap(CHUNKS, train_rays)
+
+    # Probing draws random inputs, training must not see a different RNG stream
+    rng_state = torch.get_rng_state()
+    torch.manual_seed(0)
+    try:
+        netchunk, _ = _sweep('netchunk', netchunks, make_query, budget_mb, max_seconds)
+        args.netchunk = netchunk
+        chunk, rays_per_sec = _sweep('chunk', chunks, make_render, budget_mb, max_seconds)
+    finally:
+        torch.set_rng_state(rng_state)
+    args.chunk = chunk
+    return {'chunk' : chunk, 'netchunk' : netchunk, 'rays_per_sec' : rays_per_sec,
+            'budget_mb' : budget_mb, 'time' : time.time()}
+
+
+def apply_autotune(args, render_kwargs, batchify_rays, train_rays=None):
+    """Uses the cached result for this host and model if there is one, otherwise
+    runs autotune() and caches it in basedir/autotune.json.
+    """
+    path = os.path.join(args.basedir, 'autotune.json')
+    key = tune_key(args, train_rays)
+    budget_mb = args.autotune_mem_mb if args.autotune_mem_mb > 0 else None
+    entry = load_cache(path).get(key)
+    if entry is not None and not args.autotune_retune and entry.get('budget_mb_arg') == budget_mb:
+        print('autotune: cached chunk={} netchunk={} ({})'.format(entry['chunk'], entry['netchunk'], path))
+    else:
+        entry = autotune(args, render_kwargs, batchify_rays, budget_mb=budget_mb, train_rays=train_rays)
+        entry['budget_mb_arg'] = budget_mb
+        os.makedirs(args.basedir, exist_ok=True)
+        save_cache(path, key, entry)
+        print('autotune: chose chunk={} netchunk={}, saved to {}'.format(entry['chunk'], entry['netchunk'], path))
+    args.chunk = entry['chunk']
+    args.netchunk = entry['netchunk']
+    return entry
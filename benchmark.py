@@ -0,0 +1,348 @@
+import os, sys
+import json
+import time
+import platform
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import torch
+
+from run_nerf_helpers import get_embedder, get_rays, ndc_rays, sample_pdf, img2mse
+from run_nerf import config_parser, create_nerf, raw2outputs, render_rays, render
+from load_blender import pose_spherical
+
+
+def sync():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def measure(fn, warmup, repeat):
+    """Runs fn `warmup` times untimed, then `repeat` times. Returns the per-call seconds.
+    """
+    for _ in range(warmup):
+        fn()
+    sync()
+    times = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        sync()
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def synthetic_scene(H, W, n_poses=4):
+    """Blender-style cameras on a sphere looking at the origin, no images needed.
+    """
+    focal = 1.2 * W
+    K = np.array([[focal, 0, 0.5*W], [0, focal, 0.5*H], [0, 0, 1]])
+    poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,n_poses+1)[:-1]], 0)
+    return H, W, focal, K, poses
+
+
+def random_rays(n_rays, use_viewdirs=True, near=2., far=6.):
+    rays_o = torch.randn(n_rays, 3) * .1 + torch.Tensor([0., 0., 4.])
+    rays_d = torch.randn(n_rays, 3) * .2 + torch.Tensor([0., 0., -1.])
+    rays = [rays_o, rays_d, near * torch.ones_like(rays_d[...,:1]), far * torch.ones_like(rays_d[...,:1])]
+    if use_viewdirs:
+        rays.append(rays_d / torch.norm(rays_d, dim=-1, keepdim=True))
+    return torch.cat(rays, -1)
+
+
+def make_model(bargs, netchunk, N_samples=64):
+    args = config_parser().parse_args([
+        '--expname', 'benchmark', '--basedir', bargs.basedir, '--dataset_type', 'blender',
+        '--no_reload', '--use_viewdirs', '--white_bkgd',
+        '--netchunk', str(netchunk), '--N_samples', str(N_samples), '--N_importance', str(bargs.N_importance),
+        '--netdepth', str(bargs.netdepth), '--netwidth', str(bargs.netwidth),
+        '--netdepth_fine', str(bargs.netdepth), '--netwidth_fine', str(bargs.netwidth),
+        '--perturb', '1.', '--raw_noise_std', '0.'])
+    return args, create_nerf(args)
+
+
+# Each benchmark takes the case parameters and returns (fn, items per call, unit)
+
+def bench_get_rays(p):
+    H, W, focal, K, poses = synthetic_scene(p['size'], p['size'])
+    return lambda: get_rays(H, W, K, poses[0][:3,:4]), H*W, 'rays'
+
+
+def bench_ndc_rays(p):
+    H, W, focal, K, poses = synthetic_scene(p['size'], p['size'])
+    rays_o, rays_d = get_rays(H, W, K, poses[0][:3,:4])
+    rays_o, rays_d = rays_o.reshape(-1, 3), rays_d.reshape(-1, 3)
+    return lambda: ndc_rays(H, W, focal, 1., rays_o, rays_d), H*W, 'rays'
+
+
+def bench_embed(p):
+    embed_fn, _ = get_embedder(p['multires'])
+    pts = torch.rand(p['netchunk'], 3) * 2. - 1.
+    return lambda: embed_fn(pts), p['netchunk'], 'points'
+
+
+def bench_nerf_forward(p):
+    args, (render_kwargs, _, _, _, _, _) = make_model(p['bargs'], p['netchunk'])
+    embed_fn, input_ch = get_embedder(args.multires)
+    embeddirs_fn, input_ch_views = get_embedder(args.multires_views)
+    x = torch.cat([embed_fn(torch.rand(p['netchunk'], 3)), embeddirs_fn(torch.rand(p['netchunk'], 3))], -1)
+    model = render_kwargs['network_fn']
+    def fn():
+        with torch.no_grad():
+            model(x)
+    return fn, p['netchunk'], 'points'
+
+
+def bench_raw2outputs(p):
+    n, s = p['chunk'], p['N_samples']
+    raw = torch.randn(n, s, 4)
+    z_vals, _ = torch.sort(2. + 4. * torch.rand(n, s), -1)
+    rays_d = torch.randn(n, 3)
+    return lambda: raw2outputs(raw, z_vals, rays_d, 0., True), n*s, 'samples'
+
+
+def bench_raw2outputs_backward(p, fused=False):
+    n, s = p['chunk'], p['N_samples']
+    raw = torch.randn(n, s, 4, requires_grad=True)
+    z_vals, _ = torch.sort(2. + 4. * torch.rand(n, s), -1)
+    rays_d = torch.randn(n, 3)
+    def fn():
+        rgb_map, _, acc_map, _, _ = raw2outputs(raw, z_vals, rays_d, 0., True, fused=fused)
+        (rgb_map.sum() + acc_map.sum()).backward()
+    return fn, n*s, 'samples'
+
+
+def bench_raw2outputs_fused_backward(p):
+    return bench_raw2outputs_backward(p, fused=True)
+
+
+def bench_sample_pdf(p):
+    n, s = p['chunk'], p['N_samples']
+    bins, _ = torch.sort(2. + 4. * torch.rand(n, s-1), -1)
+    weights = torch.rand(n, s-2)
+    return lambda: sample_pdf(bins, weights, p['bargs'].N_importance, det=False), n*p['bargs'].N_importance, 'samples'
+
+
+def bench_render_rays(p):
+    _, (_, render_kwargs_test, _, _, _, _) = make_model(p['bargs'], p['netchunk'], p['N_samples'])
+    kwargs = {k : v for k, v in render_kwargs_test.items() if k not in ['ndc', 'use_viewdirs']}
+    rays = random_rays(p['chunk'])
+    def fn():
+        with torch.no_grad():
+            render_rays(rays, **kwargs)
+    return fn, p['chunk'], 'rays'
+
+
+def bench_train_step(p):
+    _, (render_kwargs_train, _, _, _, optimizer, _) = make_model(p['bargs'], p['netchunk'], p['N_samples'])
+    H, W, focal, K, poses = synthetic_scene(64, 64)
+    n = p['chunk']
+    rays_o, rays_d = random_rays(n, use_viewdirs=False)[:, :6].split(3, -1)
+    target = torch.rand(n, 3)
+    def fn():
+        rgb, disp, acc, extras = render(H, W, K, chunk=n, rays=torch.stack([rays_o, rays_d], 0),
+                                        near=2., far=6., retraw=True, **render_kwargs_train)
+        optimizer.zero_grad()
+        loss = img2mse(rgb, target)
+        if 'rgb0' in extras:
+            loss = loss + img2mse(extras['rgb0'], target)
+        loss.backward()
+        optimizer.step()
+    return fn, n, 'rays'
+
+
+# What a short-lived job runs before rendering anything, in a fresh interpreter
+STARTUP = {
+    'torch' : 'import torch',
+    'run_nerf' : 'import run_nerf',
+    'create_nerf' : 'import run_nerf; run_nerf.create_nerf(run_nerf.config_parser().parse_args(["--expname", "startup", "--render_only", "--no_reload"]))',
+}
+
+
+def bench_startup(p, statement):
+    cmd = [sys.executable, '-c', statement]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    def fn():
+        subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return fn, 1, 'starts'
+
+
+# name -> (function, parameters the case depends on)
+BENCHMARKS = {
+    'get_rays' : (bench_get_rays, ['size']),
+    'ndc_rays' : (bench_ndc_rays, ['size']),
+    'embed' : (bench_embed, ['netchunk', 'multires']),
+    'nerf_forward' : (bench_nerf_forward, ['netchunk']),
+    'raw2outputs' : (bench_raw2outputs, ['chunk', 'N_samples']),
+    'raw2outputs_backward' : (bench_raw2outputs_backward, ['chunk', 'N_samples']),
+    'raw2outputs_fused_backward' : (bench_raw2outputs_fused_backward, ['chunk', 'N_samples']),
+    'sample_pdf' : (bench_sample_pdf, ['chunk', 'N_samples']),
+    'render_rays' : (bench_render_rays, ['chunk', 'netchunk', 'N_samples']),
+    'train_step' : (bench_train_step, ['chunk', 'netchunk', 'N_samples']),
+    # Import time of torch alone, of run_nerf, and up to a model ready to render
+    'startup_torch' : (lambda p : bench_startup(p, STARTUP['torch']), []),
+    'startup_import' : (lambda p : bench_startup(p, STARTUP['run_nerf']), []),
+    'startup_create_nerf' : (lambda p : bench_startup(p, STARTUP['create_nerf']), []),
+}
+
+
+def case_key(name, params, threads):
+    return '{}[{}]'.format(name, ','.join(['{}={}'.format(k, params[k]) for k in sorted(params)] + ['threads={}'.format(threads)]))
+
+
+def environment():
+    return {
+        'python' : platform.python_version(),
+        'torch' : torch.__version__,
+        'numpy' : np.__version__,
+        'platform' : platform.platform(),
+        'processor' : platform.processor(),
+        'cpu_count' : os.cpu_count(),
+        'device' : torch.cuda.get_device_name() if torch.cuda.is_available() else 'cpu',
+    }
+
+
+def run(bargs):
+    torch.set_grad_enabled(True)
+    grid = {
+        'size' : bargs.size,
+        'chunk' : bargs.chunk,
+        'netchunk' : bargs.netchunk,
+        'N_samples' : bargs.N_samples,
+        'multires' : bargs.multires,
+    }
+    names = bargs.only or list(BENCHMARKS)
+    results = {}
+    for threads in bargs.threads:
+        torch.set_num_threads(threads)
+        for name in names:
+            fn, keys = BENCHMARKS[name]
+            for values in itertools.product(*[grid[k] for k in keys]):
+                params = dict(zip(keys, values))
+                torch.manual_seed(0)
+                np.random.seed(0)
+                call, items, unit = fn(dict(params, bargs=bargs))
+                times = measure(call, bargs.warmup, bargs.repeat)
+                median = float(np.median(times))
+                key = case_key(name, params, threads)
+                results[key] = {
+                    'benchmark' : name,
+                    'params' : params,
+                    'threads' : threads,
+                    'times' : times,
+                    'median' : median,
+                    'min' : float(np.min(times)),
+                    'items' : items,
+                    'unit' : unit,
+                    'throughput' : items / median,
+                }
+                print('{:70s} {:10.3f} ms  {:14.1f} {}/s'.format(key, 1000*median, items/median, unit))
+    return {'environment' : environment(), 'config' : {k : v for k, v in vars(bargs).items() if k != 'compare'},
+            'results' : results}
+
+
+def compare(base, new, threshold):
+    """Prints the throughput change of every case present in both runs. Returns the
+    keys whose throughput dropped by more than `threshold` (a fraction).
+    """
+    for k in ['torch', 'device', 'cpu_count']:
+        if base['environment'].get(k) != new['environment'].get(k):
+            print('Note: {} differs, {} vs {}'.format(k, base['environment'].get(k), new['environment'].get(k)))
+
+    regressions = []
+    for key in sorted(set(base['results']) & set(new['results'])):
+        b, n = base['results'][key]['throughput'], new['results'][key]['throughput']
+        change = n / b - 1.
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regressions.append(key)
+        print('{:70s} {:+7.1f}%{}'.format(key, 100*change, flag))
+    for key in sorted(set(base['results']) ^ set(new['results'])):
+        print('{:70s} only in {}'.format(key, 'base' if key in base['results'] else 'new'))
+    return regressions
+
+
+def time_to_psnr(path, targets):
+    """Wall-clock seconds and iterations until the training PSNR logged in a
+    metrics.jsonl (run_nerf.py --metrics) first reaches each target.
+    """
+    elapsed, reached = 0., {}
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            if 'psnr' not in record:
+                continue
+            elapsed += record['seconds']
+            for t in targets:
+                if t not in reached and record['psnr'] >= t:
+                    reached[t] = (elapsed, record['step'])
+    return reached
+
+
+def benchmark_parser():
+    parser = argparse.ArgumentParser(description='Benchmarks of the rendering and training hot paths on '
+        'synthetic scenes and randomly initialized models.')
+    parser.add_argument("--out", type=str, default=None,
+                        help='write the results to this JSON file')
+    parser.add_argument("--compare", type=str, nargs=2, metavar=('BASE', 'NEW'), default=None,
+                        help='compare two results files instead of running')
+    parser.add_argument("--time_to_psnr", type=str, nargs='+', default=None, metavar='METRICS_JSONL',
+                        help='report the training time to reach --psnr_targets in these metrics.jsonl files')
+    parser.add_argument("--psnr_targets", type=float, nargs='+', default=[20., 25., 28., 30.])
+    parser.add_argument("--threshold", type=float, default=0.05,
+                        help='throughput drop (fraction) reported as a regression')
+    parser.add_argument("--only", type=str, nargs='+', choices=list(BENCHMARKS), default=None,
+                        help='run only these benchmarks')
+    parser.add_argument("--threads", type=int, nargs='+', default=[torch.get_num_threads()],
+                        help='torch intra-op thread counts')
+    parser.add_argument("--size", type=int, nargs='+', default=[400],
+                        help='image sizes for get_rays and ndc_rays')
+    parser.add_argument("--chunk", type=int, nargs='+', default=[1024],
+                        help='ray batch sizes')
+    parser.add_argument("--netchunk", type=int, nargs='+', default=[1024*64],
+                        help='points per network call')
+    parser.add_argument("--N_samples", type=int, nargs='+', default=[64],
+                        help='coarse samples per ray')
+    parser.add_argument("--N_importance", type=int, default=128,
+                        help='fine samples per ray')
+    parser.add_argument("--multires", type=int, nargs='+', default=[10],
+                        help='positional encoding frequencies')
+    parser.add_argument("--netdepth", type=int, default=8)
+    parser.add_argument("--netwidth", type=int, default=256)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--basedir", type=str, default='./logs/')
+    return parser
+
+
+if __name__=='__main__':
+    bargs = benchmark_parser().parse_args()
+
+    if bargs.compare is not None:
+        with open(bargs.compare[0]) as f:
+            base = json.load(f)
+        with open(bargs.compare[1]) as f:
+            new = json.load(f)
+        regressions = compare(base, new, bargs.threshold)
+        if len(regressions) > 0:
+            print('{} regression(s) above {:.0f}%'.format(len(regressions), 100*bargs.threshold))
+            sys.exit(1)
+        sys.exit(0)
+
+    if bargs.time_to_psnr is not None:
+        print('{:40s}'.format('run') + ''.join(['{:>20s}'.format('PSNR {:g}'.format(t)) for t in bargs.psnr_targets]))
+        for path in bargs.time_to_psnr:
+            reached = time_to_psnr(path, bargs.psnr_targets)
+            cells = ['{:>20s}'.format('{:.0f}s ({} it)'.format(*reached[t]) if t in reached else '-') for t in bargs.psnr_targets]
+            print('{:40s}'.format(os.path.basename(os.path.dirname(os.path.abspath(path)))) + ''.join(cells))
+        sys.exit(0)
+
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    out = run(bargs)
+    if bargs.out is not None:
+        with open(bargs.out, 'w') as f:
+            json.dump(out, f, indent=2)
+        print('Saved', bargs.out)
@@ -0,0 +1,173 @@
+import os
+import re
+import time
+import random
+import threading
+import numpy as np
+import torch
+
+from metrics import metrics
+from packfile import write_pack, read_pack
+
+
+CKPT_RE = re.compile(r'^\d+\.tar$')
+# Weights-only export of an experiment, see export_weights.py
+INFERENCE_WEIGHTS = 'weights.pack'
+
+
+def find_checkpoints(ckpt_dir):
+    """Sorted paths of the finished checkpoints in ckpt_dir (temp files are ignored).
+    """
+    if not os.path.isdir(ckpt_dir):
+        return []
+    names = sorted(e.name for e in os.scandir(ckpt_dir) if CKPT_RE.match(e.name))
+    return [os.path.join(ckpt_dir, n) for n in names]
+
+
+def torch_load(path, map_location=None):
+    # Checkpoints hold numpy RNG states, which the weights_only default of newer torch rejects
+    try:
+        return torch.load(path, map_location=map_location, weights_only=False)
+    except TypeError:
+        return torch.load(path, map_location=map_location)
+
+
+def load_checkpoint(ckpts, map_location=None):
+    """Loads the newest readable checkpoint of the list, skipping corrupt ones.
+    Returns (path, ckpt), or (None, None) if none could be read.
+    """
+    for path in reversed(ckpts):
+        try:
+            return path, torch_load(path, map_location=map_location)
+        except Exception as e:
+            print('Could not read checkpoint', path, '({}), trying the previous one'.format(e))
+    return None, None
+
+
+def save_inference_weights(path, step, networks, scene_bbox=None):
+    """Writes the state dicts of the named networks (None ones skipped) to a pack
+    file, one flat array per tensor named '{network}.{tensor}', the step and the
+    scene_bbox the model was trained in.
+    """
+    arrays = {}
+    for name, net in networks.items():
+        if net is not None:
+            arrays.update({'{}.{}'.format(name, k) : v.detach().cpu().numpy() for k, v in net.state_dict().items()})
+    meta = {'global_step' : int(step), 'networks' : [name for name, net in networks.items() if net is not None],
+            'scene_bbox' : scene_bbox}
+    return write_pack(path, arrays, meta)
+
+
+def load_inference_weights(path, device='cpu'):
+    """(meta, {network: state_dict}) of a file written by save_inference_weights,
+    meta holding 'global_step' and 'scene_bbox'.
+    Tensors are views of copy-on-write mapped pages: on the CPU nothing is copied,
+    pages are read when first used and shared by every process mapping the file.
+    """
+    arrays, meta = read_pack(path, mmap_mode='c')
+    state = {name : {} for name in meta['networks']}
+    for k, v in arrays.items():
+        name, key = k.split('.', 1)
+        state[name][key] = torch.from_numpy(v).to(device)
+    return meta, state
+
+
+def get_rng_state():
+    state = {
+        'torch' : torch.get_rng_state(),
+        'numpy' : np.random.get_state(),
+        'random' : random.getstate(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'].cpu())
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def snapshot(obj):
+    """Copies every tensor of a (nested) state dict to CPU memory, so training can
+    keep updating the originals while the copy is written.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k : snapshot(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointManager:
+    """Writes checkpoints in a background thread through a temp file and an atomic
+    rename, and keeps only the `keep` most recent ones (0 keeps everything).
+    At most one write is in flight; saving again waits for the previous one.
+    """
+    def __init__(self, ckpt_dir, keep=0, async_save=True):
+        self.ckpt_dir = ckpt_dir
+        self.keep = keep
+        self.async_save = async_save
+        self.thread = None
+        self.error = None
+        self.last_write_time = 0.
+
+    def save(self, step, ckpt):
+        self.wait()
+        path = os.path.join(self.ckpt_dir, '{:06d}.tar'.format(step))
+        ckpt = snapshot(ckpt)
+        if self.async_save:
+            self.thread = threading.Thread(target=self._write, args=(path, ckpt))
+            self.thread.start()
+        else:
+            self._write(path, ckpt)
+            self._raise()
+        return path
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self._raise()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _write(self, path, ckpt):
+        t = time.time()
+        tmp = os.path.join(self.ckpt_dir, '.{}.tmp'.format(os.path.basename(path)))
+        try:
+            with open(tmp, 'wb') as f:
+                torch.save(ckpt, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            self._remove_export()
+            self._prune()
+        except Exception as e:
+            self.error = e
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        self.last_write_time = time.time() - t
+        metrics.add_time('ckpt_write', self.last_write_time)
+
+    def _remove_export(self):
+        # The weights export is older than the checkpoint just written. Rendering
+        # then falls back to the checkpoints and never has to list them against it
+        export = os.path.join(self.ckpt_dir, INFERENCE_WEIGHTS)
+        if os.path.exists(export):
+            os.remove(export)
+            print('Removed the stale', export, '- run export_weights.py again')
+
+    def _prune(self):
+        if self.keep <= 0:
+            return
+        for path in find_checkpoints(self.ckpt_dir)[:-self.keep]:
+            os.remove(path)
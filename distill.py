@@ -0,0 +1,207 @@
+import os, sys
+import copy
+import shutil
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import trange
+
+from run_nerf_helpers import img2mse, mse2psnr
+from run_nerf import (config_parser, create_nerf, load_data, load_scene_meta, sample_rays, batchify_rays,
+                      raw2outputs, scene_bounding_box, write_config, device)
+from checkpoint import CheckpointManager
+
+
+# Student arguments that override the teacher's, written to the student's config
+STUDENT_ARGS = {
+    'student_netdepth' : ['netdepth', 'netdepth_fine'],
+    'student_netwidth' : ['netwidth', 'netwidth_fine'],
+    'student_model_type' : ['model_type'],
+    'student_i_embed' : ['i_embed'],
+    'student_N_importance' : ['N_importance'],
+}
+
+
+def distill_parser():
+    parser = config_parser()
+    parser.add_argument("--student_expname", type=str, default=None,
+                        help='experiment name of the student, defaults to {expname}_student')
+    parser.add_argument("--student_netdepth", type=int, default=4,
+                        help='layers of the student coarse and fine networks')
+    parser.add_argument("--student_netwidth", type=int, default=128,
+                        help='channels per layer of the student coarse and fine networks')
+    parser.add_argument("--student_model_type", type=str, default=None, choices=['nerf', 'tensorf'],
+                        help='student representation, defaults to the teacher\'s')
+    parser.add_argument("--student_i_embed", type=int, default=None,
+                        help='student encoding, e.g. 1 for a hash-grid student')
+    parser.add_argument("--student_N_importance", type=int, default=None,
+                        help='student fine samples, defaults to the teacher\'s')
+    parser.add_argument("--distill_iters", type=int, default=50000,
+                        help='student optimization steps')
+    parser.add_argument("--distill_rays", type=int, default=1024,
+                        help='rays per step')
+    parser.add_argument("--distill_views", type=int, default=8,
+                        help='cameras the rays of a step are drawn from')
+    parser.add_argument("--distill_lrate", type=float, default=None,
+                        help='student learning rate, defaults to lrate')
+    parser.add_argument("--distill_raw_weight", type=float, default=1.,
+                        help='weight of the per-sample (opacity and color) loss')
+    parser.add_argument("--distill_rgb_weight", type=float, default=1.,
+                        help='weight of the rendered color loss')
+    return parser
+
+
+def student_args(args):
+    sargs = copy.deepcopy(args)
+    sargs.expname = args.student_expname or args.expname + '_student'
+    for k, targets in STUDENT_ARGS.items():
+        if getattr(args, k) is not None:
+            for t in targets:
+                setattr(sargs, t, getattr(args, k))
+    if args.distill_lrate is not None:
+        sargs.lrate = args.distill_lrate
+    # Resume an unfinished distillation, never start from the teacher's checkpoint
+    sargs.ft_path = None
+    sargs.no_reload = False
+    sargs.N_iters = args.distill_iters
+    return sargs
+
+
+def write_student_config(args, sargs):
+    """Writes a config for run_nerf.py: the teacher's with the student overrides,
+    so the student renders with `run_nerf.py --config .../config.txt --render_only`.
+    """
+    overrides = {'expname' : sargs.expname, 'lrate' : sargs.lrate}
+    for targets in STUDENT_ARGS.values():
+        for t in targets:
+            overrides[t] = getattr(sargs, t)
+    # Grid sizes may come from the command line rather than the teacher's config
+    for k in sorted(vars(sargs)):
+        if (sargs.i_embed == 1 and k.startswith('hash_')) or (sargs.model_type == 'tensorf' and k.startswith('tensorf_')):
+            overrides[k] = getattr(sargs, k)
+    return write_config(args, overrides, os.path.join(sargs.basedir, sargs.expname, 'config.txt'))
+
+
+def alpha_from_raw(raw, z_vals, rays_d):
+    """Per-sample opacity and color, as raw2outputs computes them.
+    """
+    dists = z_vals[...,1:] - z_vals[...,:-1]
+    dists = torch.cat([dists, torch.Tensor([1e10]).expand(dists[...,:1].shape)], -1)
+    dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
+    alpha = 1. - torch.exp(-F.relu(raw[...,3]) * dists)
+    return alpha, torch.sigmoid(raw[...,:3])
+
+
+def strip_ray_kwargs(render_kwargs):
+    """render_rays arguments, without the ones render() consumes when building rays.
+    """
+    return {k : v for k, v in render_kwargs.items() if k not in ['ndc', 'use_viewdirs']}
+
+
+def distill(args):
+    # Cameras only, the teacher provides every target
+    scene = load_scene_meta(os.path.join(args.basedir, args.expname, 'scene_meta.npz'), args)
+    if scene is None:
+        scene = load_data(args, load_imgs=False)
+    _, poses, render_poses, hwf, K, i_split, near, far = scene
+    H, W, focal = hwf
+    H, W = int(H), int(W)
+
+    # Teacher, frozen
+    _, teacher_kwargs, teacher_step, _, _, _ = create_nerf(args)
+    if teacher_step == 0:
+        print('No trained teacher found in', os.path.join(args.basedir, args.expname))
+        return
+    for k in ['network_fn', 'network_fine']:
+        if teacher_kwargs[k] is not None:
+            teacher_kwargs[k].eval()
+            teacher_kwargs[k].requires_grad_(False)
+    ndc = teacher_kwargs.get('ndc', True)
+    # Sample like training: stratified, with the teacher's own importance samples
+    teacher_kwargs['perturb'] = args.perturb
+    teacher_kwargs = strip_ray_kwargs(teacher_kwargs)
+
+    # Student
+    sargs = student_args(args)
+    if sargs.i_embed == 1 or sargs.model_type == 'tensorf':
+        sargs.bounding_box = scene_bounding_box(sargs, poses[i_split[0]], H, W, K, near, far)
+    student_dir = os.path.join(sargs.basedir, sargs.expname)
+    os.makedirs(student_dir, exist_ok=True)
+    config_path = write_student_config(args, sargs)
+    meta_path = os.path.join(args.basedir, args.expname, 'scene_meta.npz')
+    if os.path.exists(meta_path):
+        shutil.copy(meta_path, os.path.join(student_dir, 'scene_meta.npz'))
+
+    student_kwargs, _, start, grad_vars, optimizer, _ = create_nerf(sargs)
+    query_fn = student_kwargs['network_query_fn']
+    student_fn, student_fine = student_kwargs['network_fn'], student_kwargs['network_fine']
+    student_kwargs = strip_ray_kwargs(student_kwargs)
+
+    n_params = lambda kw : sum(p.numel() for k in ['network_fn', 'network_fine'] if kw[k] is not None for p in kw[k].parameters())
+    print('Teacher parameters {}, student parameters {}'.format(n_params(teacher_kwargs), n_params(student_kwargs)))
+
+    # Rays from the training cameras and the rendering path
+    cams = np.concatenate([np.asarray(poses)[i_split[0], :3, :4], np.asarray(render_poses)[:, :3, :4]], 0)
+    n_views = min(args.distill_views, args.distill_rays)
+
+    ckpt_manager = CheckpointManager(student_dir, keep=args.ckpt_keep, async_save=not args.ckpt_sync)
+    decay_steps = args.lrate_decay * 1000
+
+    for i in trange(start + 1, args.distill_iters + 1):
+        rays = sample_rays(cams, H, W, K, n_views, args.distill_rays, ndc=ndc, near=near, far=far,
+                           use_viewdirs=args.use_viewdirs)
+
+        # Teacher targets at its own final sample positions
+        with torch.no_grad():
+            t = batchify_rays(rays, args.chunk, retraw=True, **teacher_kwargs)
+            t_alpha, t_rgb = alpha_from_raw(t['raw'], t['z_vals'], rays[:,3:6])
+            t_weights = raw2outputs(t['raw'], t['z_vals'], rays[:,3:6])[3]
+
+        pts = rays[:,None,0:3] + rays[:,None,3:6] * t['z_vals'][...,:,None]
+        viewdirs = rays[:,-3:] if args.use_viewdirs else None
+        loss_raw = 0.
+        for net in [student_fn, student_fine]:
+            if net is None:
+                continue
+            s_alpha, s_rgb = alpha_from_raw(query_fn(pts, viewdirs, net), t['z_vals'], rays[:,3:6])
+            # Colors only matter where the teacher sees something
+            loss_raw = loss_raw + img2mse(s_alpha, t_alpha) + torch.mean(t_weights[...,None] * (s_rgb - t_rgb)**2)
+
+        s = batchify_rays(rays, args.chunk, **student_kwargs)
+        loss_rgb = img2mse(s['rgb_map'], t['rgb_map'])
+        if 'rgb0' in s:
+            loss_rgb = loss_rgb + img2mse(s['rgb0'], t['rgb_map'])
+
+        loss = args.distill_raw_weight * loss_raw + args.distill_rgb_weight * loss_rgb
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        new_lrate = sargs.lrate * (0.1 ** (i / decay_steps))
+        for param_group in optimizer.param_groups:
+            param_group['lr'] = new_lrate * param_group.get('lr_scale', 1.)
+
+        if i % args.i_print == 0:
+            psnr = mse2psnr(img2mse(s['rgb_map'], t['rgb_map'])).item()
+            print('[DISTILL] Iter: {} Loss: {:.6f} PSNR to teacher: {:.2f}'.format(i, loss.item(), psnr))
+
+        if i % args.i_weights == 0 or i == args.distill_iters:
+            path = ckpt_manager.save(i, {
+                'global_step': i,
+                'network_fn_state_dict': student_fn.state_dict(),
+                'network_fine_state_dict': student_fine.state_dict() if student_fine is not None else None,
+                'optimizer_state_dict': optimizer.state_dict(),
+                'scene_bbox': sargs.scene_bbox,
+            })
+            print('Saved checkpoints at', path)
+
+    ckpt_manager.wait()
+    print('Student saved in', student_dir)
+    print('Render it with: python run_nerf.py --config {} --render_only'.format(config_path))
+
+
+if __name__=='__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    args = distill_parser().parse_args()
+    distill(args)
@@ -0,0 +1,104 @@
+import os
+import socket
+import datetime
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+
+def init_distributed(args):
+    """Joins the process group described by the usual torchrun environment
+    variables (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT). Returns (rank, world_size),
+    which is (0, 1) when not running distributed.
+    """
+    if not args.distributed:
+        return 0, 1
+    if not dist.is_initialized():
+        # Generous timeout: the other ranks wait in all_reduce while rank 0 renders videos
+        dist.init_process_group(backend='gloo', init_method='env://', timeout=datetime.timedelta(hours=6))
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_params(params, src=0):
+    """Makes every rank start from rank `src`'s weights.
+    """
+    if not dist.is_initialized():
+        return
+    with torch.no_grad():
+        for p in params:
+            dist.broadcast(p.data, src)
+
+
+def broadcast_object(obj, src=0):
+    """Returns rank `src`'s value of a picklable object on every rank.
+    """
+    if not dist.is_initialized():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src)
+    return objs[0]
+
+
+def allreduce_grads(params):
+    """Averages gradients over all ranks.
+
+    render_rays calls the coarse and fine networks many times per step (once per
+    chunk/netchunk), which DistributedDataParallel's single-forward reducer does
+    not support, so gradients are reduced explicitly after backward in one
+    flattened bucket.
+    """
+    if not dist.is_initialized():
+        return
+    world_size = dist.get_world_size()
+    grads = [p.grad if p.grad is not None else torch.zeros_like(p) for p in params]
+    flat = torch.cat([g.reshape(-1) for g in grads])
+    dist.all_reduce(flat, op=dist.ReduceOp.SUM)
+    flat /= world_size
+    offset = 0
+    for p, g in zip(params, grads):
+        n = g.numel()
+        if p.grad is None:
+            p.grad = flat[offset:offset+n].view_as(p).clone()
+        else:
+            p.grad.copy_(flat[offset:offset+n].view_as(p))
+        offset += n
+
+
+def cleanup():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _local_worker(rank, world_size, fn, args):
+    os.environ['RANK'] = str(rank)
+    os.environ['WORLD_SIZE'] = str(world_size)
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    try:
+        fn(args)
+    finally:
+        cleanup()
+
+
+def launch_local(fn, args, nprocs):
+    """Runs fn(args) in `nprocs` local processes that form one gloo process group.
+    """
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', str(_free_port()))
+    args.distributed = True
+    mp.spawn(_local_worker, args=(nprocs, fn, args), nprocs=nprocs, join=True)
@@ -0,0 +1,32 @@
+import os, sys
+import torch
+
+from run_nerf import config_parser, create_nerf
+from checkpoint import save_inference_weights, INFERENCE_WEIGHTS
+
+
+def export_parser():
+    parser = config_parser()
+    parser.add_argument("--weights_out", type=str, default=None,
+                        help='weights file, defaults to {basedir}/{expname}/' + INFERENCE_WEIGHTS + ' which render_only loads')
+    return parser
+
+
+def export_weights(args):
+    """Writes the networks of the newest checkpoint (or ft_path) to a weights-only
+    pack file, mapped without copies by create_nerf when rendering.
+    """
+    _, render_kwargs, start, _, _, _ = create_nerf(args, inference=False)
+    if start == 0:
+        print('No trained model found in', os.path.join(args.basedir, args.expname))
+        return None
+    out = args.weights_out or os.path.join(args.basedir, args.expname, INFERENCE_WEIGHTS)
+    # create_nerf resolved the model's scene_bbox
+    save_inference_weights(out, start, {k : render_kwargs[k] for k in ['network_fn', 'network_fine']}, args.scene_bbox)
+    print('Wrote weights of step {} to {} ({:.1f} MB)'.format(start, out, os.path.getsize(out) / 2**20))
+    return out
+
+
+if __name__=='__main__':
+    args = export_parser().parse_args()
+    export_weights(args)
@@ -0,0 +1,230 @@
+import os, sys
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from tqdm import tqdm
+
+from run_nerf import config_parser, create_nerf, load_data, load_scene_meta, scene_bounding_box
+from parallel_render import can_fork
+
+
+def mesh_parser():
+    parser = config_parser()
+    parser.add_argument("--mesh_res", type=int, default=512,
+                        help='resolution of the finest grid along the longest side of the box')
+    parser.add_argument("--mesh_block", type=int, default=64,
+                        help='cells per side of the blocks evaluated at full resolution')
+    parser.add_argument("--mesh_levels", type=int, default=3,
+                        help='octree levels above the blocks used to skip empty space')
+    parser.add_argument("--mesh_probe", type=int, default=16,
+                        help='samples per side when testing an octree cell for a surface')
+    parser.add_argument("--mesh_threshold", type=float, default=50.,
+                        help='density of the extracted iso-surface')
+    parser.add_argument("--mesh_bbox", type=float, nargs=6, default=None,
+                        help='xmin ymin zmin xmax ymax zmax, defaults to scene_bbox, the model\'s box or the camera frustums')
+    parser.add_argument("--mesh_format", type=str, default='mesh', choices=['mesh', 'points'],
+                        help='write a triangle mesh or only its vertices as a point cloud')
+    parser.add_argument("--mesh_colors", action='store_true',
+                        help='bake vertex colors by querying the fine network along the inward normal')
+    parser.add_argument("--mesh_workers", type=int, default=os.cpu_count(),
+                        help='processes running marching cubes')
+    parser.add_argument("--mesh_out", type=str, default=None,
+                        help='output PLY, defaults to {basedir}/{expname}/mesh_{step}.ply')
+    return parser
+
+
+class DensityField:
+    """Density of the trained model at arbitrary points, evaluated in chunks.
+    """
+    def __init__(self, render_kwargs, netchunk):
+        self.query_fn = render_kwargs['network_query_fn']
+        self.network = render_kwargs['network_fine'] if render_kwargs['network_fine'] is not None else render_kwargs['network_fn']
+        self.use_viewdirs = render_kwargs['use_viewdirs']
+        self.netchunk = netchunk
+
+    def query(self, pts, viewdirs=None):
+        """Raw outputs at pts [N, 3] (numpy), [N, 4].
+        """
+        out = []
+        with torch.no_grad():
+            for i in range(0, pts.shape[0], self.netchunk):
+                x = torch.Tensor(pts[i:i+self.netchunk])
+                d = None
+                if self.use_viewdirs:
+                    # Density does not depend on the direction
+                    d = torch.Tensor(viewdirs[i:i+self.netchunk]) if viewdirs is not None else torch.Tensor([[0., 0., -1.]]).expand(x.shape)
+                out.append(self.query_fn(x[:,None], d, self.network)[:,0].cpu().numpy())
+        return np.concatenate(out, 0)
+
+    def density(self, pts):
+        return np.maximum(self.query(pts)[:,3], 0.)
+
+
+def lattice(origin, n, step):
+    """Points of an n[0] x n[1] x n[2] grid starting at origin, [n0*n1*n2, 3].
+    """
+    axes = [origin[i] + step[i] * np.arange(n[i]) for i in range(3)]
+    return np.stack(np.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3).astype(np.float32)
+
+
+def find_blocks(field, box_min, voxel, res, block, levels, probe, threshold):
+    """Octree descent from cells of block*2^levels voxels down to blocks: a cell is
+    split when its probe lattice (plus a one-probe margin) has density both above
+    and below the threshold, so empty space and solid interiors are skipped.
+    Returns the voxel origins of the surviving blocks.
+    """
+    size = block * 2**levels
+    cells = [np.array([i, j, k]) * size for i in range(-(-res[0]//size))
+             for j in range(-(-res[1]//size)) for k in range(-(-res[2]//size))]
+    for level in range(levels, -1, -1):
+        kept = []
+        for c in tqdm(cells, desc='octree level {}'.format(level), leave=False):
+            step = size / probe
+            # One probe spacing of margin so surfaces grazing the cell are not missed
+            pts = lattice(box_min + (c - step) * voxel, [probe + 3] * 3, step * voxel)
+            sigma = field.density(pts)
+            if sigma.max() >= threshold and sigma.min() < threshold:
+                kept.append(c)
+        print('Octree level {}: {} of {} cells of {} voxels may contain the surface'.format(level, len(kept), len(cells), size))
+        if level == 0:
+            return kept
+        size //= 2
+        cells = [c + np.array([i, j, k]) * size for c in kept for i in [0, 1] for j in [0, 1] for k in [0, 1]
+                 if np.all(c + np.array([i, j, k]) * size < res)]
+    return cells
+
+
+def marching_cubes_block(args):
+    """Runs in a worker process: iso-surface of one block, in world coordinates.
+    """
+    volume, origin, voxel, threshold = args
+    try:
+        from skimage import measure
+    except ImportError:
+        raise ImportError('extract_mesh.py needs scikit-image: pip install scikit-image')
+    if volume.max() < threshold or volume.min() >= threshold:
+        return None
+    verts, faces, normals, _ = measure.marching_cubes(volume, level=threshold, spacing=tuple(voxel))
+    return verts + origin, faces, normals
+
+
+def weld(verts, faces, normals, tol):
+    """Merges the duplicate vertices of neighbouring blocks' shared faces.
+    """
+    keys = np.round(verts / tol).astype(np.int64)
+    _, index, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    return verts[index], inverse.reshape(-1)[faces], normals[index]
+
+
+def write_ply(path, verts, faces=None, colors=None):
+    """Binary little-endian PLY with float positions, optional uchar colors and faces.
+    """
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex {}'.format(len(verts)),
+              'property float x', 'property float y', 'property float z']
+    fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if colors is not None:
+        header += ['property uchar red', 'property uchar green', 'property uchar blue']
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    if faces is not None:
+        header += ['element face {}'.format(len(faces)), 'property list uchar int vertex_indices']
+    header.append('end_header')
+
+    vertex = np.empty(len(verts), dtype=fields)
+    vertex['x'], vertex['y'], vertex['z'] = verts[:,0], verts[:,1], verts[:,2]
+    if colors is not None:
+        vertex['red'], vertex['green'], vertex['blue'] = colors[:,0], colors[:,1], colors[:,2]
+    with open(path, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertex.tobytes())
+        if faces is not None:
+            face = np.empty(len(faces), dtype=[('n', 'u1'), ('v', '<i4', (3,))])
+            face['n'] = 3
+            face['v'] = faces
+            f.write(face.tobytes())
+
+
+def extract(args):
+    _, render_kwargs, start, _, _, _ = create_nerf(args)
+    if start == 0:
+        print('No trained model found in', os.path.join(args.basedir, args.expname))
+        return
+    field = DensityField(render_kwargs, args.netchunk)
+
+    if args.mesh_bbox is not None or args.scene_bbox is not None:
+        box = np.array(args.mesh_bbox or args.scene_bbox, dtype=np.float32).reshape(2, 3)
+    else:
+        net = render_kwargs['network_fn']
+        if hasattr(net, 'box_min'):
+            box = torch.stack([net.box_min, net.box_max], 0).cpu().numpy()
+        elif hasattr(net, 'embed_fn'):
+            box = torch.stack([net.embed_fn.box_min, net.embed_fn.box_max], 0).cpu().numpy()
+        else:
+            scene = load_scene_meta(os.path.join(args.basedir, args.expname, 'scene_meta.npz'), args)
+            if scene is None:
+                scene = load_data(args, load_imgs=False)
+            _, poses, _, hwf, K, i_split, near, far = scene
+            box = np.array(scene_bounding_box(args, np.asarray(poses)[i_split[0]], hwf[0], hwf[1], K, near, far))
+    box = box.astype(np.float32)
+    extent = box[1] - box[0]
+    voxel = np.full(3, extent.max() / args.mesh_res, dtype=np.float32)
+    res = np.ceil(extent / voxel).astype(np.int64)
+    print('Extracting the {} iso-surface in box {} at {} voxels'.format(args.mesh_threshold, box.tolist(), res.tolist()))
+
+    t = time.time()
+    blocks = find_blocks(field, box[0], voxel, res, args.mesh_block, args.mesh_levels, args.mesh_probe, args.mesh_threshold)
+    print('{} blocks to evaluate ({:.0f}% of the volume), octree took {:.1f}s'.format(
+        len(blocks), 100. * len(blocks) * args.mesh_block**3 / np.prod(res), time.time() - t))
+
+    # Blocks are evaluated here, one at a time, while the pool runs marching cubes on
+    # the previous ones. At most 2 blocks per worker are in flight, bounding memory.
+    ctx = mp.get_context('fork' if can_fork() else 'spawn')
+    verts, faces, normals = [], [], []
+    n_verts = 0
+    with ProcessPoolExecutor(max_workers=args.mesh_workers, mp_context=ctx) as pool:
+        pending = []
+        def collect(future):
+            nonlocal n_verts
+            out = future.result()
+            if out is not None:
+                verts.append(out[0])
+                faces.append(out[1] + n_verts)
+                normals.append(out[2])
+                n_verts += len(out[0])
+        for b in tqdm(blocks, desc='blocks'):
+            origin = box[0] + b * voxel
+            n = args.mesh_block + 1
+            volume = field.density(lattice(origin, [n] * 3, voxel)).reshape(n, n, n)
+            pending.append(pool.submit(marching_cubes_block, (volume, origin, voxel, args.mesh_threshold)))
+            while len(pending) >= 2 * args.mesh_workers:
+                collect(pending.pop(0))
+        for future in pending:
+            collect(future)
+
+    if n_verts == 0:
+        print('No surface at density', args.mesh_threshold)
+        return
+    verts, faces, normals = weld(np.concatenate(verts, 0), np.concatenate(faces, 0), np.concatenate(normals, 0),
+                                 tol=voxel.min() * 1e-3)
+    # Marching cubes may leave zero-area triangles at welded seams
+    faces = faces[(faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,0] != faces[:,2])]
+    print('Mesh: {} vertices, {} faces, {:.1f}s'.format(len(verts), len(faces), time.time() - t))
+
+    colors = None
+    if args.mesh_colors:
+        # Normals point to decreasing density (outwards): look at the surface against them
+        viewdirs = -normals / np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-8)
+        raw = field.query(verts.astype(np.float32), viewdirs.astype(np.float32))
+        colors = (255 * np.clip(1. / (1. + np.exp(-raw[:,:3])), 0, 1)).astype(np.uint8)
+
+    out = args.mesh_out or os.path.join(args.basedir, args.expname, 'mesh_{:06d}.ply'.format(start))
+    write_ply(out, verts, faces if args.mesh_format == 'mesh' else None, colors)
+    print('Saved', out)
+
+
+if __name__=='__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    args = mesh_parser().parse_args()
+    extract(args)
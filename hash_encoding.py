@@ -0,0 +1,90 @@
+import numpy as np
+import torch
+import torch.nn as nn
+
+from run_nerf_helpers import get_rays_np
+
+
+# Spatial hash primes of Instant-NGP (Mueller et al. 2022), the first one is 1 so
+# that x stays coherent in memory
+PRIMES = [1, 2654435761, 805459861]
+
+# The 8 corners of a voxel, [8, 3]
+BOX_OFFSETS = torch.tensor([[i, j, k] for i in [0, 1] for j in [0, 1] for k in [0, 1]])
+
+
+class HashEmbedder(nn.Module):
+    """Multiresolution hash encoding in pure PyTorch.
+
+    Every level is a grid of resolution `base_resolution` .. `finest_resolution`
+    (geometric progression) over the scene bounding box. Levels whose (res+1)^3
+    vertices fit in the 2^log2_hashmap_size table are stored densely, finer ones
+    are hashed into it. A point's feature at each level is the trilinear
+    interpolation of its voxel's 8 corner features; the levels are concatenated.
+    """
+    def __init__(self, bounding_box, n_levels=16, n_features_per_level=2,
+                 log2_hashmap_size=19, base_resolution=16, finest_resolution=512):
+        super(HashEmbedder, self).__init__()
+        box_min, box_max = bounding_box
+        # Buffers, so the box travels with the checkpoint
+        self.register_buffer('box_min', torch.as_tensor(np.asarray(box_min), dtype=torch.float32).reshape(3))
+        self.register_buffer('box_max', torch.as_tensor(np.asarray(box_max), dtype=torch.float32).reshape(3))
+        self.n_levels = n_levels
+        self.n_features_per_level = n_features_per_level
+        self.log2_hashmap_size = log2_hashmap_size
+        self.out_dim = n_levels * n_features_per_level
+
+        growth = np.exp((np.log(finest_resolution) - np.log(base_resolution)) / max(n_levels-1, 1))
+        self.resolutions = [int(np.floor(base_resolution * growth**i)) for i in range(n_levels)]
+        self.dense = [(res+1)**3 <= 2**log2_hashmap_size for res in self.resolutions]
+
+        self.embeddings = nn.ModuleList([
+            nn.Embedding((res+1)**3 if dense else 2**log2_hashmap_size, n_features_per_level)
+            for res, dense in zip(self.resolutions, self.dense)])
+        for emb in self.embeddings:
+            nn.init.uniform_(emb.weight, a=-1e-4, b=1e-4)
+
+    def grid_index(self, corners, level):
+        """Table rows of integer grid vertices [..., 3] at the given level.
+        """
+        res = self.resolutions[level]
+        if self.dense[level]:
+            return corners[...,0] + (res+1) * (corners[...,1] + (res+1) * corners[...,2])
+        h = corners[...,0] * PRIMES[0]
+        h = torch.bitwise_xor(h, corners[...,1] * PRIMES[1])
+        h = torch.bitwise_xor(h, corners[...,2] * PRIMES[2])
+        return torch.bitwise_and(h, (1 << self.log2_hashmap_size) - 1)
+
+    def forward(self, x):
+        # Points outside the box get the features of the closest face
+        x = (x - self.box_min) / (self.box_max - self.box_min)
+        x = torch.clamp(x, 0., 1.)
+        offsets = BOX_OFFSETS.to(x.device)
+
+        outputs = []
+        for level, res in enumerate(self.resolutions):
+            pos = x * res
+            pos0 = torch.clamp(torch.floor(pos), max=res-1)
+            w = pos - pos0                                                # [N, 3]
+            corners = pos0.long()[:,None,:] + offsets[None]               # [N, 8, 3]
+            feats = self.embeddings[level](self.grid_index(corners, level))  # [N, 8, F]
+
+            # Trilinear weights of the 8 corners
+            cw = torch.where(offsets[None].bool(), w[:,None,:], 1.-w[:,None,:])
+            cw = cw[...,0] * cw[...,1] * cw[...,2]                        # [N, 8]
+            outputs.append(torch.sum(cw[...,None] * feats, 1))
+        return torch.cat(outputs, -1)
+
+
+def frustum_bbox(poses, H, W, K, near, far):
+    """Axis-aligned box around all camera frustums between near and far, [2, 3].
+    """
+    H, W = int(H), int(W)
+    corners = np.array([[0, 0], [W-1, 0], [0, H-1], [W-1, H-1]])
+    pts = []
+    for c2w in np.asarray(poses):
+        rays_o, rays_d = get_rays_np(H, W, K, c2w[:3,:4])
+        o, d = rays_o[corners[:,1], corners[:,0]], rays_d[corners[:,1], corners[:,0]]
+        pts += [o + near * d, o + far * d]
+    pts = np.concatenate(pts, 0)
+    return np.stack([pts.min(0), pts.max(0)], 0)
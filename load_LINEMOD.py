@@ -4,7 +4,7 @@ import numpy as np
 import imageio 
 import json
 import torch.nn.functional as F
-import cv2
+from PIL import Image
 
 
 trans_t = lambda t : torch.Tensor([
@@ -34,7 +34,7 @@ def pose_spherical(theta, phi, radius):
     return c2w
 
 
-def load_LINEMOD_data(basedir, half_res=False, testskip=1):
+def load_LINEMOD_data(basedir, half_res=False, testskip=1, load_imgs=True):
     splits = ['train', 'val', 'test']
     metas = {}
     for s in splits:
@@ -43,6 +43,7 @@ def load_LINEMOD_data(basedir, half_res=False, testskip=1):
 
     all_imgs = []
     all_poses = []
+    fnames = []
     counts = [0]
     for s in splits:
         meta = metas[s]
@@ -57,20 +58,26 @@ def load_LINEMOD_data(basedir, half_res=False, testskip=1):
             fname = frame['file_path']
             if s == 'test':
                 print(f"{idx_test}th test frame: {fname}")
-            imgs.append(imageio.imread(fname))
+            fnames.append(fname)
+            if load_imgs:
+                imgs.append(imageio.imread(fname))
             poses.append(np.array(frame['transform_matrix']))
         imgs = (np.array(imgs) / 255.).astype(np.float32) # keep all 4 channels (RGBA)
         poses = np.array(poses).astype(np.float32)
-        counts.append(counts[-1] + imgs.shape[0])
+        counts.append(counts[-1] + poses.shape[0])
         all_imgs.append(imgs)
         all_poses.append(poses)
     
     i_split = [np.arange(counts[i], counts[i+1]) for i in range(3)]
     
-    imgs = np.concatenate(all_imgs, 0)
     poses = np.concatenate(all_poses, 0)
-    
-    H, W = imgs[0].shape[:2]
+    if load_imgs:
+        imgs = np.concatenate(all_imgs, 0)
+        H, W = imgs[0].shape[:2]
+    else:
+        # Metadata only: the image size comes from the header of the first image
+        imgs = None
+        W, H = Image.open(fnames[0]).size
     focal = float(meta['frames'][0]['intrinsic_matrix'][0][0])
     K = meta['frames'][0]['intrinsic_matrix']
     print(f"Focal: {focal}")
@@ -82,6 +89,9 @@ def load_LINEMOD_data(basedir, half_res=False, testskip=1):
         W = W//2
         focal = focal/2.
 
+    if half_res and load_imgs:
+        # cv2 takes a while to import, and only resizes
+        import cv2
         imgs_half_res = np.zeros((imgs.shape[0], H, W, 3))
         for i, img in enumerate(imgs):
             imgs_half_res[i] = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
@@ -3,7 +3,7 @@ import numpy as np
 import imageio 
 
 
-def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8):
+def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8, load_imgs=True):
     
 
     def parse_intrinsics(filepath, trgt_sidelength, invert_y=False):
@@ -81,6 +81,18 @@ def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8):
     valposes = dir2poses('{}/validation/{}/pose'.format(basedir, scene))
     valposes = valposes[::testskip]
 
+    counts = [0] + [x.shape[0] for x in [poses, valposes, testposes]]
+    counts = np.cumsum(counts)
+    i_split = [np.arange(counts[i], counts[i+1]) for i in range(3)]
+    
+    poses = np.concatenate([poses, valposes, testposes], 0)
+    
+    render_poses = testposes
+
+    if not load_imgs:
+        print(poses.shape)
+        return None, poses, render_poses, [H,W,focal], i_split
+
     imgfiles = [f for f in sorted(os.listdir(os.path.join(deepvoxels_base, 'rgb'))) if f.endswith('png')]
     imgs = np.stack([imageio.imread(os.path.join(deepvoxels_base, 'rgb', f))/255. for f in imgfiles], 0).astype(np.float32)
     
@@ -94,14 +106,7 @@ def load_dv_data(scene='cube', basedir='/data/deepvoxels', testskip=8):
     valimgs = np.stack([imageio.imread(os.path.join(valimgd, f))/255. for f in imgfiles[::testskip]], 0).astype(np.float32)
     
     all_imgs = [imgs, valimgs, testimgs]
-    counts = [0] + [x.shape[0] for x in all_imgs]
-    counts = np.cumsum(counts)
-    i_split = [np.arange(counts[i], counts[i+1]) for i in range(3)]
-    
     imgs = np.concatenate(all_imgs, 0)
-    poses = np.concatenate([poses, valposes, testposes], 0)
-    
-    render_poses = testposes
     
     print(poses.shape, imgs.shape)
     
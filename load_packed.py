@@ -0,0 +1,41 @@
+import numpy as np
+
+from packfile import read_header, read_pack
+
+
+def packed_meta(path):
+    """What a packed scene was made from: 'dataset_type', 'source' (the loading
+    arguments), 'factors', and per factor 'hwf', plus 'near' and 'far'.
+    """
+    return read_header(path)[0]['meta']
+
+
+def load_packed_data(path, factor=1, load_imgs=True, mmap=True):
+    """Loads a scene written by pack_scene.py, at one of the downsampling factors
+    it was packed with. Returns the same tuple as load_LINEMOD_data: images are
+    float32 in [0, 1], RGBA if the source was.
+    mmap: map the file and read only the pages used, else read it sequentially.
+    """
+    meta = packed_meta(path)
+    if factor not in meta['factors']:
+        raise ValueError('{} holds images at factors {}, not {}'.format(path, meta['factors'], factor))
+    names = ['poses', 'render_poses', 'K_{}'.format(factor), 'i_train', 'i_val', 'i_test']
+    if load_imgs:
+        names.append('images_{}'.format(factor))
+    arrays, _ = read_pack(path, names, mmap_mode='r' if mmap else None)
+
+    imgs = None
+    if load_imgs:
+        packed = arrays['images_{}'.format(factor)]
+        # The float32 values the loaders get from the source PNGs, one image at a time
+        table = (np.arange(256) / 255.).astype(np.float32)
+        imgs = np.empty(packed.shape, dtype=np.float32)
+        for i in range(packed.shape[0]):
+            np.take(table, packed[i], out=imgs[i])
+
+    poses = np.array(arrays['poses'])
+    render_poses = np.array(arrays['render_poses'])
+    H, W, focal = meta['hwf'][str(factor)]
+    K = np.array(arrays['K_{}'.format(factor)])
+    i_split = [np.array(arrays[k]) for k in ['i_train', 'i_val', 'i_test']]
+    return imgs, poses, render_poses, [int(H), int(W), float(focal)], K, i_split, meta['near'], meta['far']
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import threading
+from collections import defaultdict
+
+import torch
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        m = self.metrics
+        m.stack.append(self.name)
+        self.key = '/'.join(m.stack)
+        if m.profiler is not None:
+            self.record = torch.profiler.record_function(self.key)
+            self.record.__enter__()
+        if m.sync_cuda:
+            torch.cuda.synchronize()
+        self.t = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        m = self.metrics
+        if m.sync_cuda:
+            torch.cuda.synchronize()
+        m.times[self.key] += time.perf_counter() - self.t
+        m.calls[self.key] += 1
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        m.stack.pop()
+        return False
+
+
+class Metrics:
+    """Per-stage wall-clock timers, throughput counters and scalars, flushed to a
+    JSONL file and/or TensorBoard. Disabled by default, in which case timer() is a
+    shared no-op context and count() returns immediately.
+
+    Timers nest: timer('fine') around timer('mlp') accumulates into 'fine/mlp'.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.sync_cuda = False
+        self.stack = []
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counts = defaultdict(int)
+        self.lock = threading.Lock()
+        self.jsonl = None
+        self.writer = None
+        self.profiler = None
+        self.t_flush = time.time()
+
+    def open(self, logdir, jsonl=True, tensorboard_dir=None, sync_cuda=False):
+        self.enabled = True
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        if jsonl:
+            os.makedirs(logdir, exist_ok=True)
+            self.jsonl = open(os.path.join(logdir, 'metrics.jsonl'), 'a')
+        if tensorboard_dir is not None:
+            from torch.utils.tensorboard import SummaryWriter
+            self.writer = SummaryWriter(tensorboard_dir)
+        self.t_flush = time.time()
+
+    def timer(self, name):
+        if not self.enabled:
+            return _NULL_TIMER
+        return _Timer(self, name)
+
+    def count(self, name, n):
+        if self.enabled:
+            self.counts[name] += n
+
+    def add_time(self, name, seconds):
+        """Records a duration measured elsewhere, possibly from another thread.
+        """
+        if self.enabled:
+            with self.lock:
+                self.times[name] += seconds
+                self.calls[name] += 1
+
+    def memory_mb(self):
+        """Memory of the interval since the previous call: on a GPU the peak
+        allocated, 'peak_mem_mb'. On the CPU there is no resettable peak: the
+        resident set size sampled now, 'rss_mb', and the process lifetime
+        maximum, 'max_rss_mb'.
+        """
+        if torch.cuda.is_available():
+            peak = torch.cuda.max_memory_allocated() / 2**20
+            torch.cuda.reset_peak_memory_stats()
+            return {'peak_mem_mb' : peak}
+        mem = {}
+        try:
+            with open('/proc/self/statm') as f:
+                mem['rss_mb'] = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+        except (OSError, ValueError, AttributeError):
+            pass
+        try:
+            import resource
+            # ru_maxrss is in KB on Linux and in bytes on macOS
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            mem['max_rss_mb'] = rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+        except ImportError:
+            pass
+        return mem
+
+    def flush(self, step, steps=1, **scalars):
+        """Writes the averages since the previous flush over `steps` steps, plus
+        the given scalars (loss, psnr, ...), then resets the accumulators.
+        """
+        if not self.enabled:
+            return None
+        now = time.time()
+        elapsed = max(now - self.t_flush, 1e-9)
+        with self.lock:
+            record = {'step' : step, 'time' : now, 'seconds' : elapsed}
+            record.update({k : float(v) for k, v in scalars.items()})
+            for k, v in self.times.items():
+                record['ms/' + k] = 1000. * v / max(steps, 1)
+            for k, v in self.counts.items():
+                record[k + '_per_sec'] = v / elapsed
+            self.times.clear()
+            self.calls.clear()
+            self.counts.clear()
+        record.update(self.memory_mb())
+        self.t_flush = now
+
+        if self.jsonl is not None:
+            self.jsonl.write(json.dumps(record) + '\n')
+            self.jsonl.flush()
+        if self.writer is not None:
+            for k, v in record.items():
+                if k not in ['step', 'time'] and v is not None:
+                    self.writer.add_scalar(k, v, step)
+        return record
+
+    def start_profiler(self, logdir):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True,
+                                               on_trace_ready=torch.profiler.tensorboard_trace_handler(logdir))
+        self.profiler.__enter__()
+
+    def stop_profiler(self):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler = None
+
+    def close(self):
+        self.stop_profiler()
+        if self.jsonl is not None:
+            self.jsonl.close()
+            self.jsonl = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        self.enabled = False
+
+
+# Shared by the training loop and the rendering functions
+metrics = Metrics()
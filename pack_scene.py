@@ -0,0 +1,58 @@
+import os, sys
+import time
+import numpy as np
+import torch
+import cv2
+
+from run_nerf import config_parser, load_data, SCENE_META_ARGS
+from packfile import write_pack
+
+
+def pack_parser():
+    parser = config_parser()
+    parser.add_argument("--pack_out", type=str, default=None,
+                        help='packed scene file, defaults to {datadir}/scene.pack')
+    parser.add_argument("--pack_factors", type=int, nargs='+', default=[1],
+                        help='image downsampling factors to store, each loadable with --packed_factor')
+    return parser
+
+
+def pack_scene(args):
+    """Loads the scene the configuration points at, as load_data does, and writes
+    it to one pack file: uint8 images at every factor, the cameras, bounds and
+    splits, and the loading arguments it comes from.
+    """
+    if args.dataset_type == 'packed':
+        print('The scene is already packed')
+        return None
+    t = time.time()
+    images, poses, render_poses, hwf, K, i_split, near, far = load_data(args, keep_alpha=True)
+    print('Loaded {} images in {:.1f}s'.format(images.shape[0], time.time() - t))
+    if torch.is_tensor(render_poses):
+        render_poses = render_poses.cpu().numpy()
+
+    H, W, focal = hwf
+    arrays = {'poses' : np.asarray(poses, dtype=np.float32), 'render_poses' : np.asarray(render_poses, dtype=np.float32)}
+    arrays.update({k : np.asarray(v) for k, v in zip(['i_train', 'i_val', 'i_test'], i_split)})
+    meta = {'dataset_type' : args.dataset_type, 'source' : {k : getattr(args, k) for k in SCENE_META_ARGS},
+            'near' : float(near), 'far' : float(far), 'factors' : sorted(set(args.pack_factors)), 'hwf' : {}}
+    for f in meta['factors']:
+        K_f = np.array(K, dtype=np.float64)
+        K_f[:2,:3] = K_f[:2,:3] / f
+        H_f, W_f = H // f, W // f
+        imgs = images
+        if f > 1:
+            imgs = np.stack([cv2.resize(img, (W_f, H_f), interpolation=cv2.INTER_AREA) for img in images], 0)
+        arrays['images_{}'.format(f)] = np.clip(np.round(imgs * 255.), 0, 255).astype(np.uint8)
+        arrays['K_{}'.format(f)] = K_f
+        meta['hwf'][str(f)] = [H_f, W_f, float(focal) / f]
+
+    out = args.pack_out or os.path.join(args.datadir, 'scene.pack')
+    write_pack(out, arrays, meta)
+    print('Wrote {} ({:.1f} MB), train with: --dataset_type packed --datadir {}'.format(out, os.path.getsize(out) / 2**20, out))
+    return out
+
+
+if __name__=='__main__':
+    args = pack_parser().parse_args()
+    pack_scene(args)
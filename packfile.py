@@ -0,0 +1,90 @@
+import os
+import json
+import numpy as np
+
+
+MAGIC = b'NERFPACK'
+VERSION = 1
+# Arrays start on page boundaries, so each one maps to whole pages
+ALIGN = 4096
+
+
+def align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def write_pack(path, arrays, meta=None):
+    """Writes named numpy arrays and a JSON-serializable meta dict to one file:
+    magic, version, header length, JSON header, then the raw arrays, each
+    page-aligned. Written to a temp file renamed when complete.
+    """
+    arrays = {k : np.ascontiguousarray(v) for k, v in arrays.items()}
+    entries, offset = {}, 0
+    for k, v in arrays.items():
+        entries[k] = {'dtype' : v.dtype.str, 'shape' : list(v.shape), 'offset' : offset}
+        offset = align(offset + v.nbytes)
+    header = json.dumps({'arrays' : entries, 'meta' : meta or {}}).encode('utf-8')
+    prefix = MAGIC + np.array([VERSION, len(header)], dtype='<u4').tobytes()
+    start = align(len(prefix) + len(header))
+
+    tmp = os.path.join(os.path.dirname(os.path.abspath(path)), '.{}.tmp'.format(os.path.basename(path)))
+    try:
+        with open(tmp, 'wb') as f:
+            f.write(prefix + header)
+            for k, v in arrays.items():
+                f.seek(start + entries[k]['offset'])
+                f.write(v.tobytes())
+            f.truncate(start + offset)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path
+
+
+def read_header(path):
+    """(header, offset of the first array) of a pack file. The header holds
+    'arrays', name -> dtype, shape and offset, and 'meta'.
+    """
+    with open(path, 'rb') as f:
+        prefix = f.read(len(MAGIC) + 8)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError('{} is not a pack file'.format(path))
+        version, n = np.frombuffer(prefix[len(MAGIC):], dtype='<u4')
+        if version != VERSION:
+            raise ValueError('{} is pack format version {}, this code reads {}'.format(path, version, VERSION))
+        header = json.loads(f.read(int(n)).decode('utf-8'))
+    return header, align(len(prefix) + int(n))
+
+
+def read_pack(path, names=None, mmap_mode='r'):
+    """(arrays, meta) of a pack file, arrays restricted to `names` if given.
+    With an np.memmap mode ('r', 'c' for writable copy-on-write pages), arrays
+    map the file and pages are read when touched. With mmap_mode None, each
+    array is read with one sequential read into memory.
+    """
+    header, start = read_header(path)
+    entries = header['arrays']
+    names = list(entries) if names is None else names
+    arrays = {}
+    if mmap_mode is not None:
+        for k in names:
+            e = entries[k]
+            if int(np.prod(e['shape'])) == 0:
+                # np.memmap cannot map zero bytes
+                arrays[k] = np.zeros(e['shape'], dtype=e['dtype'])
+            else:
+                arrays[k] = np.memmap(path, dtype=e['dtype'], mode=mmap_mode, offset=start + e['offset'],
+                                      shape=tuple(e['shape']))
+        return arrays, header['meta']
+
+    with open(path, 'rb') as f:
+        for k in sorted(names, key=lambda k : entries[k]['offset']):
+            e = entries[k]
+            arrays[k] = np.empty(e['shape'], dtype=e['dtype'])
+            f.seek(start + e['offset'])
+            if f.readinto(memoryview(arrays[k].reshape(-1)).cast('B')) != arrays[k].nbytes:
+                raise ValueError('{} is truncated'.format(path))
+    return arrays, header['meta']
@@ -0,0 +1,149 @@
+import os, sys
+import time
+import numpy as np
+import imageio
+import torch
+import torch.multiprocessing as mp
+
+from run_nerf_helpers import get_ray_dirs, get_rays, to8b
+
+
+# State inherited by forked workers. Set in the parent right before the pool is
+# created so the (shared, read-only) models never have to be pickled.
+_worker_state = {}
+
+
+def scale_intrinsics(hwf, K, render_factor=0):
+    """Returns H, W, focal and K for rendering at 1/render_factor resolution.
+    """
+    H, W, focal = hwf
+    K = np.array(K, dtype=np.float32)
+    if render_factor!=0:
+        H = H//render_factor
+        W = W//render_factor
+        focal = focal/render_factor
+        K[:2,:3] = K[:2,:3] / render_factor
+    return H, W, focal, K
+
+
+def make_tasks(n_frames, H, tile_rows=0):
+    """Splits every frame into tiles of `tile_rows` image rows (0 = whole frame).
+    """
+    if tile_rows <= 0 or tile_rows >= H:
+        tile_rows = H
+    return [(i, r0, min(r0+tile_rows, H)) for i in range(n_frames) for r0 in range(0, H, tile_rows)]
+
+
+def _init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def _render_tile(task):
+    i, r0, r1 = task
+    s = _worker_state
+    H, W, K = s['H'], s['W'], s['K']
+    c2w = s['render_poses'][i][:3,:4]
+    with torch.no_grad():
+        # Rays of the tile rows only
+        rays = get_rays(H, W, K, c2w, dirs=get_ray_dirs(H, W, K, rows=(r0, r1)))
+        rgb, disp, acc, _ = s['render_fn'](H, W, K, chunk=s['chunk'], rays=rays, **s['render_kwargs'])
+    return i, r0, r1, rgb.cpu().numpy(), disp.cpu().numpy()
+
+
+def can_fork():
+    return 'fork' in mp.get_all_start_methods() and not torch.cuda.is_available()
+
+
+def render_path_parallel(render_fn, render_poses, hwf, K, chunk, render_kwargs, num_workers,
+                         gt_imgs=None, savedir=None, render_factor=0, tile_rows=0, threads_per_worker=None):
+    """Same as render_path, but frames (or row tiles of frames) are handed out
+    dynamically to a pool of forked CPU workers. Results are reassembled in order.
+    """
+    H, W, focal, K = scale_intrinsics(hwf, K, render_factor)
+    render_poses = torch.Tensor(np.asarray(render_poses.cpu() if torch.is_tensor(render_poses) else render_poses)).cpu()
+
+    # No share_memory(): forked workers already read the parent's parameter pages
+    # copy-on-write, including those mapped from an inference weights file
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+
+    _worker_state.update({
+        'render_fn' : render_fn,
+        'render_kwargs' : render_kwargs,
+        'render_poses' : render_poses,
+        'chunk' : chunk,
+        'H' : H,
+        'W' : W,
+        'K' : K,
+    })
+
+    tasks = make_tasks(render_poses.shape[0], H, tile_rows)
+    rgbs = np.zeros((render_poses.shape[0], H, W, 3), dtype=np.float32)
+    disps = np.zeros((render_poses.shape[0], H, W), dtype=np.float32)
+
+    ctx = mp.get_context('fork')
+    t = time.time()
+    try:
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+            # imap keeps submission order while workers pull tasks one at a time
+            for i, r0, r1, rgb, disp in pool.imap(_render_tile, tasks, chunksize=1):
+                rgbs[i, r0:r1] = rgb
+                disps[i, r0:r1] = disp
+                if r1 == H:
+                    print(i, time.time() - t)
+                    t = time.time()
+                    if gt_imgs is not None and render_factor==0:
+                        print('PSNR', -10. * np.log10(np.mean(np.square(rgbs[i] - np.asarray(gt_imgs[i])))))
+                    if savedir is not None:
+                        filename = os.path.join(savedir, '{:03d}.png'.format(i))
+                        imageio.imwrite(filename, to8b(rgbs[i]))
+    finally:
+        _worker_state.clear()
+
+    return rgbs, disps
+
+
+def benchmark_workers(render_fn, render_poses, hwf, K, chunk, render_kwargs, max_workers,
+                      render_factor=0, tile_rows=0):
+    """Times render_path_parallel for 1..max_workers workers (powers of two plus max_workers).
+    """
+    counts = sorted(set([2**k for k in range(int(np.log2(max_workers))+1)] + [max_workers]))
+    results = []
+    for n in counts:
+        t0 = time.time()
+        render_path_parallel(render_fn, render_poses, hwf, K, chunk, render_kwargs, n,
+                             render_factor=render_factor, tile_rows=tile_rows)
+        dt = time.time() - t0
+        results.append({'workers' : n, 'seconds' : dt, 'fps' : len(render_poses) / dt})
+        print('workers {:3d}  {:8.3f}s  {:6.3f} frames/s  speedup {:5.2f}x'.format(
+            n, dt, results[-1]['fps'], results[0]['seconds'] / dt))
+    return results
+
+
+if __name__=='__main__':
+    # Scaling benchmark on a randomly initialized model, no dataset needed:
+    #   python parallel_render.py --config configs/lego.txt --bench_max_workers 16
+    from run_nerf import config_parser, create_nerf, render
+    from load_blender import pose_spherical
+
+    parser = config_parser()
+    parser.add_argument("--bench_max_workers", type=int, default=os.cpu_count(),
+                        help='largest number of workers to benchmark')
+    parser.add_argument("--bench_frames", type=int, default=8,
+                        help='number of frames to render per run')
+    parser.add_argument("--bench_size", type=int, default=100,
+                        help='height and width of the benchmark frames')
+    args = parser.parse_args()
+    args.no_reload = True
+    os.makedirs(os.path.join(args.basedir, args.expname), exist_ok=True)
+
+    _, render_kwargs_test, _, _, _, _ = create_nerf(args)
+    render_kwargs_test.update({'near' : 2., 'far' : 6.})
+
+    H = W = args.bench_size
+    focal = 1.2 * W
+    K = np.array([[focal, 0, 0.5*W], [0, focal, 0.5*H], [0, 0, 1]])
+    render_poses = torch.stack([pose_spherical(angle, -30.0, 4.0) for angle in np.linspace(-180,180,args.bench_frames+1)[:-1]], 0)
+
+    benchmark_workers(render, render_poses, [H, W, focal], K, args.chunk, render_kwargs_test,
+                      args.bench_max_workers, render_factor=args.render_factor, tile_rows=args.render_tile_rows)
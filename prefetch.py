@@ -0,0 +1,145 @@
+import queue
+import threading
+import numpy as np
+import torch
+
+
+def cpu_tensor(x):
+    """float32 CPU tensor of an array or tensor. The training loop may have made CUDA
+    the default tensor type, which torch.Tensor() would follow.
+    """
+    if torch.is_tensor(x):
+        return x.detach().cpu().float()
+    return torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+
+
+def epoch_permutation(n, epoch, rank=0):
+    """Ray order of an epoch, reproducible from (epoch, rank) alone so training can be resumed.
+    """
+    return torch.from_numpy(np.random.default_rng([rank, epoch]).permutation(n))
+
+
+class RayBatches:
+    """Consecutive batches of n rays from the shuffled rays of every training pixel
+    [N, ro+rd+rgb, 3], reshuffled after every epoch. Only the ray order is
+    permuted at the end of an epoch, each batch gathers its own rays.
+    """
+    def __init__(self, rays_rgb, n, rank=0, epoch=0, i_batch=0):
+        self.rays_rgb = cpu_tensor(rays_rgb)
+        self.n, self.rank = n, rank
+        self.order = torch.arange(self.rays_rgb.shape[0], device='cpu')
+        self.epoch = 0
+        # Resuming replays the shuffles of the epochs done
+        for _ in range(epoch):
+            self.shuffle()
+        self.i_batch = i_batch
+
+    def shuffle(self):
+        self.epoch += 1
+        self.order = self.order[epoch_permutation(len(self.order), self.epoch, self.rank)]
+
+    def __call__(self, i):
+        batch = self.rays_rgb[self.order[self.i_batch:self.i_batch+self.n]] # [B, 2+1, 3*?]
+        batch = torch.transpose(batch, 0, 1)
+        self.i_batch += self.n
+        if self.i_batch >= len(self.order):
+            print("Shuffle data after an epoch!")
+            self.shuffle()
+            self.i_batch = 0
+        return batch[:2], batch[2], {'epoch' : self.epoch, 'i_batch' : self.i_batch}
+
+
+class ImageBatches:
+    """Batches of n random pixels of one random training image, from its central
+    crop before precrop_iters. Step i draws from its own generator, so a batch does
+    not depend on the steps before it.
+    """
+    def __init__(self, images, poses, i_train, H, W, K, n, precrop_iters=0, precrop_frac=.5, rank=0):
+        self.images = cpu_tensor(images)  # [N, H, W, 3]
+        self.poses = cpu_tensor(poses)    # [N, 3+, 4]
+        self.i_train = np.asarray(i_train)
+        self.H, self.W, self.K, self.n = H, W, K, n
+        self.precrop_iters, self.precrop_frac, self.rank = precrop_iters, precrop_frac, rank
+        self.first = True
+
+    def __call__(self, i):
+        rng = np.random.default_rng([self.rank, i])
+        img_i = rng.choice(self.i_train)
+        top, left, h, w = 0, 0, self.H, self.W
+        if i < self.precrop_iters:
+            dH = int(self.H//2 * self.precrop_frac)
+            dW = int(self.W//2 * self.precrop_frac)
+            top, left, h, w = self.H//2 - dH, self.W//2 - dW, 2*dH, 2*dW
+            if self.first:
+                print(f"[Config] Center cropping of size {h} x {w} is enabled until iter {self.precrop_iters}")
+        self.first = False
+
+        # Downsampled progressive stages may have fewer pixels than n
+        select_inds = torch.from_numpy(rng.choice(h * w, size=[self.n], replace=h * w < self.n))
+        row, col = top + select_inds // w, left + select_inds % w
+
+        # Same directions as get_rays()
+        dirs = torch.stack([(col - self.K[0][2]) / self.K[0][0], -(row - self.K[1][2]) / self.K[1][1],
+                            -torch.ones([self.n], device='cpu')], -1).float()
+        pose = self.poses[img_i, :3, :4]
+        rays_d = torch.sum(dirs[:,None,:] * pose[:3,:3], -1)
+        rays_o = pose[:3,-1].expand(rays_d.shape)
+        return torch.stack([rays_o, rays_d], 0), self.images[img_i, row, col], {}
+
+
+class Prefetcher:
+    """Calls make_batch(i) for the steps [first, last) in order, from a background
+    thread keeping up to `depth` batches ready, so that batches are built while the
+    previous steps train. depth 0 builds every batch when it is asked for. On a
+    GPU, batches are built in pinned memory and copied asynchronously.
+    """
+    def __init__(self, make_batch, first, last, depth=2, device='cpu'):
+        self.make_batch = make_batch
+        self.steps = iter(range(first, last))
+        self.device = torch.device(device)
+        self.pin = self.device.type == 'cuda'
+        self.thread = None
+        if depth > 0:
+            self.queue = queue.Queue(depth)
+            self.stopped = threading.Event()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def build(self, i):
+        rays, target, state = self.make_batch(i)
+        if self.pin:
+            rays, target = rays.pin_memory(), target.pin_memory()
+        return rays, target, state
+
+    def put(self, item):
+        # Gives up once closed, rather than waiting on a queue no one reads
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for i in self.steps:
+                if not self.put(self.build(i)):
+                    return
+        except Exception as e:
+            self.put(e)
+
+    def next(self):
+        """Batch of the next step: (rays [2, n, 3], target rgb [n, 3], state), state
+        being what a checkpoint needs to resume the sequence after this batch.
+        """
+        item = self.build(next(self.steps)) if self.thread is None else self.queue.get()
+        if isinstance(item, Exception):
+            raise item
+        rays, target, state = item
+        return rays.to(self.device, non_blocking=True), target.to(self.device, non_blocking=True), state
+
+    def close(self):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
@@ -0,0 +1,234 @@
+import os, sys
+import copy
+import shutil
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from run_nerf_helpers import NeRF, img2mse, mse2psnr
+from run_nerf import (config_parser, create_nerf, create_optimizer, load_data, load_scene_meta, sample_rays,
+                      batchify_rays, write_config, train, device)
+from checkpoint import CheckpointManager
+
+
+def prune_parser():
+    parser = config_parser()
+    parser.add_argument("--prune_width", type=int, default=128,
+                        help='channels kept in every layer of the coarse network (views layers keep half)')
+    parser.add_argument("--prune_width_fine", type=int, default=None,
+                        help='channels kept in the fine network, defaults to prune_width')
+    parser.add_argument("--prune_expname", type=str, default=None,
+                        help='experiment name of the pruned model, defaults to {expname}_w{prune_width}')
+    parser.add_argument("--prune_rays", type=int, default=16384,
+                        help='rays rendered to measure the activations')
+    parser.add_argument("--prune_views", type=int, default=8,
+                        help='training cameras the rays are drawn from')
+    parser.add_argument("--prune_iters", type=int, default=5000,
+                        help='fine-tuning steps of the pruned model, 0 to skip')
+    parser.add_argument("--prune_lrate", type=float, default=None,
+                        help='fine-tuning learning rate, defaults to where the schedule left the trained model')
+    return parser
+
+
+class ActivationStats:
+    """Mean and mean magnitude of every output channel of the hooked layers, as
+    the next layer sees them (after the ReLU for the layers that have one).
+    """
+    def __init__(self, net):
+        self.sum, self.abs_sum, self.n = {}, {}, {}
+        self.handles = []
+        for name, relu in linear_chain(net):
+            self.handles.append(getattr_path(net, name).register_forward_hook(self.hook(name, relu)))
+
+    def hook(self, name, relu):
+        def fn(module, inputs, output):
+            a = (F.relu(output) if relu else output).detach().double()
+            self.sum[name] = self.sum.get(name, 0.) + a.sum(0)
+            self.abs_sum[name] = self.abs_sum.get(name, 0.) + a.abs().sum(0)
+            self.n[name] = self.n.get(name, 0) + a.shape[0]
+        return fn
+
+    def mean(self, name):
+        return (self.sum[name] / self.n[name]).float()
+
+    def mean_abs(self, name):
+        return (self.abs_sum[name] / self.n[name]).float()
+
+    def remove(self):
+        for h in self.handles:
+            h.remove()
+
+
+def getattr_path(net, name):
+    for part in name.split('.'):
+        net = getattr(net, part)
+    return net
+
+
+def linear_chain(net):
+    """Prunable layers of a NeRF, (name, followed by a ReLU). feature_linear has no
+    activation before the views layers.
+    """
+    chain = [('pts_linears.{}'.format(i), True) for i in range(net.D)]
+    if net.use_viewdirs:
+        chain += [('feature_linear', False)] + [('views_linears.{}'.format(i), True) for i in range(len(net.views_linears))]
+    return chain
+
+
+def consumers(net, name):
+    """Layers reading the output of layer `name`, with the column its channels start
+    at: after a skip connection, the encoded position comes first.
+    """
+    if name.startswith('pts_linears.'):
+        i = int(name.split('.')[1])
+        offset = net.input_ch if i in net.skips else 0
+        if i < net.D - 1:
+            return ['pts_linears.{}'.format(i+1)], offset
+        return (['alpha_linear', 'feature_linear'] if net.use_viewdirs else ['output_linear']), offset
+    if name == 'feature_linear':
+        # h = cat([feature, input_views])
+        return ['views_linears.0'], 0
+    i = int(name.split('.')[1])
+    return ['views_linears.{}'.format(i+1) if i < len(net.views_linears) - 1 else 'rgb_linear'], 0
+
+
+def prune_nerf(net, stats, width):
+    """Narrower NeRF keeping, in every layer, the `width` channels (width//2 in the
+    views layers) that contribute most to the next layer: mean |activation| times
+    the norm of the weights reading it. The mean activation of a removed channel
+    is folded into the next layer's bias.
+    """
+    weight = {n : m.weight.detach().clone() for n, m in net.named_modules() if isinstance(m, nn.Linear)}
+    bias = {n : getattr_path(net, n).bias.detach().clone() for n in weight}
+    rows = {n : torch.arange(w.shape[0], device=w.device) for n, w in weight.items()}
+    cols = {n : torch.arange(w.shape[1], device=w.device) for n, w in weight.items()}
+
+    used = set()
+    for name, _ in linear_chain(net):
+        n_out = weight[name].shape[0]
+        n_keep = width // 2 if name.startswith('views_linears') else width
+        nexts, offset = consumers(net, name)
+        next_cols = torch.cat([weight[c][:, offset:offset+n_out] for c in nexts], 0)
+        score = stats.mean_abs(name).to(next_cols.device) * next_cols.norm(dim=0)
+        keep = torch.sort(torch.topk(score, n_keep).indices).values
+        dropped = torch.ones(n_out, dtype=torch.bool, device=keep.device)
+        dropped[keep] = False
+
+        rows[name] = keep
+        used.update([name] + nexts)
+        mean = stats.mean(name).to(next_cols.device)
+        for c in nexts:
+            bias[c] += weight[c][:, offset:offset+n_out][:, dropped] @ mean[dropped]
+            cols[c] = torch.cat([cols[c][:offset], offset + keep, cols[c][offset+n_out:]])
+
+    output_ch = 4 if net.use_viewdirs else net.output_linear.out_features
+    pruned = NeRF(D=net.D, W=width, input_ch=net.input_ch, input_ch_views=net.input_ch_views,
+                  output_ch=output_ch, skips=net.skips, use_viewdirs=net.use_viewdirs).to(device)
+    with torch.no_grad():
+        # views_linears exists but is unused without use_viewdirs
+        for n, m in pruned.named_modules():
+            if n in used:
+                m.weight.copy_(weight[n][rows[n]][:, cols[n]])
+                m.bias.copy_(bias[n][rows[n]])
+    return pruned
+
+
+def render_rays_timed(rays, chunk, render_kwargs, networks):
+    kwargs = {k : v for k, v in render_kwargs.items() if k not in ['ndc', 'use_viewdirs']}
+    kwargs.update(networks)
+    with torch.no_grad():
+        batchify_rays(rays[:chunk], chunk, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        t = time.time()
+        rgb = batchify_rays(rays, chunk, **kwargs)['rgb_map']
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    return rgb, rays.shape[0] / (time.time() - t)
+
+
+def prune(args):
+    if args.model_type == 'tensorf' or args.i_embed == 1:
+        print('prune.py prunes the NeRF MLPs, hash-encoded and TensoRF models are not supported')
+        return
+
+    scene = load_scene_meta(os.path.join(args.basedir, args.expname, 'scene_meta.npz'), args)
+    if scene is None:
+        scene = load_data(args, load_imgs=False)
+    _, poses, _, hwf, K, i_split, near, far = scene
+    H, W = int(hwf[0]), int(hwf[1])
+
+    _, render_kwargs, start, _, _, _ = create_nerf(args)
+    if start == 0:
+        print('No trained model found in', os.path.join(args.basedir, args.expname))
+        return
+    widths = {'network_fn' : args.prune_width, 'network_fine' : args.prune_width_fine or args.prune_width}
+    nets = {k : render_kwargs[k] for k in widths if render_kwargs[k] is not None}
+
+    # Activations on the samples the networks see when rendering: the coarse
+    # samples for network_fn, the importance samples for network_fine
+    rays = sample_rays(np.asarray(poses)[i_split[0]], H, W, K, args.prune_views, args.prune_rays,
+                       ndc=render_kwargs.get('ndc', True), near=near, far=far, use_viewdirs=args.use_viewdirs)
+    stats = {k : ActivationStats(net) for k, net in nets.items()}
+    rgb, rays_per_sec = render_rays_timed(rays, args.chunk, render_kwargs, {})
+    for s in stats.values():
+        s.remove()
+
+    pruned = {k : prune_nerf(net, stats[k], widths[k]) for k, net in nets.items()}
+    pruned_rgb, pruned_rays_per_sec = render_rays_timed(rays, args.chunk, render_kwargs, pruned)
+    n_params = lambda nets : sum(p.numel() for net in nets.values() for p in net.parameters())
+    print('Pruned {} to {} parameters: PSNR to the original {:.2f} before fine-tuning, {:.0f} -> {:.0f} rays/s'.format(
+        n_params(nets), n_params(pruned), mse2psnr(img2mse(pruned_rgb, rgb)).item(), rays_per_sec, pruned_rays_per_sec))
+
+    # A standard checkpoint at step 0 with a fresh optimizer, which train() resumes
+    pargs = copy.deepcopy(args)
+    pargs.expname = args.prune_expname or '{}_w{}'.format(args.expname, args.prune_width)
+    pargs.netwidth, pargs.netwidth_fine = widths['network_fn'], widths['network_fine']
+    if args.prune_lrate is not None:
+        pargs.lrate = args.prune_lrate
+    else:
+        pargs.lrate = args.lrate * 0.1 ** (start / (args.lrate_decay * 1000))
+    pargs.ft_path = None
+    pargs.no_reload = False
+    pargs.precrop_iters = 0
+    pargs.N_iters = args.prune_iters
+    pargs.i_weights = max(args.prune_iters, 1)
+
+    prune_dir = os.path.join(pargs.basedir, pargs.expname)
+    os.makedirs(prune_dir, exist_ok=True)
+    grad_vars = [p for net in pruned.values() for p in net.parameters()]
+    optimizer = create_optimizer(pargs, pruned['network_fn'], grad_vars)
+    ckpt_manager = CheckpointManager(prune_dir, async_save=False)
+    path = ckpt_manager.save(0, {
+        'global_step': 0,
+        'network_fn_state_dict': pruned['network_fn'].state_dict(),
+        'network_fine_state_dict': pruned['network_fine'].state_dict() if 'network_fine' in pruned else None,
+        'optimizer_state_dict': optimizer.state_dict(),
+        'scene_bbox': pargs.scene_bbox,
+    })
+    print('Saved pruned checkpoint at', path)
+    meta_path = os.path.join(args.basedir, args.expname, 'scene_meta.npz')
+    if os.path.exists(meta_path):
+        shutil.copy(meta_path, os.path.join(prune_dir, 'scene_meta.npz'))
+
+    if args.prune_iters > 0:
+        print('Fine-tuning for {} steps at lrate {:.2e}'.format(args.prune_iters, pargs.lrate))
+        train(pargs)
+        _, tuned_kwargs, _, _, _, _ = create_nerf(pargs)
+        tuned = {k : tuned_kwargs[k] for k in pruned}
+        tuned_rgb, _ = render_rays_timed(rays, args.chunk, render_kwargs, tuned)
+        print('PSNR to the original after fine-tuning {:.2f}'.format(mse2psnr(img2mse(tuned_rgb, rgb)).item()))
+
+    # Written last: train() copies the original config into the experiment
+    overrides = {k : getattr(pargs, k) for k in ['expname', 'netdepth', 'netwidth', 'netdepth_fine', 'netwidth_fine']}
+    config_path = write_config(args, overrides, os.path.join(prune_dir, 'config.txt'))
+    print('Render it with: python run_nerf.py --config {} --render_only'.format(config_path))
+
+
+if __name__=='__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    args = prune_parser().parse_args()
+    prune(args)
@@ -0,0 +1,191 @@
+import os, sys
+import copy
+import json
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from run_nerf_helpers import img2mse, mse2psnr
+from run_nerf import (config_parser, create_nerf, load_data, load_scene_meta, sample_rays, batchify_rays, render,
+                      load_quantized_networks)
+from parallel_render import scale_intrinsics
+
+# torch.ao.quantization warns about its own deprecation on every call
+warnings.filterwarnings('ignore', category=DeprecationWarning, module='torch')
+warnings.filterwarnings('ignore', category=FutureWarning, module='torch')
+warnings.filterwarnings('ignore', category=UserWarning, module='torch.ao')
+
+
+QUANT_NETWORKS = ['network_fn', 'network_fine']
+
+
+def quantize_parser():
+    parser = config_parser()
+    parser.add_argument("--quant_mode", type=str, default='static', choices=['static', 'dynamic'],
+                        help='static: int8 activations calibrated on rendered samples, dynamic: int8 weights only')
+    parser.add_argument("--quant_backend", type=str, default=None, choices=torch.backends.quantized.supported_engines,
+                        help='quantized kernels, defaults to torch\'s choice for this CPU')
+    parser.add_argument("--quant_calib_views", type=int, default=8,
+                        help='training cameras the calibration rays are drawn from')
+    parser.add_argument("--quant_calib_rays", type=int, default=8192,
+                        help='calibration rays, rendered with the coarse and fine networks')
+    parser.add_argument("--quant_out", type=str, default=None,
+                        help='TorchScript artifact, defaults to {basedir}/{expname}/int8_{mode}_{step}.pt')
+    parser.add_argument("--quant_report", action='store_true',
+                        help='render test views with fp32 and int8 networks and report PSNR and throughput')
+    parser.add_argument("--quant_report_views", type=int, default=4,
+                        help='test views rendered for the report')
+    return parser
+
+
+def int8_layers(net):
+    """Names of the hidden nn.Linear layers. The output layers stay fp32: they are
+    tiny, and sigma and rgb are the most sensitive to rounding.
+    """
+    heads = ['alpha_linear', 'rgb_linear', 'output_linear']
+    return [n for n, m in net.named_modules() if isinstance(m, nn.Linear) and n not in heads]
+
+
+def example_input(net, n=1024):
+    return torch.randn(n, net.input_ch + net.input_ch_views)
+
+
+def float_copy(net):
+    return copy.deepcopy(net).cpu().eval()
+
+
+def prepare_static(net, backend):
+    """FX graph with observers on every activation of the int8 layers.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    layers = int8_layers(net)
+    for name, m in net.named_modules():
+        if isinstance(m, nn.Linear) and name not in layers:
+            qconfig_mapping.set_module_name(name, None)
+    return prepare_fx(net, qconfig_mapping, example_inputs=(example_input(net),))
+
+
+def quantize_dynamic(net):
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig
+    return quantize_dynamic(net, {name : default_dynamic_qconfig for name in int8_layers(net)}, dtype=torch.qint8)
+
+
+def ray_kwargs(render_kwargs, networks):
+    """render_rays arguments with the networks replaced.
+    """
+    kwargs = {k : v for k, v in render_kwargs.items() if k not in ['ndc', 'use_viewdirs', 'near', 'far']}
+    kwargs.update(networks)
+    return kwargs
+
+
+def save_quantized(path, networks, example, meta):
+    """One TorchScript file holding the coarse and fine networks traced on example,
+    with the settings they were quantized with.
+    """
+    traced = nn.Module()
+    for k in QUANT_NETWORKS:
+        net = networks[k] if networks[k] is not None else networks['network_fn']
+        with torch.no_grad():
+            setattr(traced, k, torch.jit.trace(net, example))
+    torch.jit.save(torch.jit.script(traced), path, _extra_files={'meta.json' : json.dumps(meta)})
+
+
+def report(args, render_kwargs, networks, scene, n_views):
+    """Renders test views with the fp32 and int8 networks. Returns the PSNR of each
+    against the ground truth, of int8 against fp32, and the rays per second.
+    """
+    images, poses, _, hwf, K, i_split, _, _ = scene
+    H, W, focal, K = scale_intrinsics(hwf, K, args.render_factor)
+    views = i_split[2][:n_views]
+    results = {}
+    rgbs = {}
+    for name, nets in [('fp32', {k : render_kwargs[k] for k in QUANT_NETWORKS}), ('int8', networks)]:
+        kwargs = dict(render_kwargs, **nets)
+        rgbs[name] = []
+        t = time.time()
+        with torch.no_grad():
+            for i in tqdm(views, desc=name):
+                rgb, _, _, _ = render(H, W, K, chunk=args.chunk, c2w=torch.Tensor(poses[i][:3,:4]), **kwargs)
+                rgbs[name].append(rgb)
+        seconds = time.time() - t
+        results[name] = {'seconds' : seconds, 'rays_per_sec' : len(views) * H * W / seconds}
+        if images is not None and args.render_factor == 0:
+            gt = torch.Tensor(np.asarray(images)[views][...,:3])
+            results[name]['psnr'] = mse2psnr(img2mse(torch.stack(rgbs[name], 0), gt)).item()
+    results['int8']['psnr_to_fp32'] = mse2psnr(img2mse(torch.stack(rgbs['int8'], 0), torch.stack(rgbs['fp32'], 0))).item()
+    results['speedup'] = results['fp32']['seconds'] / results['int8']['seconds']
+    return results
+
+
+def quantize(args):
+    if args.model_type == 'tensorf' or args.i_embed == 1:
+        # Their MLPs are a few 64-wide layers, the grid lookups dominate
+        print('quantize.py quantizes the NeRF MLPs, hash-encoded and TensoRF models are not supported')
+        return
+    if args.quant_backend is not None:
+        torch.backends.quantized.engine = args.quant_backend
+    backend = torch.backends.quantized.engine
+
+    scene = load_scene_meta(os.path.join(args.basedir, args.expname, 'scene_meta.npz'), args)
+    if scene is None or args.quant_report:
+        scene = load_data(args, load_imgs=args.quant_report)
+    _, poses, _, hwf, K, i_split, near, far = scene
+    H, W = int(hwf[0]), int(hwf[1])
+
+    _, render_kwargs, start, _, _, _ = create_nerf(args)
+    if start == 0:
+        print('No trained model found in', os.path.join(args.basedir, args.expname))
+        return
+    # Quantized kernels only run on the CPU
+    for k in QUANT_NETWORKS:
+        if render_kwargs[k] is not None:
+            render_kwargs[k].cpu().eval()
+    render_kwargs.update({'near' : near, 'far' : far})
+    fp32 = {k : render_kwargs[k] for k in QUANT_NETWORKS}
+
+    t = time.time()
+    if args.quant_mode == 'dynamic':
+        networks = {k : quantize_dynamic(float_copy(v)) if v is not None else None for k, v in fp32.items()}
+    else:
+        from torch.ao.quantization.quantize_fx import convert_fx
+        networks = {k : prepare_static(float_copy(v), backend) if v is not None else None for k, v in fp32.items()}
+        # Calibrate on the inputs the networks see when rendering: positions of the
+        # coarse and importance samples along rays of the training cameras
+        rays = sample_rays(np.asarray(poses)[i_split[0]], H, W, K, args.quant_calib_views, args.quant_calib_rays,
+                           ndc=render_kwargs.get('ndc', True), near=near, far=far, use_viewdirs=args.use_viewdirs)
+        with torch.no_grad():
+            batchify_rays(rays, args.chunk, **ray_kwargs(render_kwargs, networks))
+        networks = {k : convert_fx(v) if v is not None else None for k, v in networks.items()}
+    print('Quantized ({}, {}) in {:.1f}s'.format(args.quant_mode, backend, time.time() - t))
+
+    out = args.quant_out or os.path.join(args.basedir, args.expname, 'int8_{}_{:06d}.pt'.format(args.quant_mode, start))
+    meta = {'mode' : args.quant_mode, 'backend' : backend, 'global_step' : start,
+            'has_fine' : fp32['network_fine'] is not None, 'int8_layers' : int8_layers(fp32['network_fn'])}
+    save_quantized(out, networks, example_input(fp32['network_fn']), meta)
+    print('Saved', out)
+    print('Render with it: python run_nerf.py --config ... --render_only --render_quantized', out)
+
+    if args.quant_report:
+        # Reload, so the report measures the artifact itself
+        loaded = dict(zip(QUANT_NETWORKS, load_quantized_networks(out)))
+        results = report(args, render_kwargs, loaded, scene, args.quant_report_views)
+        results.update({'meta' : meta, 'threads' : torch.get_num_threads(), 'artifact' : out})
+        print('{:6s} {:>10s} {:>12s}'.format('', 'PSNR', 'rays/s'))
+        for name in ['fp32', 'int8']:
+            r = results[name]
+            print('{:6s} {:>10s} {:12.0f}'.format(name, '{:.2f}'.format(r['psnr']) if 'psnr' in r else 'n/a', r['rays_per_sec']))
+        print('int8 vs fp32: PSNR {:.2f}, speedup {:.2f}x'.format(results['int8']['psnr_to_fp32'], results['speedup']))
+        path = os.path.splitext(out)[0] + '_report.json'
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Saved', path)
+
+
+if __name__=='__main__':
+    args = quantize_parser().parse_args()
+    quantize(args)
@@ -0,0 +1,97 @@
+import torch
+
+
+class ErrorSampler:
+    """Draws training pixels in proportion to a running estimate of their loss.
+
+    Images are split into tile x tile tiles, each keeping an exponential moving
+    average of the loss of the rays drawn from it. A `mix` fraction of the
+    probability is uniform so every tile keeps being visited. Unvisited tiles
+    start at `init`, above any loss, so they are visited early, and take the loss
+    of their first rays as is. Tiles are drawn by inverting their cumulative
+    distribution, rebuilt every `rebuild` steps, pixels uniformly within a tile. Rays come with importance
+    weights, 1 under uniform sampling, that keep the weighted loss an unbiased
+    estimate of the uniform one.
+    """
+    def __init__(self, images, poses, K, tile=8, mix=.5, ema=.1, rebuild=100, init=1.):
+        self.images = images  # [N, H, W, 3]
+        self.poses = poses    # [N, 3, 4]
+        self.K = K
+        self.N, self.H, self.W = images.shape[:3]
+        self.tile, self.mix, self.ema, self.rebuild = tile, mix, ema, rebuild
+        self.th, self.tw = -(-self.H // tile), -(-self.W // tile)
+        # Kept on the CPU, where the table is built
+        self.loss = torch.full([self.N * self.th * self.tw], float(init), device='cpu')
+        self.visited = torch.zeros([self.N * self.th * self.tw], dtype=torch.bool, device='cpu')
+
+        # Pixels per tile, fewer on the last row and column
+        rows = torch.full([self.th], tile, device='cpu')
+        rows[-1] = self.H - tile * (self.th - 1)
+        cols = torch.full([self.tw], tile, device='cpu')
+        cols[-1] = self.W - tile * (self.tw - 1)
+        self.rows, self.cols = rows.to(images.device), cols.to(images.device)
+        self.tile_pixels = (rows[:,None] * cols[None,:]).reshape(-1).repeat(self.N).double()
+        self.steps = 0
+        self.build()
+
+    def build(self):
+        # Probability of a tile: its share of the total loss, mixed with its
+        # share of the pixels
+        p = (1. - self.mix) * self.loss.double() / self.loss.double().sum() \
+            + self.mix * self.tile_pixels / self.tile_pixels.sum()
+        device = self.images.device
+        # Importance weight of a tile's rays: uniform pixel probability over the
+        # pixel's, p_tile / tile_pixels
+        self.weights = (self.tile_pixels / (self.tile_pixels.sum() * p)).float().to(device)
+        # float64: a million tiles have probabilities below float32's resolution
+        self.cdf = torch.cumsum(p, 0).to(device)
+
+    def sample(self, n):
+        """n random rays: (rays [2, n, 3], target rgb [n, 3], weights [n], tiles [n]).
+        """
+        device = self.images.device
+        u = torch.rand(n, dtype=torch.float64, device=device) * self.cdf[-1]
+        tiles = torch.searchsorted(self.cdf, u, right=True).clamp_(max=len(self.cdf) - 1)
+
+        img, rest = tiles // (self.th * self.tw), tiles % (self.th * self.tw)
+        ty, tx = rest // self.tw, rest % self.tw
+        row = ty * self.tile + (torch.rand(n, device=device) * self.rows[ty]).long()
+        col = tx * self.tile + (torch.rand(n, device=device) * self.cols[tx]).long()
+
+        # Same directions as get_rays(), one camera per ray
+        dirs = torch.stack([(col - self.K[0][2]) / self.K[0][0], -(row - self.K[1][2]) / self.K[1][1],
+                            -torch.ones_like(col, dtype=torch.float)], -1).float()
+        pose = self.poses[img]
+        rays_d = torch.sum(dirs[:,None,:] * pose[:,:3,:3], -1)
+        rays_o = pose[:,:3,-1]
+        return torch.stack([rays_o, rays_d], 0), self.images[img, row, col], self.weights[tiles], tiles
+
+    def update(self, tiles, ray_loss):
+        """Folds the per-ray losses [n] of the rays drawn from tiles [n] into the
+        running estimates, rebuilding the distribution every `rebuild` calls.
+        """
+        tiles, ray_loss = tiles.cpu(), ray_loss.detach().float().cpu()
+        total = torch.zeros_like(self.loss).index_add_(0, tiles, ray_loss)
+        count = torch.zeros_like(self.loss).index_add_(0, tiles, torch.ones_like(ray_loss))
+        seen = count > 0
+        ema = torch.where(self.visited, self.ema, 1.)[seen]
+        self.loss[seen] = (1. - ema) * self.loss[seen] + ema * total[seen] / count[seen]
+        self.visited |= seen
+        self.steps += 1
+        if self.steps % self.rebuild == 0:
+            self.build()
+
+    def state_dict(self):
+        return {'loss' : self.loss.clone(), 'visited' : self.visited.clone(), 'steps' : self.steps}
+
+    def load_state_dict(self, state):
+        self.loss = state['loss'].clone().cpu()
+        self.visited = state['visited'].clone().cpu()
+        self.steps = state['steps']
+        self.build()
+
+
+def weighted_mse(x, y, weights):
+    """Mean squared error of rays [N, 3] under importance weights [N].
+    """
+    return torch.mean(weights[:,None] * (x - y) ** 2)
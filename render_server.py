@@ -0,0 +1,250 @@
+import os, sys
+import io
+import json
+import time
+import queue
+import threading
+import argparse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import imageio
+import torch
+
+from run_nerf_helpers import get_ray_dirs, to8b
+from run_nerf import config_parser, create_nerf, get_ray_batch, get_pixel_cone, batchify_rays, load_scene_meta
+from load_packed import packed_meta
+
+
+class Scene:
+    """A trained model kept resident, plus the per-intrinsics ray direction cache.
+    """
+    def __init__(self, name, config, max_cached_dirs=16):
+        args = config_parser().parse_args(['--config', config])
+        self.name = name
+        self.args = args
+        _, render_kwargs_test, start, _, _, _ = create_nerf(args, inference=True)
+        for k in ['network_fn', 'network_fine']:
+            if render_kwargs_test[k] is not None:
+                render_kwargs_test[k].eval()
+        self.global_step = start
+
+        # Arguments consumed while building rays vs. the ones for render_rays
+        self.ndc = render_kwargs_test.pop('ndc', True)
+        self.use_viewdirs = render_kwargs_test.pop('use_viewdirs')
+        self.render_kwargs = render_kwargs_test
+
+        # Same bounds train() used, from its scene metadata cache if there is one
+        self.near, self.far = None, None
+        meta = load_scene_meta(os.path.join(args.basedir, args.expname, 'scene_meta.npz'), args)
+        if meta is not None:
+            self.near, self.far = meta[-2:]
+        elif args.dataset_type == 'packed':
+            packed = packed_meta(args.datadir)
+            self.near, self.far = packed['near'], packed['far']
+        elif self.ndc:
+            self.near, self.far = 0., 1.
+        elif args.dataset_type == 'blender':
+            self.near, self.far = 2., 6.
+
+        self.dirs_cache = OrderedDict()
+        self.max_cached_dirs = max_cached_dirs
+        self.lock = threading.Lock()
+
+    def get_dirs(self, H, W, K):
+        key = (H, W) + tuple(np.asarray(K, dtype=np.float64).reshape(-1).tolist())
+        with self.lock:
+            if key in self.dirs_cache:
+                self.dirs_cache.move_to_end(key)
+                return self.dirs_cache[key]
+        dirs = get_ray_dirs(H, W, K)
+        with self.lock:
+            self.dirs_cache[key] = dirs
+            if len(self.dirs_cache) > self.max_cached_dirs:
+                self.dirs_cache.popitem(last=False)
+        return dirs
+
+    def make_rays(self, req):
+        H, W = int(req['H']), int(req['W'])
+        if 'K' in req:
+            K = np.array(req['K'], dtype=np.float32)
+        else:
+            focal = float(req['focal'])
+            K = np.array([[focal, 0, 0.5*W], [0, focal, 0.5*H], [0, 0, 1]], dtype=np.float32)
+        c2w = torch.Tensor(np.array(req['c2w'], dtype=np.float32)[:3,:4])
+        near = req.get('near', self.near)
+        far = req.get('far', self.far)
+        if near is None or far is None:
+            raise ValueError('near/far are required for dataset_type {}'.format(self.args.dataset_type))
+        rays, sh = get_ray_batch(H, W, K, c2w=c2w, ndc=self.ndc, near=float(near), far=float(far),
+                                 use_viewdirs=self.use_viewdirs, dirs=self.get_dirs(H, W, K))
+        # Level of detail needs the pixel footprint, as in render()
+        cone = None
+        if self.render_kwargs.get('lod_quality', 1.) < 1.:
+            cone = get_pixel_cone(W, K, self.ndc)
+        return rays, sh, cone
+
+
+class Job:
+    def __init__(self, scene, rays, sh, cone=None):
+        self.scene = scene
+        self.rays = rays
+        self.sh = sh
+        self.cone = cone
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class RenderBatcher(threading.Thread):
+    """Single render thread. Jobs that arrive within `window` seconds of each other
+    are concatenated per scene and rendered in shared chunks.
+    """
+    def __init__(self, chunk, window=0.005):
+        super().__init__(daemon=True)
+        self.chunk = chunk
+        self.window = window
+        self.queue = queue.Queue()
+
+    def submit(self, scene, rays, sh, cone=None):
+        job = Job(scene, rays, sh, cone)
+        self.queue.put(job)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def run(self):
+        while True:
+            jobs = [self.queue.get()]
+            n_rays = jobs[0].rays.shape[0]
+            deadline = time.time() + self.window
+            while n_rays < self.chunk:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    jobs.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                n_rays += jobs[-1].rays.shape[0]
+
+            # Rays rendered together share their scene and pixel footprint
+            groups = OrderedDict()
+            for job in jobs:
+                groups.setdefault((job.scene.name, job.cone), []).append(job)
+            for group in groups.values():
+                self.render_group(group)
+
+    def render_group(self, jobs):
+        scene = jobs[0].scene
+        try:
+            rays = torch.cat([job.rays for job in jobs], 0)
+            kwargs = scene.render_kwargs
+            if jobs[0].cone is not None:
+                kwargs = dict(kwargs, pixel_cone=jobs[0].cone)
+            with torch.no_grad():
+                all_ret = batchify_rays(rays, self.chunk, **kwargs)
+            offset = 0
+            for job in jobs:
+                n = job.rays.shape[0]
+                job.result = {k : torch.reshape(all_ret[k][offset:offset+n], list(job.sh[:-1]) + list(all_ret[k].shape[1:])).cpu().numpy()
+                              for k in ['rgb_map', 'disp_map', 'acc_map', 'depth_map'] if k in all_ret}
+                offset += n
+        except Exception as e:
+            for job in jobs:
+                job.error = e
+        for job in jobs:
+            job.done.set()
+
+
+def encode(result, output, fmt):
+    out = {'rgb' : 'rgb_map', 'disp' : 'disp_map', 'acc' : 'acc_map', 'depth' : 'depth_map'}[output]
+    img = result[out]
+    buf = io.BytesIO()
+    if fmt == 'npy':
+        np.save(buf, img)
+        return buf.getvalue(), 'application/octet-stream'
+    if output != 'rgb':
+        img = img / max(np.max(img), 1e-10)
+    imageio.imwrite(buf, to8b(img), format='png')
+    return buf.getvalue(), 'image/png'
+
+
+def make_handler(scenes, batcher):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def send(self, code, body, content_type='application/json'):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') != '/scenes':
+                return self.send(404, b'{"error": "not found"}')
+            info = {name : {'expname' : s.args.expname, 'global_step' : s.global_step, 'ndc' : s.ndc,
+                            'near' : s.near, 'far' : s.far} for name, s in scenes.items()}
+            self.send(200, json.dumps(info).encode())
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/render':
+                return self.send(404, b'{"error": "not found"}')
+            try:
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                name = req.get('scene', next(iter(scenes)))
+                scene = scenes[name]
+                rays, sh, cone = scene.make_rays(req)
+                result = batcher.submit(scene, rays, sh, cone)
+                body, content_type = encode(result, req.get('output', 'rgb'), req.get('format', 'png'))
+            except (KeyError, ValueError) as e:
+                return self.send(400, json.dumps({'error' : repr(e)}).encode())
+            except Exception as e:
+                return self.send(500, json.dumps({'error' : repr(e)}).encode())
+            self.send(200, body, content_type)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def server_parser():
+    parser = argparse.ArgumentParser(description='Serve renders of trained NeRF models over HTTP. '
+        'POST /render with JSON {"scene", "c2w" (3x4 or 4x4), "H", "W", "K" (3x3) or "focal", '
+        '"near", "far", "output": rgb|disp|acc|depth, "format": png|npy}.')
+    parser.add_argument("--scene", action='append', required=True,
+                        help='name=path/to/config.txt of a trained experiment, can be repeated')
+    parser.add_argument("--host", type=str, default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--chunk", type=int, default=1024*32,
+                        help='rays rendered together, shared by concurrent requests')
+    parser.add_argument("--batch_window", type=float, default=0.005,
+                        help='seconds to wait for more requests before rendering a batch')
+    parser.add_argument("--threads", type=int, default=0,
+                        help='torch intra-op threads, 0 keeps the default')
+    return parser
+
+
+if __name__=='__main__':
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+    sargs = server_parser().parse_args()
+    if sargs.threads > 0:
+        torch.set_num_threads(sargs.threads)
+
+    scenes = OrderedDict()
+    for spec in sargs.scene:
+        name, config = spec.split('=', 1)
+        scenes[name] = Scene(name, config)
+        print('Loaded scene', name, 'from', config)
+
+    batcher = RenderBatcher(sargs.chunk, sargs.batch_window)
+    batcher.start()
+    httpd = ThreadingHTTPServer((sargs.host, sargs.port), make_handler(scenes, batcher))
+    print('Serving on {}:{}'.format(sargs.host, sargs.port))
+    httpd.serve_forever()
@@ -2,21 +2,32 @@ import os, sys
 import numpy as np
 import imageio
 import json
+import math
 import random
 import time
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from tqdm import tqdm, trange
 
-import matplotlib.pyplot as plt
-
 from run_nerf_helpers import *
 
-from load_llff import load_llff_data
-from load_deepvoxels import load_dv_data
-from load_blender import load_blender_data
-from load_LINEMOD import load_LINEMOD_data
+# The other loaders are imported by load_data, only for their dataset type
+from load_packed import load_packed_data, packed_meta
+
+from parallel_render import render_path_parallel, scale_intrinsics, can_fork
+from temporal_render import render_path_temporal
+from ray_sampler import ErrorSampler, weighted_mse
+from prefetch import Prefetcher, RayBatches, ImageBatches
+from distributed import init_distributed, is_main_process, broadcast_params, broadcast_object, allreduce_grads, launch_local
+from metrics import metrics
+from checkpoint import (CheckpointManager, find_checkpoints, load_checkpoint, get_rng_state, set_rng_state,
+                        load_inference_weights, INFERENCE_WEIGHTS)
+from autotune import apply_autotune
+from hash_encoding import HashEmbedder, frustum_bbox
+from tensorf import TensorVM, TensorCP, n_to_res
 
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -34,26 +45,49 @@ def batchify(fn, chunk):
     return ret
 
 
-def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64):
-    """Prepares inputs and applies network 'fn'.
+def run_network(inputs, viewdirs, fn, embed_fn, embeddirs_fn, netchunk=1024*64, var=None, pe_alpha=None,
+                grad_checkpoint=False):
+    """Prepares inputs and applies network 'fn'. var: optional [..., N_samples]
+    variance of every sample's position, which attenuates the encoding.
+    pe_alpha: optional number of encoding frequency bands let through.
+    grad_checkpoint: keep only the network inputs of every netchunk for backward,
+    which runs the network again to get its activations.
     """
-    inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
-    embedded = embed_fn(inputs_flat)
-
-    if viewdirs is not None:
-        input_dirs = viewdirs[:,None].expand(inputs.shape)
-        input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
-        embedded_dirs = embeddirs_fn(input_dirs_flat)
-        embedded = torch.cat([embedded, embedded_dirs], -1)
-
-    outputs_flat = batchify(fn, netchunk)(embedded)
+    with metrics.timer('embed'):
+        inputs_flat = torch.reshape(inputs, [-1, inputs.shape[-1]])
+        embed_kwargs = {}
+        if var is not None:
+            embed_kwargs['var'] = torch.reshape(var, [-1, 1])
+        if pe_alpha is not None:
+            embed_kwargs['alpha'] = pe_alpha
+        embedded = embed_fn(inputs_flat, **embed_kwargs)
+
+        if viewdirs is not None:
+            input_dirs = viewdirs[:,None].expand(inputs.shape)
+            input_dirs_flat = torch.reshape(input_dirs, [-1, input_dirs.shape[-1]])
+            embedded_dirs = embeddirs_fn(input_dirs_flat)
+            embedded = torch.cat([embedded, embedded_dirs], -1)
+
+    with metrics.timer('mlp'):
+        if grad_checkpoint and torch.is_grad_enabled():
+            fn = functools.partial(torch.utils.checkpoint.checkpoint, fn, use_reentrant=False)
+        outputs_flat = batchify(fn, netchunk)(embedded)
     outputs = torch.reshape(outputs_flat, list(inputs.shape[:-1]) + [outputs_flat.shape[-1]])
     return outputs
 
 
-def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
+def batchify_rays(rays_flat, chunk=1024*32, scene_bbox=None, **kwargs):
     """Render rays in smaller minibatches to avoid OOM.
+    scene_bbox: [2, 3] box or None. Rays are clipped to it, and those missing it
+      are not rendered: they get the background color and zeros elsewhere.
     """
+    if scene_bbox is not None:
+        rays_flat, hit = clip_rays(rays_flat, scene_bbox)
+        # Render at least one ray, for the shapes of the outputs
+        rendered = hit.clone()
+        rendered[0] = True
+        rays_flat = rays_flat[rendered]
+
     all_ret = {}
     for i in range(0, rays_flat.shape[0], chunk):
         ret = render_rays(rays_flat[i:i+chunk], **kwargs)
@@ -63,38 +97,42 @@ def batchify_rays(rays_flat, chunk=1024*32, **kwargs):
             all_ret[k].append(ret[k])
 
     all_ret = {k : torch.cat(all_ret[k], 0) for k in all_ret}
+    if scene_bbox is not None:
+        bkgd = 1. if kwargs.get('white_bkgd', False) else 0.
+        for k, v in all_ret.items():
+            out = torch.full([hit.shape[0]] + list(v.shape[1:]), bkgd if k in ['rgb_map', 'rgb0'] else 0., dtype=v.dtype)
+            out[rendered] = v
+            out[rendered & ~hit] = bkgd if k in ['rgb_map', 'rgb0'] else 0.
+            all_ret[k] = out
     return all_ret
 
 
-def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
+def clip_rays(rays_flat, box):
+    """Ray batch with near and far clipped to the box, and which rays cross it
+    between their near and far.
+    """
+    t_enter, t_exit = ray_box(rays_flat[:,0:3], rays_flat[:,3:6], box)
+    near = torch.maximum(rays_flat[:,6], t_enter)
+    far = torch.minimum(rays_flat[:,7], t_exit)
+    hit = near < far
+    # Missed rays keep a valid interval, they are not rendered anyway
+    rays_flat = torch.cat([rays_flat[:,:6], torch.where(hit, near, rays_flat[:,6])[:,None],
+                           torch.where(hit, far, rays_flat[:,7])[:,None], rays_flat[:,8:]], -1)
+    return rays_flat, hit
+
+
+def get_ray_batch(H, W, K, rays=None, c2w=None, ndc=True,
                   near=0., far=1.,
-                  use_viewdirs=False, c2w_staticcam=None,
-                  **kwargs):
-    """Render rays
-    Args:
-      H: int. Height of image in pixels.
-      W: int. Width of image in pixels.
-      focal: float. Focal length of pinhole camera.
-      chunk: int. Maximum number of rays to process simultaneously. Used to
-        control maximum memory usage. Does not affect final results.
-      rays: array of shape [2, batch_size, 3]. Ray origin and direction for
-        each example in batch.
-      c2w: array of shape [3, 4]. Camera-to-world transformation matrix.
-      ndc: bool. If True, represent ray origin, direction in NDC coordinates.
-      near: float or array of shape [batch_size]. Nearest distance for a ray.
-      far: float or array of shape [batch_size]. Farthest distance for a ray.
-      use_viewdirs: bool. If True, use viewing direction of a point in space in model.
-      c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
-       camera while using other c2w argument for viewing directions.
+                  use_viewdirs=False, c2w_staticcam=None, dirs=None):
+    """Builds the flat ray batch consumed by render_rays.
+    Args: see render(). dirs: optional cached output of get_ray_dirs(H, W, K).
     Returns:
-      rgb_map: [batch_size, 3]. Predicted RGB values for rays.
-      disp_map: [batch_size]. Disparity map. Inverse of depth.
-      acc_map: [batch_size]. Accumulated opacity (alpha) along a ray.
-      extras: dict with everything returned by render_rays().
+      rays: [batch_size, 8] (or 11 with viewdirs). Origin, direction, near, far, viewdir.
+      sh: shape of the input rays, used to reshape the outputs.
     """
     if c2w is not None:
         # special case to render full image
-        rays_o, rays_d = get_rays(H, W, K, c2w)
+        rays_o, rays_d = get_rays(H, W, K, c2w, dirs=dirs)
     else:
         # use provided ray batch
         rays_o, rays_d = rays
@@ -104,7 +142,7 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
         viewdirs = rays_d
         if c2w_staticcam is not None:
             # special case to visualize effect of viewdirs
-            rays_o, rays_d = get_rays(H, W, K, c2w_staticcam)
+            rays_o, rays_d = get_rays(H, W, K, c2w_staticcam, dirs=dirs)
         viewdirs = viewdirs / torch.norm(viewdirs, dim=-1, keepdim=True)
         viewdirs = torch.reshape(viewdirs, [-1,3]).float()
 
@@ -122,6 +160,60 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
     if use_viewdirs:
         rays = torch.cat([rays, viewdirs], -1)
 
+    return rays, sh
+
+
+def sample_rays(poses, H, W, K, n_views, n_rays, **kwargs):
+    """Ray batch of n_rays random pixels of n_views random cameras among poses,
+    built by get_ray_batch(**kwargs).
+    """
+    rays_o, rays_d = [], []
+    for c in np.random.choice(len(poses), n_views):
+        ro, rd = get_rays(H, W, K, torch.Tensor(poses[c][:3,:4]))
+        select = torch.randint(H*W, (n_rays // n_views,))
+        rays_o.append(ro.reshape(-1, 3)[select])
+        rays_d.append(rd.reshape(-1, 3)[select])
+    rays, _ = get_ray_batch(H, W, K, rays=(torch.cat(rays_o, 0), torch.cat(rays_d, 0)), **kwargs)
+    return rays
+
+
+def get_pixel_cone(W, K, ndc):
+    """Pixel width at distance t along the rays, w0 + w1*t: t/focal, or 2/W in NDC.
+    """
+    return (2. / W, 0.) if ndc else (0., 1. / K[0][0])
+
+
+def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
+                  near=0., far=1.,
+                  use_viewdirs=False, c2w_staticcam=None,
+                  **kwargs):
+    """Render rays
+    Args:
+      H: int. Height of image in pixels.
+      W: int. Width of image in pixels.
+      focal: float. Focal length of pinhole camera.
+      chunk: int. Maximum number of rays to process simultaneously. Used to
+        control maximum memory usage. Does not affect final results.
+      rays: array of shape [2, batch_size, 3]. Ray origin and direction for
+        each example in batch.
+      c2w: array of shape [3, 4]. Camera-to-world transformation matrix.
+      ndc: bool. If True, represent ray origin, direction in NDC coordinates.
+      near: float or array of shape [batch_size]. Nearest distance for a ray.
+      far: float or array of shape [batch_size]. Farthest distance for a ray.
+      use_viewdirs: bool. If True, use viewing direction of a point in space in model.
+      c2w_staticcam: array of shape [3, 4]. If not None, use this transformation matrix for 
+       camera while using other c2w argument for viewing directions.
+    Returns:
+      rgb_map: [batch_size, 3]. Predicted RGB values for rays.
+      disp_map: [batch_size]. Disparity map. Inverse of depth.
+      acc_map: [batch_size]. Accumulated opacity (alpha) along a ray.
+      extras: dict with everything returned by render_rays().
+    """
+    rays, sh = get_ray_batch(H, W, K, rays=rays, c2w=c2w, ndc=ndc, near=near, far=far,
+                             use_viewdirs=use_viewdirs, c2w_staticcam=c2w_staticcam)
+    if kwargs.get('lod_quality', 1.) < 1.:
+        kwargs['pixel_cone'] = get_pixel_cone(W, K, ndc)
+
     # Render and reshape
     all_ret = batchify_rays(rays, chunk, **kwargs)
     for k in all_ret:
@@ -136,13 +228,8 @@ def render(H, W, K, chunk=1024*32, rays=None, c2w=None, ndc=True,
 
 def render_path(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedir=None, render_factor=0):
 
-    H, W, focal = hwf
-
-    if render_factor!=0:
-        # Render downsampled for speed
-        H = H//render_factor
-        W = W//render_factor
-        focal = focal/render_factor
+    # Render downsampled for speed
+    H, W, focal, K = scale_intrinsics(hwf, K, render_factor)
 
     rgbs = []
     disps = []
@@ -151,17 +238,16 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedi
     for i, c2w in enumerate(tqdm(render_poses)):
         print(i, time.time() - t)
         t = time.time()
-        rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
+        with metrics.timer('render_frame'):
+            rgb, disp, acc, _ = render(H, W, K, chunk=chunk, c2w=c2w[:3,:4], **render_kwargs)
         rgbs.append(rgb.cpu().numpy())
         disps.append(disp.cpu().numpy())
         if i==0:
             print(rgb.shape, disp.shape)
 
-        """
         if gt_imgs is not None and render_factor==0:
-            p = -10. * np.log10(np.mean(np.square(rgb.cpu().numpy() - gt_imgs[i])))
-            print(p)
-        """
+            gt = gt_imgs[i].cpu().numpy() if torch.is_tensor(gt_imgs) else gt_imgs[i]
+            print('PSNR', -10. * np.log10(np.mean(np.square(rgbs[-1] - gt))))
 
         if savedir is not None:
             rgb8 = to8b(rgbs[-1])
@@ -175,36 +261,103 @@ def render_path(render_poses, hwf, K, chunk, render_kwargs, gt_imgs=None, savedi
     return rgbs, disps
 
 
-def create_nerf(args):
+def create_optimizer(args, model, grad_vars):
+    """Adam with the settings of the chosen scene representation.
+    """
+    if args.model_type == 'tensorf':
+        return torch.optim.Adam(params=model.param_groups(args.lrate), betas=(0.9, 0.99))
+    if args.i_embed == 1:
+        # Settings of Instant-NGP, the sparse hash table updates need a tiny epsilon
+        return torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.99), eps=1e-15)
+    return torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
+
+
+def load_quantized_networks(path):
+    """Coarse and fine int8 networks saved by quantize.py, as TorchScript modules.
+    Quantized kernels only run on the CPU.
+    """
+    if torch.cuda.is_available():
+        raise RuntimeError('int8 networks run on the CPU, hide the GPUs with CUDA_VISIBLE_DEVICES=')
+    extra_files = {'meta.json' : ''}
+    networks = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+    meta = json.loads(extra_files['meta.json'])
+    torch.backends.quantized.engine = meta['backend']
+    print('Loaded int8 networks ({}, {}, step {}) from {}'.format(meta['mode'], meta['backend'], meta['global_step'], path))
+    return networks.network_fn, networks.network_fine if meta['has_fine'] else None
+
+
+def create_nerf(args, inference=None):
     """Instantiate NeRF's MLP model.
+    inference: only render with the model, defaults to args.render_only. The
+      weights exported by export_weights.py are then preferred to the training
+      checkpoints, and no optimizer is created (None is returned).
     """
-    embed_fn, input_ch = get_embedder(args.multires, args.i_embed)
+    # Grid-based models are restored with their box from the checkpoint when
+    # train() did not compute one
+    bounding_box = getattr(args, 'bounding_box', None)
+    if bounding_box is None:
+        bounding_box = [[-1., -1., -1.], [1., 1., 1.]]
+
+    if args.model_type == 'tensorf':
+        # The factorized grid is queried with raw positions and view directions
+        embed_fn, input_ch = get_embedder(args.multires, -1)
+    elif args.i_embed == 1:
+        embed_fn = HashEmbedder(bounding_box, n_levels=args.hash_levels,
+                                log2_hashmap_size=args.hash_log2_size,
+                                base_resolution=args.hash_base_res,
+                                finest_resolution=args.hash_finest_res).to(device)
+        input_ch = embed_fn.out_dim
+    else:
+        embed_fn, input_ch = get_embedder(args.multires, args.i_embed)
 
     input_ch_views = 0
     embeddirs_fn = None
     if args.use_viewdirs:
-        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, args.i_embed)
+        embeddirs_fn, input_ch_views = get_embedder(args.multires_views, -1 if args.model_type == 'tensorf' else min(args.i_embed, 0))
     output_ch = 5 if args.N_importance > 0 else 4
     skips = [4]
-    model = NeRF(D=args.netdepth, W=args.netwidth,
-                 input_ch=input_ch, output_ch=output_ch, skips=skips,
-                 input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    if args.model_type == 'tensorf':
+        tensorf_class = TensorVM if args.tensorf_mode == 'vm' else TensorCP
+        model = tensorf_class(bounding_box, n_to_res(args.tensorf_res_init**3, bounding_box),
+                              density_n_comp=args.tensorf_density_comp, app_n_comp=args.tensorf_app_comp,
+                              use_viewdirs=args.use_viewdirs).to(device)
+    elif args.i_embed == 1:
+        model = NeRFSmall(input_ch=input_ch, input_ch_views=input_ch_views).to(device)
+        # The hash tables are trained with the coarse network and saved, shared and
+        # synchronized as part of it; the fine network queries the same tables
+        model.embed_fn = embed_fn
+    else:
+        model = NeRF(D=args.netdepth, W=args.netwidth,
+                     input_ch=input_ch, output_ch=output_ch, skips=skips,
+                     input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
     grad_vars = list(model.parameters())
 
     model_fine = None
-    if args.N_importance > 0:
-        model_fine = NeRF(D=args.netdepth_fine, W=args.netwidth_fine,
-                          input_ch=input_ch, output_ch=output_ch, skips=skips,
-                          input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
+    # A TensoRF model also takes the fine samples (network_fine=None)
+    if args.N_importance > 0 and args.model_type != 'tensorf':
+        if args.i_embed == 1:
+            model_fine = NeRFSmall(input_ch=input_ch, input_ch_views=input_ch_views).to(device)
+        else:
+            model_fine = NeRF(D=args.netdepth_fine, W=args.netwidth_fine,
+                              input_ch=input_ch, output_ch=output_ch, skips=skips,
+                              input_ch_views=input_ch_views, use_viewdirs=args.use_viewdirs).to(device)
         grad_vars += list(model_fine.parameters())
 
-    network_query_fn = lambda inputs, viewdirs, network_fn : run_network(inputs, viewdirs, network_fn,
+    # Only the positional encoding can be attenuated for level of detail or windowed
+    attenuate = args.model_type == 'nerf' and args.i_embed == 0
+    network_query_fn = lambda inputs, viewdirs, network_fn, var=None, pe_alpha=None : run_network(inputs, viewdirs, network_fn,
                                                                 embed_fn=embed_fn,
                                                                 embeddirs_fn=embeddirs_fn,
-                                                                netchunk=args.netchunk)
+                                                                netchunk=args.netchunk,
+                                                                var=var if attenuate else None,
+                                                                pe_alpha=pe_alpha if attenuate else None,
+                                                                grad_checkpoint=args.grad_checkpoint)
+
+    if inference is None:
+        inference = args.render_only
 
     # Create optimizer
-    optimizer = torch.optim.Adam(params=grad_vars, lr=args.lrate, betas=(0.9, 0.999))
+    optimizer = None if inference else create_optimizer(args, model, grad_vars)
 
     start = 0
     basedir = args.basedir
@@ -213,24 +366,58 @@ def create_nerf(args):
     ##########################
 
     # Load checkpoints
-    if args.ft_path is not None and args.ft_path!='None':
+    has_ft_path = args.ft_path is not None and args.ft_path!='None'
+    weights_path = os.path.join(basedir, expname, INFERENCE_WEIGHTS)
+    # Checkpoints written after the export remove it, so it is never stale
+    use_weights = inference and not has_ft_path and not args.no_reload and os.path.exists(weights_path)
+    if use_weights:
+        ckpts = []
+    elif has_ft_path:
         ckpts = [args.ft_path]
     else:
-        ckpts = [os.path.join(basedir, expname, f) for f in sorted(os.listdir(os.path.join(basedir, expname))) if 'tar' in f]
+        ckpts = find_checkpoints(os.path.join(basedir, expname))
 
-    print('Found ckpts', ckpts)
+    ckpt = None
+    if use_weights:
+        print('Loading inference weights from', weights_path)
+    else:
+        print('Found ckpts', ckpts)
     if len(ckpts) > 0 and not args.no_reload:
-        ckpt_path = ckpts[-1]
+        # Newest readable ckpt, an unfinished or corrupt one falls back to the previous
+        ckpt_path, ckpt = load_checkpoint(ckpts, map_location=device)
+
+    train_state = None
+    saved_bbox = None
+    if use_weights:
+        weights_meta, state = load_inference_weights(weights_path, device)
+        start, saved_bbox = weights_meta['global_step'], weights_meta.get('scene_bbox')
+        # The mapped tensors become the parameters, nothing is copied on the CPU
+        model.load_state_dict(state['network_fn'], assign=True)
+        if model_fine is not None:
+            model_fine.load_state_dict(state['network_fine'], assign=True)
+        grad_vars = list(model.parameters()) + (list(model_fine.parameters()) if model_fine is not None else [])
+    elif ckpt is not None:
         print('Reloading from', ckpt_path)
-        ckpt = torch.load(ckpt_path)
-
         start = ckpt['global_step']
-        optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+        train_state = ckpt.get('train_state')
+        saved_bbox = ckpt.get('scene_bbox')
 
         # Load model
         model.load_state_dict(ckpt['network_fn_state_dict'])
         if model_fine is not None:
             model_fine.load_state_dict(ckpt['network_fine_state_dict'])
+        if args.model_type == 'tensorf':
+            # The grids were resized to the checkpoint's, the optimizer must hold the new ones
+            grad_vars = list(model.parameters())
+            if optimizer is not None:
+                optimizer = create_optimizer(args, model, grad_vars)
+        if optimizer is not None:
+            optimizer.load_state_dict(ckpt['optimizer_state_dict'])
+
+    if args.render_quantized is not None:
+        if not args.render_only:
+            raise ValueError('--render_quantized only applies to --render_only')
+        model, model_fine = load_quantized_networks(args.render_quantized)
 
     ##########################
 
@@ -244,27 +431,46 @@ def create_nerf(args):
         'use_viewdirs' : args.use_viewdirs,
         'white_bkgd' : args.white_bkgd,
         'raw_noise_std' : args.raw_noise_std,
+        'fused_composite' : args.fused_composite,
     }
 
     # NDC only good for LLFF-style forward facing data
-    if args.dataset_type != 'llff' or args.no_ndc:
+    if scene_type(args) != 'llff' or args.no_ndc:
         print('Not ndc!')
         render_kwargs_train['ndc'] = False
         render_kwargs_train['lindisp'] = args.lindisp
 
+    if args.scene_bbox is None:
+        # The box the model was trained in (resolved by scene_bbox_auto), which it
+        # was never queried outside of. Older checkpoints only have it in the scene metadata
+        if saved_bbox is None:
+            saved_bbox = load_scene_bbox(os.path.join(basedir, expname, 'scene_meta.npz'))
+        if saved_bbox is not None:
+            args.scene_bbox = list(saved_bbox)
+            print('Scene bounding box of the trained model', args.scene_bbox)
+    if args.scene_bbox is not None:
+        if render_kwargs_train.get('ndc', True):
+            raise ValueError('--scene_bbox needs world-space rays, it does not apply to NDC scenes')
+        render_kwargs_train['scene_bbox'] = torch.Tensor(args.scene_bbox).reshape(2, 3)
+
     render_kwargs_test = {k : render_kwargs_train[k] for k in render_kwargs_train}
     render_kwargs_test['perturb'] = False
     render_kwargs_test['raw_noise_std'] = 0.
+    render_kwargs_test['lod_quality'] = args.lod_quality
+    render_kwargs_test['lod_blur'] = args.lod_blur
 
-    return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer
+    return render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer, train_state
 
 
-def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False):
+def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=False, fused=False):
     """Transforms model's predictions to semantically meaningful values.
     Args:
         raw: [num_rays, num_samples along ray, 4]. Prediction from model.
         z_vals: [num_rays, num_samples along ray]. Integration time.
         rays_d: [num_rays, 3]. Direction of each ray.
+        fused: bool. Composite with FusedComposite, whose backward recomputes the
+          per-sample intermediates instead of keeping them. Only if the samples
+          positions need no gradient.
     Returns:
         rgb_map: [num_rays, 3]. Estimated RGB color of a ray.
         disp_map: [num_rays]. Disparity map. Inverse of depth map.
@@ -279,7 +485,6 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
 
     dists = dists * torch.norm(rays_d[...,None,:], dim=-1)
 
-    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
     noise = 0.
     if raw_noise_std > 0.:
         noise = torch.randn(raw[...,3].shape) * raw_noise_std
@@ -290,6 +495,14 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
             noise = np.random.rand(*list(raw[...,3].shape)) * raw_noise_std
             noise = torch.Tensor(noise)
 
+    if fused and not (z_vals.requires_grad or rays_d.requires_grad):
+        rgb_map, depth_map, acc_map, weights = FusedComposite.apply(raw[...,:3], raw[...,3] + noise, z_vals, dists)
+        disp_map = 1./torch.max(1e-10 * torch.ones_like(depth_map), depth_map / acc_map)
+        if white_bkgd:
+            rgb_map = rgb_map + (1.-acc_map[...,None])
+        return rgb_map, disp_map, acc_map, weights, depth_map
+
+    rgb = torch.sigmoid(raw[...,:3])  # [N_rays, N_samples, 3]
     alpha = raw2alpha(raw[...,3] + noise, dists)  # [N_rays, N_samples]
     # weights = alpha * tf.math.cumprod(1.-alpha + 1e-10, -1, exclusive=True)
     weights = alpha * torch.cumprod(torch.cat([torch.ones((alpha.shape[0], 1)), 1.-alpha + 1e-10], -1), -1)[:, :-1]
@@ -305,6 +518,42 @@ def raw2outputs(raw, z_vals, rays_d, raw_noise_std=0, white_bkgd=False, pytest=F
     return rgb_map, disp_map, acc_map, weights, depth_map
 
 
+# Level of detail: a chunk takes at least this many coarse samples, and rays whose
+# coarse opacity stays below LOD_EMPTY_ACC get no importance samples
+LOD_MIN_SAMPLES = 8
+LOD_EMPTY_ACC = 1e-2
+
+
+def footprint_samples(near, far, norm_d, pixel_cone, quality):
+    """Samples that step along each ray from near to far [N_rays] by one pixel
+    footprint divided by quality: the integral of quality*|d|/w(t) dt, where
+    w(t) = w0 + w1*t is the width of a pixel at t.
+    """
+    w0, w1 = pixel_cone
+    if w1 > 0:
+        n = torch.log((w0 + w1 * far) / torch.clamp(w0 + w1 * near, min=1e-10)) / w1
+    else:
+        n = (far - near) / w0
+    return quality * norm_d * n
+
+
+def lod_count(n, N_max, N_min=0):
+    """Samples of a chunk: enough for its most demanding ray, at most N_max.
+    """
+    n = torch.nan_to_num(n, nan=N_max, posinf=N_max).max().item()
+    return int(min(N_max, max(N_min, math.ceil(n))))
+
+
+def lod_var(extent, norm_d, N, N_full):
+    """Variance the encoding is blurred with, [N_rays, 1]: that of a uniform
+    distribution over the spacing of N samples along extent [N_rays], minus that of
+    the N_full samples the model was trained with. None when nothing was dropped.
+    """
+    if N >= N_full:
+        return None
+    return ((norm_d * extent)**2 * (1. / N**2 - 1. / N_full**2) / 12.)[...,None]
+
+
 def render_rays(ray_batch,
                 network_fn,
                 network_query_fn,
@@ -317,7 +566,12 @@ def render_rays(ray_batch,
                 white_bkgd=False,
                 raw_noise_std=0.,
                 verbose=False,
-                pytest=False):
+                pytest=False,
+                lod_quality=1.,
+                lod_blur=False,
+                pixel_cone=None,
+                pe_alpha=None,
+                fused_composite=False):
     """Volumetric rendering.
     Args:
       ray_batch: array of shape [batch_size, ...]. All information necessary
@@ -337,11 +591,22 @@ def render_rays(ray_batch,
       white_bkgd: bool. If True, assume a white background.
       raw_noise_std: ...
       verbose: bool. If True, print more debugging info.
+      lod_quality: float in (0, 1]. Below 1, every chunk takes only the samples its
+        rays need at this fraction of the pixel footprint sampling rate, and the
+        positional encoding is blurred by the spacing lost if lod_blur.
+      pixel_cone: (w0, w1). Width of a pixel at distance t along a ray, w0 + w1*t.
+        Set by render(), level of detail is off without it.
+      pe_alpha: float or None. Positional encoding frequency bands let through, set
+        during the progressive training stages.
+      fused_composite: bool. Composite the samples with FusedComposite, which keeps
+        less for backward.
     Returns:
       rgb_map: [num_rays, 3]. Estimated RGB color of a ray. Comes from fine model.
       disp_map: [num_rays]. Disparity map. 1 / depth.
       acc_map: [num_rays]. Accumulated opacity along each ray. Comes from fine model.
+      depth_map: [num_rays]. Expected distance along each ray. Comes from fine model.
       raw: [num_rays, num_samples, 4]. Raw predictions from model.
+      z_vals: [num_rays, num_samples]. Distances along each ray of the samples in raw.
       rgb0: See rgb_map. Output for coarse model.
       disp0: See disp_map. Output for coarse model.
       acc0: See acc_map. Output for coarse model.
@@ -354,6 +619,16 @@ def render_rays(ray_batch,
     bounds = torch.reshape(ray_batch[...,6:8], [-1,1,2])
     near, far = bounds[...,0], bounds[...,1] # [-1,1]
 
+    lod = pixel_cone is not None and lod_quality < 1.
+    var = None
+    if lod:
+        norm_d = torch.norm(rays_d, dim=-1)
+        N_lod = lod_count(footprint_samples(near[...,0], far[...,0], norm_d, pixel_cone, lod_quality),
+                          N_samples, min(N_samples, LOD_MIN_SAMPLES))
+        if lod_blur:
+            var = lod_var(far[...,0] - near[...,0], norm_d, N_lod, N_samples)
+        N_samples = N_lod
+
     t_vals = torch.linspace(0., 1., steps=N_samples)
     if not lindisp:
         z_vals = near * (1.-t_vals) + far * (t_vals)
@@ -382,29 +657,54 @@ def render_rays(ray_batch,
 
 
 #     raw = run_network(pts)
-    raw = network_query_fn(pts, viewdirs, network_fn)
-    rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
+    with metrics.timer('coarse'):
+        raw = network_query_fn(pts, viewdirs, network_fn, var=var.expand(z_vals.shape) if var is not None else None,
+                               pe_alpha=pe_alpha)
+        with metrics.timer('raw2outputs'):
+            rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest,
+                                                                         fused=fused_composite)
+    metrics.count('rays', N_rays)
+    metrics.count('samples', N_rays * N_samples)
+
+    N_fine = N_importance
+    if N_importance > 0 and lod:
+        # Importance samples only span the coarse weights, at the footprint rate there
+        cdf = torch.cumsum(weights, -1) / torch.clamp(acc_map[...,None], min=1e-10)
+        lo = torch.clamp(torch.sum(cdf < .01, -1) - 1, min=0)
+        hi = torch.clamp(torch.sum(cdf < .99, -1) + 1, max=N_samples-1)
+        z_lo, z_hi = torch.gather(z_vals, -1, lo[...,None])[...,0], torch.gather(z_vals, -1, hi[...,None])[...,0]
+        n = footprint_samples(z_lo, z_hi, norm_d, pixel_cone, lod_quality)
+        N_fine = lod_count(torch.where(acc_map < LOD_EMPTY_ACC, torch.zeros_like(n), n), N_importance)
+        var = lod_var(z_hi - z_lo, norm_d, N_fine, N_importance) if lod_blur and N_fine > 0 else None
 
     if N_importance > 0:
-
         rgb_map_0, disp_map_0, acc_map_0 = rgb_map, disp_map, acc_map
+        z_samples = torch.zeros([N_rays, 1])
+
+    if N_fine > 0:
 
-        z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
-        z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_importance, det=(perturb==0.), pytest=pytest)
-        z_samples = z_samples.detach()
+        with metrics.timer('sample_pdf'):
+            z_vals_mid = .5 * (z_vals[...,1:] + z_vals[...,:-1])
+            z_samples = sample_pdf(z_vals_mid, weights[...,1:-1], N_fine, det=(perturb==0.), pytest=pytest)
+            z_samples = z_samples.detach()
 
         z_vals, _ = torch.sort(torch.cat([z_vals, z_samples], -1), -1)
         pts = rays_o[...,None,:] + rays_d[...,None,:] * z_vals[...,:,None] # [N_rays, N_samples + N_importance, 3]
 
         run_fn = network_fn if network_fine is None else network_fine
 #         raw = run_network(pts, fn=run_fn)
-        raw = network_query_fn(pts, viewdirs, run_fn)
-
-        rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest)
-
-    ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map}
+        with metrics.timer('fine'):
+            raw = network_query_fn(pts, viewdirs, run_fn, var=var.expand(z_vals.shape) if var is not None else None,
+                                   pe_alpha=pe_alpha)
+            with metrics.timer('raw2outputs'):
+                rgb_map, disp_map, acc_map, weights, depth_map = raw2outputs(raw, z_vals, rays_d, raw_noise_std, white_bkgd, pytest=pytest,
+                                                                             fused=fused_composite)
+        metrics.count('samples', N_rays * (N_samples + N_fine))
+
+    ret = {'rgb_map' : rgb_map, 'disp_map' : disp_map, 'acc_map' : acc_map, 'depth_map' : depth_map}
     if retraw:
         ret['raw'] = raw
+        ret['z_vals'] = z_vals
     if N_importance > 0:
         ret['rgb0'] = rgb_map_0
         ret['disp0'] = disp_map_0
@@ -442,6 +742,12 @@ def config_parser():
                         help='channels per layer in fine network')
     parser.add_argument("--N_rand", type=int, default=32*32*4, 
                         help='batch size (number of random rays per gradient step)')
+    parser.add_argument("--N_rand_micro", type=int, default=0, 
+                        help='rays rendered per forward and backward pass, whose gradients add up to the N_rand batch, 0 for N_rand')
+    parser.add_argument("--grad_checkpoint", action='store_true', 
+                        help='recompute the network activations in backward instead of keeping them, for less memory')
+    parser.add_argument("--fused_composite", action='store_true', 
+                        help='volume compositing with a backward that recomputes its per-sample intermediates, for less memory')
     parser.add_argument("--lrate", type=float, default=5e-4, 
                         help='learning rate')
     parser.add_argument("--lrate_decay", type=int, default=250, 
@@ -450,12 +756,31 @@ def config_parser():
                         help='number of rays processed in parallel, decrease if running out of memory')
     parser.add_argument("--netchunk", type=int, default=1024*64, 
                         help='number of pts sent through network in parallel, decrease if running out of memory')
+    parser.add_argument("--autotune", action='store_true', 
+                        help='pick the fastest chunk and netchunk for this host and model at startup (cached in basedir/autotune.json)')
+    parser.add_argument("--autotune_mem_mb", type=float, default=0, 
+                        help='memory budget of the chunk/netchunk probes in MB, 0 for half of the free memory')
+    parser.add_argument("--autotune_retune", action='store_true', 
+                        help='ignore the cached autotune result and probe again')
     parser.add_argument("--no_batching", action='store_true', 
                         help='only take random rays from 1 image at a time')
+    parser.add_argument("--prefetch_batches", type=int, default=2, 
+                        help='training batches built ahead in a background thread, 0 to build each one in the training loop')
     parser.add_argument("--no_reload", action='store_true', 
                         help='do not reload weights from saved ckpt')
     parser.add_argument("--ft_path", type=str, default=None, 
                         help='specific weights npy file to reload for coarse network')
+    parser.add_argument("--N_iters", type=int, default=200000, 
+                        help='number of training iterations')
+
+    # distributed training options
+    parser.add_argument("--distributed", action='store_true', 
+                        help='data-parallel training over a gloo process group set up by torchrun (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT)')
+    parser.add_argument("--ddp_procs", type=int, default=0, 
+                        help='spawn this many local data-parallel processes on this machine')
+    parser.add_argument("--ddp_scale_batch", action='store_true', 
+                        help='every rank takes N_rand rays (effective batch N_rand*world_size) and N_iters, lrate_decay shrink accordingly. '
+                             'By default N_rand is the global batch split across ranks')
 
     # rendering options
     parser.add_argument("--N_samples", type=int, default=64, 
@@ -466,14 +791,42 @@ def config_parser():
                         help='set to 0. for no jitter, 1. for jitter')
     parser.add_argument("--use_viewdirs", action='store_true', 
                         help='use full 5D input instead of 3D')
+    parser.add_argument("--model_type", type=str, default='nerf', choices=['nerf', 'tensorf'], 
+                        help='nerf: MLP, tensorf: tensor-factorized feature grids with a small MLP')
+    parser.add_argument("--tensorf_mode", type=str, default='vm', choices=['vm', 'cp'], 
+                        help='tensorf factorization, vector-matrix or CP')
+    parser.add_argument("--tensorf_density_comp", type=int, default=16, 
+                        help='tensorf density components per plane/line (use 96 for cp)')
+    parser.add_argument("--tensorf_app_comp", type=int, default=48, 
+                        help='tensorf appearance components per plane/line (use 288 for cp)')
+    parser.add_argument("--tensorf_res_init", type=int, default=128, 
+                        help='initial tensorf grid resolution, as the cube root of the voxel count')
+    parser.add_argument("--tensorf_res_final", type=int, default=300, 
+                        help='final tensorf grid resolution, reached at the last upsampling step')
+    parser.add_argument("--tensorf_upsample_iters", type=int, nargs='*', default=[2000, 3000, 4000, 5500, 7000], 
+                        help='iterations at which the tensorf grid is upsampled (log-linear voxel counts)')
+    parser.add_argument("--tensorf_prune_iters", type=int, nargs='*', default=[2000, 4000], 
+                        help='iterations at which empty space is masked out and the box shrunk to the occupied region')
     parser.add_argument("--i_embed", type=int, default=0, 
-                        help='set 0 for default positional encoding, -1 for none')
+                        help='set 0 for default positional encoding, -1 for none, 1 for multiresolution hash encoding with a small MLP')
+    parser.add_argument("--hash_levels", type=int, default=16, 
+                        help='number of hash encoding levels')
+    parser.add_argument("--hash_log2_size", type=int, default=19, 
+                        help='log2 of the hash table size per level')
+    parser.add_argument("--hash_base_res", type=int, default=16, 
+                        help='grid resolution of the coarsest hash level')
+    parser.add_argument("--hash_finest_res", type=int, default=512, 
+                        help='grid resolution of the finest hash level')
     parser.add_argument("--multires", type=int, default=10, 
                         help='log2 of max freq for positional encoding (3D location)')
     parser.add_argument("--multires_views", type=int, default=4, 
                         help='log2 of max freq for positional encoding (2D direction)')
     parser.add_argument("--raw_noise_std", type=float, default=0., 
                         help='std dev of noise added to regularize sigma_a output, 1e0 recommended')
+    parser.add_argument("--scene_bbox", type=float, nargs=6, default=None, 
+                        help='xmin ymin zmin xmax ymax zmax: rays are sampled only inside, those missing it are background (not NDC)')
+    parser.add_argument("--scene_bbox_auto", action='store_true', 
+                        help='without scene_bbox, use the box seen by every training camera between near and far')
 
     parser.add_argument("--render_only", action='store_true', 
                         help='do not optimize, reload weights and render out render_poses path')
@@ -481,6 +834,26 @@ def config_parser():
                         help='render the test set instead of render_poses path')
     parser.add_argument("--render_factor", type=int, default=0, 
                         help='downsampling factor to speed up rendering, set 4 or 8 for fast preview')
+    parser.add_argument("--render_workers", type=int, default=0, 
+                        help='number of CPU worker processes for render_only, 0 renders in this process')
+    parser.add_argument("--render_tile_rows", type=int, default=0, 
+                        help='image rows per task handed to a render worker, 0 for whole frames')
+    parser.add_argument("--render_quantized", type=str, default=None, 
+                        help='int8 networks saved by quantize.py to render_only with, on the CPU')
+    parser.add_argument("--render_temporal", action='store_true', 
+                        help='render_only reusing the depth of the previous frame of the path')
+    parser.add_argument("--temporal_refresh", type=int, default=10, 
+                        help='frames between full renders with render_temporal')
+    parser.add_argument("--temporal_samples", type=int, default=16, 
+                        help='fine network samples around a reprojected surface')
+    parser.add_argument("--temporal_margin", type=float, default=.02, 
+                        help='half width of the interval around a reprojected surface, as a fraction of far-near')
+    parser.add_argument("--temporal_check", action='store_true', 
+                        help='also render every frame in full and report the PSNR of the reused frames')
+    parser.add_argument("--lod_quality", type=float, default=1., 
+                        help='level of detail of rendered images in (0, 1]: lower takes fewer samples per pixel footprint, 1 disables it')
+    parser.add_argument("--lod_blur", action='store_true', 
+                        help='with lod_quality, blur the positional encoding by the sample spacing dropped (for models trained at several scales)')
 
     # training options
     parser.add_argument("--precrop_iters", type=int, default=0,
@@ -488,9 +861,30 @@ def config_parser():
     parser.add_argument("--precrop_frac", type=float,
                         default=.5, help='fraction of img taken for central crops') 
 
+    parser.add_argument("--prog_iters", type=int, nargs='*', default=[], 
+                        help='steps at which the progressive training stages end, none to train at full resolution throughout')
+    parser.add_argument("--prog_scales", type=int, nargs='*', default=[], 
+                        help='image downsampling factor of every progressive stage')
+    parser.add_argument("--prog_samples", type=int, nargs='*', default=[], 
+                        help='N_samples of every progressive stage')
+    parser.add_argument("--prog_importance", type=int, nargs='*', default=[], 
+                        help='N_importance of every progressive stage')
+    parser.add_argument("--prog_multires", type=float, nargs='*', default=[], 
+                        help='positional encoding bands at the start of every progressive stage, growing to multires at the last')
+    parser.add_argument("--error_sampling", action='store_true', 
+                        help='draw training rays from all images in proportion to a running loss per tile, with importance weights')
+    parser.add_argument("--error_tile", type=int, default=8, 
+                        help='side in pixels of the tiles error_sampling keeps a loss for')
+    parser.add_argument("--error_mix", type=float, default=.5, 
+                        help='fraction of the error_sampling probability spread uniformly over the pixels')
+    parser.add_argument("--error_ema", type=float, default=.1, 
+                        help='weight of the newest rays in the running loss of a tile')
+    parser.add_argument("--error_rebuild", type=int, default=100, 
+                        help='steps between rebuilds of the error_sampling tile distribution')
+
     # dataset options
     parser.add_argument("--dataset_type", type=str, default='llff', 
-                        help='options: llff / blender / deepvoxels')
+                        help='options: llff / blender / LINEMOD / deepvoxels / packed')
     parser.add_argument("--testskip", type=int, default=8, 
                         help='will load 1/N images from test/val sets, useful for large datasets like deepvoxels')
 
@@ -511,6 +905,10 @@ def config_parser():
                         help='do not use normalized device coordinates (set for non-forward facing scenes)')
     parser.add_argument("--lindisp", action='store_true', 
                         help='sampling linearly in disparity rather than depth')
+    parser.add_argument("--packed_factor", type=int, default=1, 
+                        help='image downsampling factor to load from a packed scene, one of those it was packed with')
+    parser.add_argument("--packed_no_mmap", action='store_true', 
+                        help='read a packed scene into memory sequentially instead of mapping it')
     parser.add_argument("--spherify", action='store_true', 
                         help='set for spherical 360 scenes')
     parser.add_argument("--llffhold", type=int, default=8, 
@@ -523,6 +921,20 @@ def config_parser():
                         help='frequency of tensorboard image logging')
     parser.add_argument("--i_weights", type=int, default=10000, 
                         help='frequency of weight ckpt saving')
+    parser.add_argument("--ckpt_keep", type=int, default=0, 
+                        help='number of most recent ckpts to keep, 0 keeps all')
+    parser.add_argument("--ckpt_sync", action='store_true', 
+                        help='write ckpts in the training thread instead of in the background')
+    parser.add_argument("--metrics", action='store_true', 
+                        help='time every stage and write averages to metrics.jsonl at every i_print')
+    parser.add_argument("--tensorboard", action='store_true', 
+                        help='also write the metrics to tensorboard (implies --metrics)')
+    parser.add_argument("--metrics_sync", action='store_true', 
+                        help='synchronize CUDA around timed stages for exact GPU timings (slower)')
+    parser.add_argument("--profile_steps", type=int, nargs=2, default=None, 
+                        help='record a torch.profiler trace for iterations [start, end)')
+    parser.add_argument("--detect_anomaly", action='store_true', 
+                        help='debug: locate the op producing NaN/inf gradients (torch.autograd anomaly detection, slow)')
     parser.add_argument("--i_testset", type=int, default=50000, 
                         help='frequency of testset saving')
     parser.add_argument("--i_video",   type=int, default=50000, 
@@ -531,29 +943,32 @@ def config_parser():
     return parser
 
 
-def train():
-
-    parser = config_parser()
-    args = parser.parse_args()
-
-    # Load data
+def load_data(args, load_imgs=True, keep_alpha=False):
+    """Loads the dataset selected by args.dataset_type.
+    Returns:
+      images: [N, H, W, 3] or None if load_imgs is False. [N, H, W, 4] for RGBA
+        scenes if keep_alpha, else composited onto the background.
+      poses: [N, 3, 4]. render_poses: [N_render, 3(or 4), 4]. hwf: [H, W, focal]. K: [3, 3].
+      i_split: [i_train, i_val, i_test]. near, far: scene bounds.
+    """
     K = None
     if args.dataset_type == 'llff':
+        from load_llff import load_llff_data
         images, poses, bds, render_poses, i_test = load_llff_data(args.datadir, args.factor,
                                                                   recenter=True, bd_factor=.75,
-                                                                  spherify=args.spherify)
+                                                                  spherify=args.spherify, load_imgs=load_imgs)
         hwf = poses[0,:3,-1]
         poses = poses[:,:3,:4]
-        print('Loaded llff', images.shape, render_poses.shape, hwf, args.datadir)
+        print('Loaded llff', images.shape if load_imgs else None, render_poses.shape, hwf, args.datadir)
         if not isinstance(i_test, list):
             i_test = [i_test]
 
         if args.llffhold > 0:
             print('Auto LLFF holdout,', args.llffhold)
-            i_test = np.arange(images.shape[0])[::args.llffhold]
+            i_test = np.arange(poses.shape[0])[::args.llffhold]
 
         i_val = i_test
-        i_train = np.array([i for i in np.arange(int(images.shape[0])) if
+        i_train = np.array([i for i in np.arange(int(poses.shape[0])) if
                         (i not in i_test and i not in i_val)])
 
         print('DEFINING BOUNDS')
@@ -567,45 +982,55 @@ def train():
         print('NEAR FAR', near, far)
 
     elif args.dataset_type == 'blender':
-        images, poses, render_poses, hwf, i_split = load_blender_data(args.datadir, args.half_res, args.testskip)
-        print('Loaded blender', images.shape, render_poses.shape, hwf, args.datadir)
+        from load_blender import load_blender_data
+        images, poses, render_poses, hwf, i_split = load_blender_data(args.datadir, args.half_res, args.testskip, load_imgs=load_imgs)
+        print('Loaded blender', images.shape if load_imgs else None, render_poses.shape, hwf, args.datadir)
         i_train, i_val, i_test = i_split
 
         near = 2.
         far = 6.
 
-        if args.white_bkgd:
-            images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
-        else:
-            images = images[...,:3]
-
     elif args.dataset_type == 'LINEMOD':
-        images, poses, render_poses, hwf, K, i_split, near, far = load_LINEMOD_data(args.datadir, args.half_res, args.testskip)
-        print(f'Loaded LINEMOD, images shape: {images.shape}, hwf: {hwf}, K: {K}')
+        from load_LINEMOD import load_LINEMOD_data
+        images, poses, render_poses, hwf, K, i_split, near, far = load_LINEMOD_data(args.datadir, args.half_res, args.testskip, load_imgs=load_imgs)
+        print(f'Loaded LINEMOD, images shape: {images.shape if load_imgs else None}, hwf: {hwf}, K: {K}')
         print(f'[CHECK HERE] near: {near}, far: {far}.')
         i_train, i_val, i_test = i_split
 
-        if args.white_bkgd:
-            images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
-        else:
-            images = images[...,:3]
-
     elif args.dataset_type == 'deepvoxels':
+        from load_deepvoxels import load_dv_data
 
         images, poses, render_poses, hwf, i_split = load_dv_data(scene=args.shape,
                                                                  basedir=args.datadir,
-                                                                 testskip=args.testskip)
+                                                                 testskip=args.testskip,
+                                                                 load_imgs=load_imgs)
 
-        print('Loaded deepvoxels', images.shape, render_poses.shape, hwf, args.datadir)
+        print('Loaded deepvoxels', images.shape if load_imgs else None, render_poses.shape, hwf, args.datadir)
         i_train, i_val, i_test = i_split
 
         hemi_R = np.mean(np.linalg.norm(poses[:,:3,-1], axis=-1))
         near = hemi_R-1.
         far = hemi_R+1.
 
+    elif args.dataset_type == 'packed':
+        meta = packed_meta(args.datadir)
+        if meta['dataset_type'] == 'llff' and meta['source']['no_ndc'] != args.no_ndc:
+            # near and far were set for the other coordinates
+            raise ValueError('{} was packed with no_ndc={}, pack it again to change it'.format(args.datadir, meta['source']['no_ndc']))
+        images, poses, render_poses, hwf, K, i_split, near, far = load_packed_data(args.datadir, args.packed_factor,
+                                                                                   load_imgs=load_imgs, mmap=not args.packed_no_mmap)
+        print('Loaded packed {}'.format(meta['dataset_type']), images.shape if load_imgs else None, render_poses.shape, hwf, args.datadir)
+        i_train, i_val, i_test = i_split
+
     else:
         print('Unknown dataset type', args.dataset_type, 'exiting')
-        return
+        return None
+
+    if load_imgs and images.shape[-1] == 4 and not keep_alpha:
+        if args.white_bkgd:
+            images = images[...,:3]*images[...,-1:] + (1.-images[...,-1:])
+        else:
+            images = images[...,:3]
 
     # Cast intrinsics to right types
     H, W, focal = hwf
@@ -619,27 +1044,277 @@ def train():
             [0, 0, 1]
         ])
 
+    return images, poses, render_poses, hwf, K, [i_train, i_val, i_test], near, far
+
+
+def write_config(args, overrides, path):
+    """Writes args.config with the keys of overrides replaced, so that a derived
+    model renders with `run_nerf.py --config path --render_only`.
+    """
+    lines = []
+    if args.config is not None:
+        for line in open(args.config).read().splitlines():
+            key = line.split('=')[0].strip()
+            if key not in overrides:
+                lines.append(line)
+    lines.append('')
+    for k, v in overrides.items():
+        # Lists in configargparse syntax
+        lines.append('{} = {}'.format(k, '[{}]'.format(', '.join(str(x) for x in v)) if isinstance(v, list) else v))
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+# Arguments that change what load_data returns, apart from the images
+SCENE_META_ARGS = ['dataset_type', 'datadir', 'factor', 'spherify', 'no_ndc', 'llffhold',
+                   'half_res', 'testskip', 'shape', 'packed_factor']
+
+
+def scene_type(args):
+    """Dataset type of the scene, the one it was packed from for a packed scene.
+    """
+    if args.dataset_type == 'packed':
+        return packed_meta(args.datadir)['dataset_type']
+    return args.dataset_type
+
+
+def save_scene_meta(path, args, scene):
+    """Caches the cameras, bounds and splits of a loaded scene next to the checkpoints.
+    """
+    _, poses, render_poses, hwf, K, i_split, near, far = scene
+    key = json.dumps({k : getattr(args, k) for k in SCENE_META_ARGS}, sort_keys=True)
+    np.savez(path, key=key, poses=np.asarray(poses), render_poses=np.asarray(render_poses),
+             hwf=np.array(hwf, dtype=np.float64), K=np.asarray(K), near=near, far=far,
+             i_train=i_split[0], i_val=i_split[1], i_test=i_split[2],
+             scene_bbox=np.array(args.scene_bbox if args.scene_bbox is not None else [], dtype=np.float64))
+
+
+def load_scene_meta(path, args):
+    """Returns the same tuple as load_data (without images) from a cache written by
+    save_scene_meta, or None if there is no cache for these arguments.
+    """
+    if not os.path.exists(path):
+        return None
+    meta = np.load(path)
+    key = json.dumps({k : getattr(args, k) for k in SCENE_META_ARGS}, sort_keys=True)
+    if str(meta['key']) != key:
+        print('Scene metadata cache', path, 'was made with different data arguments, ignoring it')
+        return None
+    print('Loaded scene metadata from', path)
+    H, W, focal = meta['hwf']
+    hwf = [int(H), int(W), float(focal)]
+    i_split = [meta['i_train'], meta['i_val'], meta['i_test']]
+    return None, meta['poses'], meta['render_poses'], hwf, meta['K'], i_split, float(meta['near']), float(meta['far'])
+
+
+def load_scene_bbox(path):
+    """scene_bbox of the training run that wrote a scene metadata cache, or None.
+    """
+    if not os.path.exists(path):
+        return None
+    meta = np.load(path)
+    if 'scene_bbox' not in meta or meta['scene_bbox'].size == 0:
+        return None
+    return meta['scene_bbox'].tolist()
+
+
+def scene_bounding_box(args, poses, H, W, K, near, far):
+    """Box for grid-based models: the region every training ray passes through.
+    """
+    if scene_type(args) == 'llff' and not args.no_ndc:
+        return [[-1., -1., -1.], [1., 1., 1.]]
+    return frustum_bbox(poses, H, W, K, near, far).tolist()
+
+
+def object_bounding_box(poses, H, W, K, near, far, res=64):
+    """Box around the region every camera sees between near and far, [2, 3]: the
+    object of a capture around it. Found on a res^3 lattice over the cameras'
+    frustums, padded by one lattice step.
+    """
+    H, W = int(H), int(W)
+    box = frustum_bbox(poses, H, W, K, near, far)
+    axes = [np.linspace(box[0][i], box[1][i], res) for i in range(3)]
+    pts = np.stack(np.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3)
+    seen = np.ones(pts.shape[0], dtype=bool)
+    for c2w in np.asarray(poses):
+        # Camera depth, which is the distance along rays of get_rays()
+        p = (pts - c2w[:3,3]) @ c2w[:3,:3]
+        z = np.maximum(-p[:,2], 1e-8)
+        i = K[0][0] * p[:,0] / z + K[0][2]
+        j = K[1][2] - K[1][1] * p[:,1] / z
+        seen &= (-p[:,2] >= near) & (-p[:,2] <= far) & (i >= 0) & (i <= W) & (j >= 0) & (j <= H)
+    if not seen.any():
+        print('No region is seen by every camera, using the box around the frustums')
+        return box
+    step = (box[1] - box[0]) / (res - 1)
+    return np.stack([pts[seen].min(0) - step, pts[seen].max(0) + step], 0)
+
+
+def check_progressive(args):
+    n = len(args.prog_iters)
+    for name in ['prog_scales', 'prog_samples', 'prog_importance', 'prog_multires']:
+        if getattr(args, name) and len(getattr(args, name)) != n:
+            raise ValueError('--{} needs one value per stage of --prog_iters ({})'.format(name, n))
+    if args.prog_importance and min(args.prog_importance) == 0 and args.N_importance > 0:
+        raise ValueError('--prog_importance cannot drop the fine network of a model that has one')
+    if args.prog_importance and args.N_importance == 0:
+        raise ValueError('--prog_importance needs N_importance > 0')
+    if list(args.prog_iters) != sorted(args.prog_iters):
+        raise ValueError('--prog_iters must increase')
+
+
+def progressive_stage(args, i):
+    """Progressive training stage of step i, len(args.prog_iters) once at full resolution.
+    """
+    return int(np.searchsorted(args.prog_iters, i, side='right'))
+
+
+def progressive_settings(args, stage):
+    """(downsampling factor, N_samples, N_importance) of a progressive stage.
+    """
+    if stage >= len(args.prog_iters):
+        return 1, args.N_samples, args.N_importance
+    return (args.prog_scales[stage] if args.prog_scales else 1,
+            args.prog_samples[stage] if args.prog_samples else args.N_samples,
+            args.prog_importance[stage] if args.prog_importance else args.N_importance)
+
+
+def progressive_pe_alpha(args, i):
+    """Positional encoding bands let through at step i: prog_multires[k] at the start
+    of stage k, growing linearly to all of them at the last stage.
+    """
+    if not args.prog_multires or i >= args.prog_iters[-1]:
+        return None
+    return float(np.interp(i, [0] + list(args.prog_iters), list(args.prog_multires) + [args.multires]))
+
+
+def progressive_data(args, stage, images, poses, hwf, K, i_train, use_batching, rank=0, world_size=1):
+    """Training data of a progressive stage: (H, W, K, images, rays_rgb, sampler), the
+    images downsampled by area averaging. rays_rgb holds the shuffled rays of every
+    training pixel when batching, sampler is the error sampler if enabled.
+    """
+    factor, _, _ = progressive_settings(args, stage)
+    H, W, _, K = scale_intrinsics(hwf, K, factor if factor > 1 else 0)
+    H, W = int(H), int(W)
+    images = images.cpu().numpy() if torch.is_tensor(images) else np.asarray(images)
+    poses = poses.cpu().numpy() if torch.is_tensor(poses) else np.asarray(poses)
+    if factor > 1:
+        images = F.interpolate(torch.Tensor(images).permute(0, 3, 1, 2), size=(H, W), mode='area')
+        images = images.permute(0, 2, 3, 1).cpu().numpy()
+    if args.prog_iters:
+        print('Progressive stage {}: {}x{} images, {} + {} samples'.format(stage, W, H, *progressive_settings(args, stage)[1:]))
+
+    rays_rgb, sampler = None, None
+    if use_batching:
+        # Kept on the CPU, where the prefetcher gathers the batches
+        rays_rgb = batching_rays(images, poses, H, W, K, i_train, stage, rank, world_size)
+    if args.error_sampling:
+        sampler = ErrorSampler(torch.Tensor(images[i_train]).to(device), torch.Tensor(poses[i_train,:3,:4]).to(device), K,
+                               tile=args.error_tile, mix=args.error_mix, ema=args.error_ema, rebuild=args.error_rebuild)
+    return H, W, K, images, rays_rgb, sampler
+
+
+def batching_rays(images, poses, H, W, K, i_train, seed=0, rank=0, world_size=1):
+    """Rays of every pixel of the training images in a random order, for random ray
+    batching, [N*H*W, ro+rd+rgb, 3] (this rank's share).
+    """
+    print('get rays')
+    rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
+    print('done, concats')
+    rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
+    rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
+    rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
+    rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
+    rays_rgb = rays_rgb.astype(np.float32)
+    print('shuffle rays')
+    # Seeded, so a resumed run and every rank see the same order
+    np.random.default_rng(seed).shuffle(rays_rgb)
+    if world_size > 1:
+        # Same shuffle on every rank, so strided shards are disjoint
+        rays_rgb = rays_rgb[rank::world_size]
+    print('done')
+    return rays_rgb
+
+
+def batch_prefetcher(args, stage, first, N_iters, images, poses, H, W, K, i_train, rays_rgb, N_rand, rank=0, resume=None):
+    """Prefetcher of the training batches of a progressive stage from step first, or
+    None if the stage has no steps left. After the precrop, the error sampler
+    draws its own rays and is not prefetched. resume is the state of the ray
+    batches saved with a checkpoint of this stage.
+    """
+    last = N_iters if stage >= len(args.prog_iters) else min(args.prog_iters[stage], N_iters)
+    if args.error_sampling:
+        last = min(last, args.precrop_iters)
+    if first >= last:
+        return None
+    if rays_rgb is not None:
+        make_batch = RayBatches(rays_rgb, N_rand, rank, **(resume or {}))
+    else:
+        make_batch = ImageBatches(images, poses, i_train, H, W, K, N_rand,
+                                  precrop_iters=args.precrop_iters, precrop_frac=args.precrop_frac, rank=rank)
+    return Prefetcher(make_batch, first, last, depth=args.prefetch_batches, device=device)
+
+
+def train(args=None):
+
+    if args is None:
+        parser = config_parser()
+        args = parser.parse_args()
+
+    rank, world_size = init_distributed(args)
+    torch.autograd.set_detect_anomaly(args.detect_anomaly)
+
+    # Load data, or only the cameras when rendering from a trained model (render_test
+    # compares with the test images)
+    meta_path = os.path.join(args.basedir, args.expname, 'scene_meta.npz')
+    scene = None
+    if args.render_only and not args.render_test:
+        scene = load_scene_meta(meta_path, args)
+    if scene is None:
+        scene = load_data(args, load_imgs=not args.render_only or args.render_test)
+        if scene is None:
+            return
+    images, poses, render_poses, hwf, K, i_split, near, far = scene
+    i_train, i_val, i_test = i_split
+    H, W, focal = hwf
+
     if args.render_test:
         render_poses = np.array(poses[i_test])
 
+    if args.i_embed == 1 or args.model_type == 'tensorf':
+        args.bounding_box = scene_bounding_box(args, poses[i_train], H, W, K, near, far)
+        print('Grid bounding box', args.bounding_box)
+    if args.scene_bbox is None and args.scene_bbox_auto:
+        args.scene_bbox = object_bounding_box(poses[i_train], H, W, K, near, far).reshape(-1).tolist()
+        print('Scene bounding box', args.scene_bbox)
+
     # Create log dir and copy the config file
     basedir = args.basedir
     expname = args.expname
     os.makedirs(os.path.join(basedir, expname), exist_ok=True)
-    f = os.path.join(basedir, expname, 'args.txt')
-    with open(f, 'w') as file:
-        for arg in sorted(vars(args)):
-            attr = getattr(args, arg)
-            file.write('{} = {}\n'.format(arg, attr))
-    if args.config is not None:
-        f = os.path.join(basedir, expname, 'config.txt')
+    if is_main_process():
+        f = os.path.join(basedir, expname, 'args.txt')
         with open(f, 'w') as file:
-            file.write(open(args.config, 'r').read())
+            for arg in sorted(vars(args)):
+                attr = getattr(args, arg)
+                file.write('{} = {}\n'.format(arg, attr))
+        if args.config is not None:
+            f = os.path.join(basedir, expname, 'config.txt')
+            # Read before truncating: args.config may be this very file
+            config = open(args.config, 'r').read()
+            with open(f, 'w') as file:
+                file.write(config)
+
+        save_scene_meta(meta_path, args, scene)
 
     # Create nerf model
-    render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer = create_nerf(args)
+    render_kwargs_train, render_kwargs_test, start, grad_vars, optimizer, train_state = create_nerf(args)
     global_step = start
 
+    # Every rank starts from the same weights
+    broadcast_params(grad_vars)
+
     bds_dict = {
         'near' : near,
         'far' : far,
@@ -647,16 +1322,32 @@ def train():
     render_kwargs_train.update(bds_dict)
     render_kwargs_test.update(bds_dict)
 
+    if args.autotune:
+        # Probed once on rank 0, every rank then uses the same sizes. Training
+        # sizes are probed with backward on the rays of one micro-batch,
+        # rendering ones without gradients
+        if args.render_only:
+            tuned = apply_autotune(args, render_kwargs_test, batchify_rays) if is_main_process() else None
+        else:
+            train_rays = args.N_rand if world_size == 1 or args.ddp_scale_batch else args.N_rand // world_size
+            if args.N_rand_micro > 0:
+                train_rays = min(train_rays, args.N_rand_micro)
+            tuned = apply_autotune(args, render_kwargs_train, batchify_rays, train_rays=train_rays) if is_main_process() else None
+        tuned = broadcast_object(tuned)
+        args.chunk, args.netchunk = tuned['chunk'], tuned['netchunk']
+
     # Move testing data to GPU
     render_poses = torch.Tensor(render_poses).to(device)
 
     # Short circuit if only rendering out from trained model
     if args.render_only:
+        if not is_main_process():
+            return
         print('RENDER ONLY')
         with torch.no_grad():
             if args.render_test:
                 # render_test switches to test poses
-                images = images[i_test]
+                images = images[i_test] if images is not None else None
             else:
                 # Default is smoother render_poses path
                 images = None
@@ -664,139 +1355,209 @@ def train():
             testsavedir = os.path.join(basedir, expname, 'renderonly_{}_{:06d}'.format('test' if args.render_test else 'path', start))
             os.makedirs(testsavedir, exist_ok=True)
             print('test poses shape', render_poses.shape)
-
-            rgbs, _ = render_path(render_poses, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor)
+            if args.metrics:
+                metrics.open(testsavedir, jsonl=True, sync_cuda=args.metrics_sync)
+
+            if args.render_workers > 0 and (args.render_temporal or not can_fork()):
+                print('WARNING: --render_workers needs forked CPU workers{}, rendering in this process'.format(
+                      ' and does not apply to --render_temporal' if args.render_temporal else ', not available with CUDA'))
+            if args.render_temporal:
+                rgbs, _ = render_path_temporal(render, render_poses, hwf, K, args.chunk, render_kwargs_test, savedir=testsavedir,
+                                               render_factor=args.render_factor, refresh=args.temporal_refresh,
+                                               samples=args.temporal_samples, margin=args.temporal_margin, check=args.temporal_check)
+            elif args.render_workers > 0 and can_fork():
+                rgbs, _ = render_path_parallel(render, render_poses, hwf, K, args.chunk, render_kwargs_test, args.render_workers,
+                                               gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor, tile_rows=args.render_tile_rows)
+            else:
+                rgbs, _ = render_path(render_poses, hwf, K, args.chunk, render_kwargs_test, gt_imgs=images, savedir=testsavedir, render_factor=args.render_factor)
             print('Done rendering', testsavedir)
+            metrics.flush(start, steps=render_poses.shape[0])
+            metrics.close()
             imageio.mimwrite(os.path.join(testsavedir, 'video.mp4'), to8b(rgbs), fps=30, quality=8)
 
             return
 
     # Prepare raybatch tensor if batching random rays
     N_rand = args.N_rand
-    use_batching = not args.no_batching
-    if use_batching:
-        # For random ray batching
-        print('get rays')
-        rays = np.stack([get_rays_np(H, W, K, p) for p in poses[:,:3,:4]], 0) # [N, ro+rd, H, W, 3]
-        print('done, concats')
-        rays_rgb = np.concatenate([rays, images[:,None]], 1) # [N, ro+rd+rgb, H, W, 3]
-        rays_rgb = np.transpose(rays_rgb, [0,2,3,1,4]) # [N, H, W, ro+rd+rgb, 3]
-        rays_rgb = np.stack([rays_rgb[i] for i in i_train], 0) # train images only
-        rays_rgb = np.reshape(rays_rgb, [-1,3,3]) # [(N-1)*H*W, ro+rd+rgb, 3]
-        rays_rgb = rays_rgb.astype(np.float32)
-        print('shuffle rays')
-        np.random.shuffle(rays_rgb)
-
-        print('done')
-        i_batch = 0
+    N_iters = args.N_iters + 1
+    decay_steps = args.lrate_decay * 1000
+    if world_size > 1:
+        if args.ddp_scale_batch:
+            # Effective batch grows with the number of ranks, so the same number
+            # of epochs takes world_size times fewer steps
+            N_iters = args.N_iters // world_size + 1
+            decay_steps = decay_steps / world_size
+        else:
+            N_rand = args.N_rand // world_size
+        print('Rank {}/{}: {} rays per step, {} effective'.format(rank, world_size, N_rand, N_rand * world_size))
+    # The error sampler draws rays from the images itself
+    use_batching = not args.no_batching and not args.error_sampling
+    # Training resolution and rays of the current progressive stage (the whole
+    # run without stages): H_s, W_s, K_s, images_s, and rays_rgb or sampler
+    check_progressive(args)
+    stage = progressive_stage(args, start + 1)
+    H_s, W_s, K_s, images_s, rays_rgb, sampler = progressive_data(args, stage, images, poses, hwf, K, i_train,
+                                                                  use_batching, rank, world_size)
+    batch_state = {}
 
     # Move training data to GPU
     if use_batching:
         images = torch.Tensor(images).to(device)
     poses = torch.Tensor(poses).to(device)
-    if use_batching:
-        rays_rgb = torch.Tensor(rays_rgb).to(device)
 
 
-    N_iters = 200000 + 1
+    if world_size > 1:
+        # Ranks draw different rays from here on
+        np.random.seed(rank + start)
+        torch.manual_seed(rank + start)
+
+    # Pick up where the checkpoint left off: same ray order and random numbers
+    if train_state is not None:
+        # Rays of an earlier stage do not apply
+        same_stage = train_state.get('stage', 0) == stage
+        if use_batching and 'sampler' in train_state and same_stage:
+            batch_state = train_state['sampler']
+        if sampler is not None and 'error_sampler' in train_state and same_stage:
+            sampler.load_state_dict(train_state['error_sampler'])
+        if world_size == 1:
+            set_rng_state(train_state['rng'])
+    prefetcher = batch_prefetcher(args, stage, start + 1, N_iters, images_s, poses, H_s, W_s, K_s, i_train, rays_rgb,
+                                  N_rand, rank, resume=batch_state)
+
+    ckpt_manager = CheckpointManager(os.path.join(basedir, expname), keep=args.ckpt_keep, async_save=not args.ckpt_sync)
+
     print('Begin')
     print('TRAIN views are', i_train)
     print('TEST views are', i_test)
     print('VAL views are', i_val)
 
     # Summary writers
-    # writer = SummaryWriter(os.path.join(basedir, 'summaries', expname))
+    if (args.metrics or args.tensorboard or args.profile_steps is not None) and is_main_process():
+        metrics.open(os.path.join(basedir, expname), jsonl=True, sync_cuda=args.metrics_sync,
+                     tensorboard_dir=os.path.join(basedir, 'summaries', expname) if args.tensorboard else None)
+    last_flush = start
     
     start = start + 1
     for i in trange(start, N_iters):
         time0 = time.time()
 
+        if args.prog_iters:
+            if progressive_stage(args, i) != stage:
+                stage = progressive_stage(args, i)
+                H_s, W_s, K_s, images_s, rays_rgb, sampler = progressive_data(args, stage, images, poses, hwf, K, i_train,
+                                                                              use_batching, rank, world_size)
+                if prefetcher is not None:
+                    prefetcher.close()
+                prefetcher = batch_prefetcher(args, stage, i, N_iters, images_s, poses, H_s, W_s, K_s, i_train, rays_rgb,
+                                              N_rand, rank)
+            _, render_kwargs_train['N_samples'], render_kwargs_train['N_importance'] = progressive_settings(args, stage)
+            # Test renders during training see the same encoding
+            render_kwargs_train['pe_alpha'] = render_kwargs_test['pe_alpha'] = progressive_pe_alpha(args, i)
+
         # Sample random ray batch
-        if use_batching:
-            # Random over all images
-            batch = rays_rgb[i_batch:i_batch+N_rand] # [B, 2+1, 3*?]
-            batch = torch.transpose(batch, 0, 1)
-            batch_rays, target_s = batch[:2], batch[2]
-
-            i_batch += N_rand
-            if i_batch >= rays_rgb.shape[0]:
-                print("Shuffle data after an epoch!")
-                rand_idx = torch.randperm(rays_rgb.shape[0])
-                rays_rgb = rays_rgb[rand_idx]
-                i_batch = 0
+        with metrics.timer('sample_rays'):
+            ray_weights = None
+            if sampler is not None and i >= args.precrop_iters:
+                # In proportion to the running loss, over all images
+                batch_rays, target_s, ray_weights, tiles = sampler.sample(N_rand)
 
-        else:
-            # Random from one image
-            img_i = np.random.choice(i_train)
-            target = images[img_i]
-            target = torch.Tensor(target).to(device)
-            pose = poses[img_i, :3,:4]
-
-            if N_rand is not None:
-                rays_o, rays_d = get_rays(H, W, K, torch.Tensor(pose))  # (H, W, 3), (H, W, 3)
-
-                if i < args.precrop_iters:
-                    dH = int(H//2 * args.precrop_frac)
-                    dW = int(W//2 * args.precrop_frac)
-                    coords = torch.stack(
-                        torch.meshgrid(
-                            torch.linspace(H//2 - dH, H//2 + dH - 1, 2*dH), 
-                            torch.linspace(W//2 - dW, W//2 + dW - 1, 2*dW)
-                        ), -1)
-                    if i == start:
-                        print(f"[Config] Center cropping of size {2*dH} x {2*dW} is enabled until iter {args.precrop_iters}")                
-                else:
-                    coords = torch.stack(torch.meshgrid(torch.linspace(0, H-1, H), torch.linspace(0, W-1, W)), -1)  # (H, W, 2)
-
-                coords = torch.reshape(coords, [-1,2])  # (H * W, 2)
-                select_inds = np.random.choice(coords.shape[0], size=[N_rand], replace=False)  # (N_rand,)
-                select_coords = coords[select_inds].long()  # (N_rand, 2)
-                rays_o = rays_o[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                rays_d = rays_d[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
-                batch_rays = torch.stack([rays_o, rays_d], 0)
-                target_s = target[select_coords[:, 0], select_coords[:, 1]]  # (N_rand, 3)
+            else:
+                # Built ahead in the background: random over all images when
+                # batching, else from one image
+                batch_rays, target_s, batch_state = prefetcher.next()
 
         #####  Core optimization loop  #####
-        rgb, disp, acc, extras = render(H, W, K, chunk=args.chunk, rays=batch_rays,
-                                                verbose=i < 10, retraw=True,
-                                                **render_kwargs_train)
+        if args.profile_steps is not None and i == args.profile_steps[0] and is_main_process():
+            metrics.start_profiler(os.path.join(basedir, expname, 'profile'))
+        if args.profile_steps is not None and i == args.profile_steps[1]:
+            metrics.stop_profiler()
 
         optimizer.zero_grad()
+        # Micro-batches add up their gradients, each weighted by its share of the
+        # rays, to the gradient of the whole batch. Only one is in memory at a time
+        n_rays = batch_rays.shape[1]
+        micro = args.N_rand_micro if args.N_rand_micro > 0 else n_rays
+        rgbs, rgb0s = [], []
+        loss = 0.
+        for k in range(0, n_rays, micro):
+            with metrics.timer('forward'):
+                rgb, disp, acc, extras = render(H_s, W_s, K_s, chunk=args.chunk, rays=batch_rays[:,k:k+micro],
+                                                        verbose=i < 10, retraw=True,
+                                                        **render_kwargs_train)
+
+                target_k = target_s[k:k+micro]
+                weights_k = ray_weights[k:k+micro] if ray_weights is not None else None
+                loss_k = img2mse(rgb, target_k) if weights_k is None else weighted_mse(rgb, target_k, weights_k)
+                if 'rgb0' in extras:
+                    loss_k = loss_k + (img2mse(extras['rgb0'], target_k) if weights_k is None else weighted_mse(extras['rgb0'], target_k, weights_k))
+                    rgb0s.append(extras['rgb0'].detach())
+                loss_k = loss_k * (rgb.shape[0] / n_rays)
+                rgbs.append(rgb.detach())
+
+            with metrics.timer('backward'):
+                loss_k.backward()
+            loss = loss + loss_k.detach()
+
+        rgb = torch.cat(rgbs, 0)
         img_loss = img2mse(rgb, target_s)
-        trans = extras['raw'][...,-1]
-        loss = img_loss
         psnr = mse2psnr(img_loss)
-
-        if 'rgb0' in extras:
-            img_loss0 = img2mse(extras['rgb0'], target_s)
-            loss = loss + img_loss0
+        if rgb0s:
+            img_loss0 = img2mse(torch.cat(rgb0s, 0), target_s)
             psnr0 = mse2psnr(img_loss0)
 
-        loss.backward()
-        optimizer.step()
+        with metrics.timer('backward'):
+            allreduce_grads(grad_vars)
+        with metrics.timer('optimizer'):
+            optimizer.step()
+        if ray_weights is not None:
+            sampler.update(tiles, torch.mean((rgb.detach() - target_s) ** 2, -1))
+
+        if args.model_type == 'tensorf' and (i in args.tensorf_upsample_iters or i in args.tensorf_prune_iters):
+            # Same deterministic update on every rank, the optimizer restarts on the new grids
+            model = render_kwargs_train['network_fn']
+            if i in args.tensorf_prune_iters:
+                model.prune(step_size=(far - near) / args.N_samples)
+            if i in args.tensorf_upsample_iters:
+                n_voxels = np.exp(np.linspace(np.log(args.tensorf_res_init**3), np.log(args.tensorf_res_final**3),
+                                              len(args.tensorf_upsample_iters)+1))[1:]
+                box = torch.stack([model.box_min, model.box_max], 0).cpu().numpy()
+                model.upsample(n_to_res(n_voxels[sorted(args.tensorf_upsample_iters).index(i)], box))
+            grad_vars = list(model.parameters())
+            optimizer = create_optimizer(args, model, grad_vars)
 
         # NOTE: IMPORTANT!
         ###   update learning rate   ###
         decay_rate = 0.1
-        decay_steps = args.lrate_decay * 1000
         new_lrate = args.lrate * (decay_rate ** (global_step / decay_steps))
         for param_group in optimizer.param_groups:
-            param_group['lr'] = new_lrate
+            param_group['lr'] = new_lrate * param_group.get('lr_scale', 1.)
         ################################
 
         dt = time.time()-time0
         # print(f"Step: {global_step}, Loss: {loss}, Time: {dt}")
         #####           end            #####
 
-        # Rest is logging
+        # Rest is logging, done by rank 0 only
+        if not is_main_process():
+            global_step += 1
+            continue
+
         if i%args.i_weights==0:
-            path = os.path.join(basedir, expname, '{:06d}.tar'.format(i))
-            torch.save({
-                'global_step': global_step,
-                'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
-                'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }, path)
+            train_state = {'rng' : get_rng_state(), 'stage' : stage}
+            if use_batching:
+                train_state['sampler'] = batch_state
+            if sampler is not None:
+                train_state['error_sampler'] = sampler.state_dict()
+            # Snapshot to CPU now, written to disk in the background
+            with metrics.timer('ckpt_snapshot'):
+                path = ckpt_manager.save(i, {
+                    'global_step': global_step + 1, # steps done, the resumed run continues at i+1
+                    'network_fn_state_dict': render_kwargs_train['network_fn'].state_dict(),
+                    'network_fine_state_dict': render_kwargs_train['network_fine'].state_dict() if render_kwargs_train['network_fine'] is not None else None,
+                    'optimizer_state_dict': optimizer.state_dict(),
+                    'train_state': train_state,
+                    'scene_bbox': args.scene_bbox,
+                })
             print('Saved checkpoints at', path)
 
         if i%args.i_video==0 and i > 0:
@@ -827,6 +1588,11 @@ def train():
     
         if i%args.i_print==0:
             tqdm.write(f"[TRAIN] Iter: {i} Loss: {loss.item()}  PSNR: {psnr.item()}")
+            scalars = {'loss' : loss.item(), 'psnr' : psnr.item(), 'lr' : new_lrate}
+            if 'rgb0' in extras:
+                scalars['psnr0'] = psnr0.item()
+            metrics.flush(i, steps=i - last_flush, **scalars)
+            last_flush = i
         """
             print(expname, i, psnr.numpy(), loss.numpy(), global_step.numpy())
             print('iter time {:.05f}'.format(dt))
@@ -871,8 +1637,18 @@ def train():
 
         global_step += 1
 
+    if prefetcher is not None:
+        prefetcher.close()
+    ckpt_manager.wait()
+    metrics.close()
+
 
 if __name__=='__main__':
-    torch.set_default_tensor_type('torch.cuda.FloatTensor')
+    if torch.cuda.is_available():
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
-    train()
+    args = config_parser().parse_args()
+    if args.ddp_procs > 1:
+        launch_local(train, args, args.ddp_procs)
+    else:
+        train(args)
@@ -1,5 +1,4 @@
 import torch
-torch.autograd.set_detect_anomaly(True)
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
@@ -19,10 +18,14 @@ class Embedder:
         
     def create_embedding_fn(self):
         embed_fns = []
+        embed_freqs = []
+        embed_bands = []
         d = self.kwargs['input_dims']
         out_dim = 0
         if self.kwargs['include_input']:
             embed_fns.append(lambda x : x)
+            embed_freqs.append(None)
+            embed_bands.append(None)
             out_dim += d
             
         max_freq = self.kwargs['max_freq_log2']
@@ -33,16 +36,33 @@ class Embedder:
         else:
             freq_bands = torch.linspace(2.**0., 2.**max_freq, steps=N_freqs)
             
-        for freq in freq_bands:
+        for band, freq in enumerate(freq_bands):
             for p_fn in self.kwargs['periodic_fns']:
                 embed_fns.append(lambda x, p_fn=p_fn, freq=freq : p_fn(x * freq))
+                embed_freqs.append(freq)
+                embed_bands.append(band)
                 out_dim += d
                     
         self.embed_fns = embed_fns
+        self.embed_freqs = embed_freqs
+        self.embed_bands = embed_bands
         self.out_dim = out_dim
         
-    def embed(self, inputs):
-        return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+    def embed(self, inputs, var=None, alpha=None):
+        if var is None and alpha is None:
+            return torch.cat([fn(inputs) for fn in self.embed_fns], -1)
+        outputs = []
+        for fn, freq, band in zip(self.embed_fns, self.embed_freqs, self.embed_bands):
+            out = fn(inputs)
+            if freq is not None and var is not None:
+                # Expected encoding of a Gaussian around inputs with variance var [N, 1]
+                # (integrated positional encoding of mip-NeRF): E[sin(f x)] = sin(f mu) exp(-f^2 var / 2)
+                out = out * torch.exp(-.5 * freq**2 * var)
+            if band is not None and alpha is not None:
+                # Coarse-to-fine window (Nerfies): band k fades in as alpha goes from k to k+1
+                out = out * (1. - np.cos(np.pi * np.clip(alpha - band, 0., 1.))) / 2.
+            outputs.append(out)
+        return torch.cat(outputs, -1)
 
 
 def get_embedder(multires, i=0):
@@ -59,7 +79,7 @@ def get_embedder(multires, i=0):
     }
     
     embedder_obj = Embedder(**embed_kwargs)
-    embed = lambda x, eo=embedder_obj : eo.embed(x)
+    embed = lambda x, eo=embedder_obj, **kwargs : eo.embed(x, **kwargs)
     return embed, embedder_obj.out_dim
 
 
@@ -149,12 +169,61 @@ class NeRF(nn.Module):
 
 
 
+# Small MLP for learned feature encodings (section 4 of Instant-NGP)
+class NeRFSmall(nn.Module):
+    def __init__(self, input_ch=32, input_ch_views=27, num_layers=2, hidden_dim=64, geo_feat_dim=15,
+                 num_layers_color=3, hidden_dim_color=64):
+        """Density MLP on the encoded position, whose extra `geo_feat_dim` outputs
+        feed a color MLP together with the encoded view direction. Same
+        [rgb, sigma] output layout as NeRF with use_viewdirs.
+        """
+        super(NeRFSmall, self).__init__()
+        self.input_ch = input_ch
+        self.input_ch_views = input_ch_views
+        self.geo_feat_dim = geo_feat_dim
+
+        self.sigma_net = nn.ModuleList(
+            [nn.Linear(input_ch if i == 0 else hidden_dim, 1 + geo_feat_dim if i == num_layers-1 else hidden_dim, bias=False)
+             for i in range(num_layers)])
+        self.color_net = nn.ModuleList(
+            [nn.Linear(input_ch_views + geo_feat_dim if i == 0 else hidden_dim_color, 3 if i == num_layers_color-1 else hidden_dim_color, bias=False)
+             for i in range(num_layers_color)])
+
+    def forward(self, x):
+        input_pts, input_views = torch.split(x, [self.input_ch, self.input_ch_views], dim=-1)
+
+        h = input_pts
+        for i, l in enumerate(self.sigma_net):
+            h = l(h)
+            if i != len(self.sigma_net)-1:
+                h = F.relu(h)
+        sigma, geo_feat = h[...,:1], h[...,1:]
+
+        h = torch.cat([input_views, geo_feat], -1)
+        for i, l in enumerate(self.color_net):
+            h = l(h)
+            if i != len(self.color_net)-1:
+                h = F.relu(h)
+
+        return torch.cat([h, sigma], -1)
+
+
 # Ray helpers
-def get_rays(H, W, K, c2w):
-    i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(0, H-1, H))  # pytorch's meshgrid has indexing='ij'
+def get_ray_dirs(H, W, K, rows=None):
+    """Camera-frame ray directions of every pixel, [H, W, 3], or of the image rows
+    [r0, r1) only if rows=(r0, r1). Only depends on the intrinsics.
+    """
+    r0, r1 = (0, H) if rows is None else rows
+    i, j = torch.meshgrid(torch.linspace(0, W-1, W), torch.linspace(r0, r1-1, r1-r0))  # pytorch's meshgrid has indexing='ij'
     i = i.t()
     j = j.t()
     dirs = torch.stack([(i-K[0][2])/K[0][0], -(j-K[1][2])/K[1][1], -torch.ones_like(i)], -1)
+    return dirs
+
+
+def get_rays(H, W, K, c2w, dirs=None):
+    if dirs is None:
+        dirs = get_ray_dirs(H, W, K)
     # Rotate ray directions from camera frame to the world frame
     rays_d = torch.sum(dirs[..., np.newaxis, :] * c2w[:3,:3], -1)  # dot product, equals to: [c2w.dot(dir) for dir in dirs]
     # Translate camera frame's origin to the world frame. It is the origin of all rays.
@@ -192,6 +261,19 @@ def ndc_rays(H, W, focal, near, rays_o, rays_d):
     return rays_o, rays_d
 
 
+def ray_box(rays_o, rays_d, box):
+    """Distances along the rays [N, 3] where they enter and leave the axis-aligned
+    box [2, 3] (slab method), [N] each. Rays missing it enter after they leave.
+    """
+    # Axis-parallel rays never cross those slabs: inf distances, not 0*inf
+    rays_d = torch.where(rays_d.abs() < 1e-12, torch.full_like(rays_d, 1e-12), rays_d)
+    t0 = (box[0] - rays_o) / rays_d
+    t1 = (box[1] - rays_o) / rays_d
+    t_enter = torch.max(torch.minimum(t0, t1), -1).values
+    t_exit = torch.min(torch.maximum(t0, t1), -1).values
+    return t_enter, t_exit
+
+
 # Hierarchical sampling (section 5.2)
 def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     # Get pdf
@@ -237,3 +319,47 @@ def sample_pdf(bins, weights, N_samples, det=False, pytest=False):
     samples = bins_g[...,0] + t * (bins_g[...,1]-bins_g[...,0])
 
     return samples
+
+
+# Volume rendering (equation 3) with a hand-written backward
+def composite_terms(rgb_raw, sigma_raw, dists):
+    """Sample colors, opacities, transmittance before each sample and weights,
+    the transmittance from a cumulative sum of optical depths.
+    """
+    rgb = torch.sigmoid(rgb_raw)
+    tau = F.relu(sigma_raw) * dists
+    # Exclusive cumulative sum: the last distance is 1e10, do not subtract it
+    trans = torch.exp(-torch.cat([torch.zeros_like(tau[...,:1]), torch.cumsum(tau[...,:-1], -1)], -1))
+    alpha = 1. - torch.exp(-tau)
+    return rgb, alpha, trans, alpha * trans
+
+
+class FusedComposite(torch.autograd.Function):
+    """Composites samples along rays into (rgb_map, depth_map, acc_map, weights).
+    Backward only keeps the inputs and recomputes the rest, instead of autograd
+    keeping every intermediate of every sample. The inputs are the raw rgb
+    [N_rays, N_samples, 3] and density [N_rays, N_samples] (noise included),
+    z_vals and dists. No gradient flows to z_vals or dists.
+    """
+    @staticmethod
+    def forward(ctx, rgb_raw, sigma_raw, z_vals, dists):
+        rgb, alpha, trans, weights = composite_terms(rgb_raw, sigma_raw, dists)
+        ctx.save_for_backward(rgb_raw, sigma_raw, z_vals, dists)
+        rgb_map = torch.sum(weights[...,None] * rgb, -2)
+        return rgb_map, torch.sum(weights * z_vals, -1), torch.sum(weights, -1), weights
+
+    @staticmethod
+    def backward(ctx, grad_rgb_map, grad_depth_map, grad_acc_map, grad_weights):
+        rgb_raw, sigma_raw, z_vals, dists = ctx.saved_tensors
+        rgb, alpha, trans, weights = composite_terms(rgb_raw, sigma_raw, dists)
+        # Gradient of each weight through all four outputs
+        grad_w = torch.sum(grad_rgb_map[...,None,:] * rgb, -1) + grad_depth_map[...,None] * z_vals \
+            + grad_acc_map[...,None] + grad_weights
+        # A sample's optical depth raises its own weight by the transmittance past
+        # it, and scales down every later weight by the same factor
+        later = torch.flip(torch.cumsum(torch.flip(grad_w * weights, [-1]), -1), [-1])
+        later = torch.cat([later[...,1:], torch.zeros_like(later[...,:1])], -1)
+        grad_tau = grad_w * trans * (1. - alpha) - later
+        grad_sigma = grad_tau * dists * (sigma_raw > 0)
+        grad_rgb = weights[...,None] * grad_rgb_map[...,None,:] * rgb * (1. - rgb)
+        return grad_rgb, grad_sigma, None, None
@@ -0,0 +1,174 @@
+import os, sys
+import json
+import time
+import numpy as np
+import imageio
+import torch
+import torch.nn.functional as F
+
+from run_nerf_helpers import get_rays, img2mse, mse2psnr, to8b
+from parallel_render import scale_intrinsics
+
+
+# Opacity above which a pixel of the previous frame is a surface to reproject, and
+# which the fine network must reach around it for the reuse to be kept
+SURFACE_ACC = .9
+# Largest color difference between a reused surface point and the pixel that saw
+# it in the previous frame
+COLOR_TOL = .1
+# Opacity below which a pixel saw only empty space
+EMPTY_ACC = .05
+# Points along a new ray checked against the previous frame
+RAY_CHECKS = 16
+
+# Pixel states of a reprojected frame
+FULL, SURFACE, EMPTY = 0, 1, 2
+
+
+def ray_points(rays_o, rays_d, t, ndc):
+    """World points at distance t along world rays [N, 3], t in NDC units when ndc.
+    """
+    if ndc:
+        # ndc_rays() puts the near plane at z = -1, where NDC depth t is z = -1/(1-t)
+        z = -1. / torch.clamp(1. - t, min=1e-6)
+        t = (z - rays_o[...,2]) / rays_d[...,2]
+    return rays_o + t[...,None] * rays_d
+
+
+def project(pts, c2w, H, W, K, ndc):
+    """Pixel (i, j) of world points [N, 3] in camera c2w, their distance t along
+    that camera's rays, and whether they are in front of it and inside the image.
+    """
+    p = (pts - c2w[:3,3]) @ c2w[:3,:3]
+    z = -p[...,2]
+    i = K[0][0] * p[...,0] / z + K[0][2]
+    j = K[1][2] - K[1][1] * p[...,1] / z
+    t = 1. + 1. / pts[...,2] if ndc else z
+    inside = (z > 0) & (i > -.5) & (i < W - .5) & (j > -.5) & (j < H - .5)
+    return i, j, t, inside
+
+
+def reproject(prev, c2w, rays_o, rays_d, H, W, K, ndc, near, far):
+    """Classifies the pixels of camera c2w from the previous frame, returns
+    (state [H*W], t [H*W]).
+
+    Opaque points of the previous frame are splatted into the new camera with a
+    z-buffer, dilated by one pixel to close the holes of forward splatting: such a
+    pixel is SURFACE, with t the nearest splatted depth. A pixel is EMPTY if
+    RAY_CHECKS points from near to far along its ray all fall on transparent
+    pixels of the previous frame, within its near and far. Either needs the
+    pixel's whole ray inside the previous camera's view, so geometry entering the
+    frame is never missed; everything else is FULL.
+    """
+    pts = ray_points(prev['rays_o'], prev['rays_d'], prev['t'], ndc)
+    i, j, t, inside = project(pts, c2w, H, W, K, ndc)
+    index = torch.round(j).long().clamp(0, H-1) * W + torch.round(i).long().clamp(0, W-1)
+    surface = inside & (prev['acc'] > SURFACE_ACC)
+    zbuf = torch.full([H*W], float('inf')).scatter_reduce(0, index[surface], t[surface], reduce='amin')
+    zbuf = -F.max_pool2d(-zbuf.reshape(1, 1, H, W), 3, stride=1, padding=1).reshape(-1)
+
+    # Most opaque neighbour of each previous pixel, for the same one-pixel slack
+    prev_acc = F.max_pool2d(prev['acc'].reshape(1, 1, H, W), 3, stride=1, padding=1).reshape(-1)
+    seen = torch.ones([H*W], dtype=torch.bool)
+    empty = torch.ones([H*W], dtype=torch.bool)
+    for bound in np.linspace(near, far, RAY_CHECKS):
+        pts = ray_points(rays_o, rays_d, torch.full([H*W], float(bound)), ndc)
+        i, j, t, inside = project(pts, prev['c2w'], H, W, K, ndc)
+        index = torch.round(j).long().clamp(0, H-1) * W + torch.round(i).long().clamp(0, W-1)
+        seen &= inside
+        empty &= (t >= near) & (t <= far) & (prev_acc[index] < EMPTY_ACC)
+
+    state = torch.full([H*W], FULL, dtype=torch.long)
+    state[seen & torch.isfinite(zbuf)] = SURFACE
+    state[seen & empty] = EMPTY
+    return state, zbuf
+
+
+def render_path_temporal(render_fn, render_poses, hwf, K, chunk, render_kwargs, savedir=None, render_factor=0,
+                         refresh=10, samples=16, margin=.02, check=False):
+    """Same as render_path, but frames between full renders every `refresh` frames
+    reuse the previous frame's depth. Pixels on a reprojected surface are rendered
+    with the fine network alone, `samples` samples within `margin`*(far-near) of
+    it. Pixels on reprojected empty space are background. Disoccluded pixels, and
+    surface pixels that came out transparent or of another color than the
+    previous frame saw there, get the usual coarse and fine sampling. With check, every frame is also rendered in full to measure the PSNR
+    lost, which is printed and saved to temporal.json.
+    """
+    H, W, focal, K = scale_intrinsics(hwf, K, render_factor)
+    H, W = int(H), int(W)
+    ndc = render_kwargs.get('ndc', True)
+    near, far = float(render_kwargs['near']), float(render_kwargs['far'])
+    kwargs = {k : v for k, v in render_kwargs.items() if k not in ['near', 'far']}
+    fine = kwargs['network_fine'] if kwargs.get('network_fine') is not None else kwargs['network_fn']
+    tight_kwargs = dict(kwargs, network_fn=fine, network_fine=None, N_samples=samples, N_importance=0, perturb=0.)
+    delta = margin * (far - near)
+    bkgd = 1. if kwargs.get('white_bkgd', False) else 0.
+
+    def render_rays_subset(select, rays_o, rays_d, kw, near, far):
+        rgb, disp, acc, extras = render_fn(H, W, K, chunk=chunk, rays=(rays_o[select], rays_d[select]),
+                                           near=near, far=far, **kw)
+        return rgb, disp, acc, extras['depth_map']
+
+    rgbs, disps, stats = [], [], []
+    prev = None
+    t = time.time()
+    for i, c2w in enumerate(render_poses):
+        c2w = torch.Tensor(c2w[:3,:4]) if not torch.is_tensor(c2w) else c2w[:3,:4]
+        rays_o, rays_d = [x.reshape(-1, 3) for x in get_rays(H, W, K, c2w)]
+        with torch.no_grad():
+            if prev is None or i % refresh == 0:
+                state = torch.full([H*W], FULL, dtype=torch.long)
+            else:
+                state, zbuf = reproject(prev, c2w, rays_o, rays_d, H, W, K, ndc, near, far)
+
+            rgb = torch.full([H*W, 3], bkgd)
+            disp, acc, depth = torch.zeros([H*W]), torch.zeros([H*W]), torch.zeros([H*W])
+
+            surface = torch.nonzero(state == SURFACE)[:,0]
+            if surface.numel() > 0:
+                t_lo = torch.clamp(zbuf[surface] - delta, min=near)[:,None]
+                t_hi = torch.clamp(zbuf[surface] + delta, max=far)[:,None]
+                out = render_rays_subset(surface, rays_o, rays_d, tight_kwargs, t_lo, t_hi)
+                rgb[surface], disp[surface], acc[surface], depth[surface] = out
+                # The point found must look the same from the previous camera
+                pts = ray_points(rays_o[surface], rays_d[surface], out[3] / torch.clamp(out[2], min=1e-10), ndc)
+                pi, pj, _, _ = project(pts, prev['c2w'], H, W, K, ndc)
+                index = torch.round(pj).long().clamp(0, H-1) * W + torch.round(pi).long().clamp(0, W-1)
+                consistent = (out[0] - prev['rgb'][index]).abs().max(-1).values < COLOR_TOL
+                # Otherwise the reprojected surface was not there, or not opaque
+                # within the interval (a diffuse density): render these in full
+                state[surface[(out[2] < SURFACE_ACC) | ~consistent]] = FULL
+
+            full = torch.nonzero(state == FULL)[:,0]
+            if full.numel() > 0:
+                rgb[full], disp[full], acc[full], depth[full] = render_rays_subset(full, rays_o, rays_d, kwargs, near, far)
+
+        prev = {'c2w' : c2w, 'rays_o' : rays_o, 'rays_d' : rays_d, 'acc' : acc, 'rgb' : rgb,
+                't' : depth / torch.clamp(acc, min=1e-10)}
+        frame = {'frame' : i, 'seconds' : time.time() - t,
+                 'full' : (state == FULL).float().mean().item(), 'surface' : (state == SURFACE).float().mean().item(),
+                 'empty' : (state == EMPTY).float().mean().item()}
+
+        if check:
+            with torch.no_grad():
+                ref, _, _, _ = render_fn(H, W, K, chunk=chunk, c2w=c2w, near=near, far=far, **kwargs)
+            frame['psnr'] = mse2psnr(img2mse(rgb.reshape(H, W, 3), ref)).item()
+
+        print('{} {:.2f}s full {:.0%} surface {:.0%} empty {:.0%}{}'.format(i, frame['seconds'], frame['full'],
+              frame['surface'], frame['empty'], ' PSNR {:.2f}'.format(frame['psnr']) if check else ''))
+        stats.append(frame)
+        rgbs.append(rgb.reshape(H, W, 3).cpu().numpy())
+        disps.append(disp.reshape(H, W).cpu().numpy())
+        if savedir is not None:
+            imageio.imwrite(os.path.join(savedir, '{:03d}.png'.format(i)), to8b(rgbs[-1]))
+        t = time.time()
+
+    if check:
+        # Full frames match exactly
+        psnrs = [s['psnr'] for s in stats if np.isfinite(s['psnr'])] or [float('inf')]
+        print('Temporal reuse PSNR to full renders: min {:.2f} mean {:.2f}'.format(min(psnrs), np.mean(psnrs)))
+    if savedir is not None:
+        with open(os.path.join(savedir, 'temporal.json'), 'w') as f:
+            json.dump(stats, f, indent=2)
+
+    return np.stack(rgbs, 0), np.stack(disps, 0)
@@ -0,0 +1,269 @@
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def positional_encoding(x, n_freqs):
+    """[..., C] -> [..., 2*n_freqs*C] sines and cosines at frequencies 2^0..2^(n_freqs-1).
+    """
+    freqs = 2.**torch.arange(n_freqs, dtype=x.dtype, device=x.device)
+    x = (x[..., None] * freqs).reshape(list(x.shape[:-1]) + [-1])
+    return torch.cat([torch.sin(x), torch.cos(x)], -1)
+
+
+def n_to_res(n_voxels, bounding_box):
+    """Per-axis grid resolution with about n_voxels cubic voxels in the box.
+    """
+    size = np.asarray(bounding_box[1]) - np.asarray(bounding_box[0])
+    voxel_size = (np.prod(size) / n_voxels) ** (1. / 3)
+    return [int(r) for r in np.maximum(size / voxel_size, 2)]
+
+
+class TensorBase(nn.Module):
+    """Radiance field stored as a low-rank factorization of a density grid and an
+    appearance feature grid over an axis-aligned box (TensoRF, Chen et al. 2022).
+
+    Takes the same [x, viewdir] input and returns the same [rgb, sigma] raw output
+    as NeRF, so network_query_fn, render_rays and raw2outputs are unchanged: the
+    position and view direction are passed through identity embeddings, rgb is
+    returned before the sigmoid and sigma before the relu of raw2outputs.
+
+    Subclasses create the factors and tell how they map to the grid axes; grid
+    upsampling, shrinking to the occupied box, the occupancy mask and resizing
+    on load_state_dict are shared.
+    """
+    def __init__(self, bounding_box, resolution, app_dim=27, view_pe=2, fea_pe=2, featureC=128,
+                 density_scale=25., use_viewdirs=True):
+        super(TensorBase, self).__init__()
+        box_min, box_max = bounding_box
+        self.register_buffer('box_min', torch.as_tensor(np.asarray(box_min), dtype=torch.float32).reshape(3))
+        self.register_buffer('box_max', torch.as_tensor(np.asarray(box_max), dtype=torch.float32).reshape(3))
+        self.register_buffer('grid_res', torch.as_tensor(resolution, dtype=torch.long).reshape(3))
+        # Occupancy over the box at some resolution, a single True cell means everywhere
+        self.register_buffer('alpha_mask', torch.ones(1, 1, 1, dtype=torch.bool))
+        self.density_scale = density_scale
+        self.use_viewdirs = use_viewdirs
+        self.input_ch_views = 3 if use_viewdirs else 0
+        self.view_pe = view_pe
+        self.fea_pe = fea_pe
+
+        self.init_factors([int(r) for r in resolution])
+        self.basis_mat = nn.Linear(self.app_channels, app_dim, bias=False)
+
+        in_ch = app_dim + 2*fea_pe*app_dim
+        if use_viewdirs:
+            in_ch += 3 + 2*view_pe*3
+        self.render_mlp = nn.Sequential(nn.Linear(in_ch, featureC), nn.ReLU(inplace=True),
+                                        nn.Linear(featureC, featureC), nn.ReLU(inplace=True),
+                                        nn.Linear(featureC, 3))
+        nn.init.constant_(self.render_mlp[-1].bias, 0)
+
+    # Factorization, defined by subclasses
+
+    def init_factors(self, res):
+        raise NotImplementedError
+
+    def factors(self):
+        """(ParameterList, index, axes) of every factor tensor [1, R, A, B], where
+        axes gives the grid axis of A and B (None for a singleton dimension).
+        """
+        raise NotImplementedError
+
+    def density_features(self, xyz):
+        raise NotImplementedError
+
+    def app_features(self, xyz):
+        raise NotImplementedError
+
+    # Shared
+
+    @staticmethod
+    def sample_plane(plane, a, b):
+        """Bilinear samples [R, N] of a factor [1, R, B, A] at normalized coordinates a, b.
+        """
+        coords = torch.stack([a, b], -1).view(1, -1, 1, 2)
+        return F.grid_sample(plane, coords, align_corners=True).view(plane.shape[1], -1)
+
+    @staticmethod
+    def sample_line(line, a):
+        return TensorBase.sample_plane(line, torch.zeros_like(a), a)
+
+    def normalize(self, pts):
+        return (pts - self.box_min) / (self.box_max - self.box_min) * 2. - 1.
+
+    def occupied(self, xyz):
+        """Points inside the box and in occupied cells of the mask.
+        """
+        valid = torch.all(torch.abs(xyz) <= 1., -1)
+        shape = torch.tensor(self.alpha_mask.shape, device=xyz.device)
+        if self.alpha_mask.numel() > 1:
+            idx = torch.round((torch.clamp(xyz, -1., 1.) + 1.) / 2. * (shape - 1)).long()
+            valid = valid & self.alpha_mask[idx[:,0], idx[:,1], idx[:,2]]
+        return valid
+
+    def forward(self, x):
+        pts, views = torch.split(x, [3, self.input_ch_views], dim=-1)
+        xyz = self.normalize(pts)
+
+        # Only points in occupied space go through the grids and the MLP
+        valid = self.occupied(xyz)
+        sigma = torch.zeros(x.shape[0], device=x.device)
+        rgb = torch.zeros(x.shape[0], 3, device=x.device)
+        if valid.any():
+            xyz = xyz[valid]
+            sigma[valid] = self.density_scale * self.density_features(xyz)
+            feats = self.basis_mat(self.app_features(xyz))
+            h = [feats, positional_encoding(feats, self.fea_pe)]
+            if self.use_viewdirs:
+                views = views[valid]
+                h += [views, positional_encoding(views, self.view_pe)]
+            rgb[valid] = self.render_mlp(torch.cat(h, -1))
+        return torch.cat([rgb, sigma[:,None]], -1)
+
+    def param_groups(self, lr, net_lr_scale=.05):
+        """Adam groups of the grid factors and of the networks. 'lr_scale' is applied
+        by the learning rate schedule of train().
+        """
+        grids = [params[i] for params, i, _ in self.factors()]
+        nets = list(self.basis_mat.parameters()) + list(self.render_mlp.parameters())
+        return [{'params' : grids, 'lr' : lr, 'lr_scale' : 1.},
+                {'params' : nets, 'lr' : lr * net_lr_scale, 'lr_scale' : net_lr_scale}]
+
+    def factor_size(self, axes, res):
+        return [1 if a is None else int(res[a]) for a in axes]
+
+    @torch.no_grad()
+    def upsample(self, res):
+        """Resamples every factor to the grid resolution `res`. Returns new
+        parameters, so the optimizer has to be rebuilt.
+        """
+        for params, i, axes in self.factors():
+            size = self.factor_size(axes, res)
+            params[i] = nn.Parameter(F.interpolate(params[i].data, size=size, mode='bilinear', align_corners=True))
+        self.grid_res = torch.as_tensor(res, dtype=torch.long, device=self.grid_res.device)
+        print('TensoRF grid upsampled to', list(res))
+
+    @torch.no_grad()
+    def alpha_grid(self, res, step_size, chunk=1024*64):
+        """Opacity of a step of `step_size` at every vertex of a res grid, [X, Y, Z].
+        """
+        axes = [torch.linspace(-1., 1., int(r), device=self.box_min.device) for r in res]
+        xyz = torch.stack(torch.meshgrid(*axes, indexing='ij'), -1).reshape(-1, 3)
+        sigma = torch.cat([self.density_scale * self.density_features(xyz[i:i+chunk])
+                           for i in range(0, xyz.shape[0], chunk)], 0)
+        alpha = 1. - torch.exp(-F.relu(sigma) * step_size)
+        return alpha.reshape([int(r) for r in res])
+
+    @torch.no_grad()
+    def prune(self, step_size, threshold=1e-4):
+        """Rebuilds the occupancy mask at the current grid resolution and shrinks the
+        box and the factors to the occupied region. Returns the new box.
+        """
+        res = self.grid_res.tolist()
+        alpha = self.alpha_grid(res, step_size)
+        # Dilate by one cell so surfaces between grid vertices are kept
+        mask = F.max_pool3d(alpha[None,None], kernel_size=3, stride=1, padding=1)[0,0] > threshold
+        if not mask.any():
+            print('TensoRF prune: nothing occupied, keeping the grid')
+            return torch.stack([self.box_min, self.box_max], 0)
+
+        idx = torch.nonzero(mask)
+        lo, hi = idx.min(0)[0], idx.max(0)[0] + 1
+        for params, i, axes in self.factors():
+            p = params[i].data
+            for dim, a in zip([2, 3], axes):
+                if a is not None:
+                    p = p.narrow(dim, int(lo[a]), int(hi[a] - lo[a]))
+            params[i] = nn.Parameter(p.contiguous())
+        self.alpha_mask = mask[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]].contiguous()
+
+        # The new box passes exactly through the kept grid vertices
+        size = self.box_max - self.box_min
+        res_t = self.grid_res.to(size.dtype)
+        new_min = self.box_min + lo.to(size.dtype) / (res_t - 1) * size
+        new_max = self.box_min + (hi - 1).to(size.dtype) / (res_t - 1) * size
+        self.box_min, self.box_max = new_min, new_max
+        self.grid_res = (hi - lo).to(self.grid_res.dtype)
+        print('TensoRF pruned to box', new_min.tolist(), new_max.tolist(), 'grid', self.grid_res.tolist(),
+              'occupied {:.1f}%'.format(100. * self.alpha_mask.float().mean().item()))
+        return torch.stack([new_min, new_max], 0)
+
+    def load_state_dict(self, state_dict, strict=True, assign=False):
+        # Factors, mask and box change shape while training: match the checkpoint first
+        for params, i, _ in self.factors():
+            name = [k for k, v in self.named_parameters() if v is params[i]][0]
+            if name in state_dict and state_dict[name].shape != params[i].shape:
+                params[i] = nn.Parameter(torch.empty_like(state_dict[name], device=params[i].device))
+        if 'alpha_mask' in state_dict:
+            self.alpha_mask = torch.empty_like(state_dict['alpha_mask'], device=self.alpha_mask.device)
+        return super(TensorBase, self).load_state_dict(state_dict, strict, assign)
+
+
+class TensorVM(TensorBase):
+    """Vector-matrix decomposition: every component is the outer product of a plane
+    over two axes and a line along the third, for the three axis pairs.
+    """
+    mat_mode = [[0, 1], [0, 2], [1, 2]]
+    vec_mode = [2, 1, 0]
+
+    def __init__(self, bounding_box, resolution, density_n_comp=16, app_n_comp=48, **kwargs):
+        self.density_n_comp = density_n_comp
+        self.app_n_comp = app_n_comp
+        self.app_channels = 3 * app_n_comp
+        super(TensorVM, self).__init__(bounding_box, resolution, **kwargs)
+
+    def init_factors(self, res, scale=.1):
+        def planes_lines(n_comp):
+            planes = nn.ParameterList([nn.Parameter(scale * torch.randn(1, n_comp, res[m[1]], res[m[0]])) for m in self.mat_mode])
+            lines = nn.ParameterList([nn.Parameter(scale * torch.randn(1, n_comp, res[v], 1)) for v in self.vec_mode])
+            return planes, lines
+        self.density_plane, self.density_line = planes_lines(self.density_n_comp)
+        self.app_plane, self.app_line = planes_lines(self.app_n_comp)
+
+    def factors(self):
+        out = []
+        for planes, lines in [(self.density_plane, self.density_line), (self.app_plane, self.app_line)]:
+            for i in range(3):
+                out.append((planes, i, (self.mat_mode[i][1], self.mat_mode[i][0])))
+                out.append((lines, i, (self.vec_mode[i], None)))
+        return out
+
+    def vm_features(self, planes, lines, xyz):
+        return [self.sample_plane(planes[i], xyz[:,m[0]], xyz[:,m[1]]) * self.sample_line(lines[i], xyz[:,self.vec_mode[i]])
+                for i, m in enumerate(self.mat_mode)]
+
+    def density_features(self, xyz):
+        return sum(f.sum(0) for f in self.vm_features(self.density_plane, self.density_line, xyz))
+
+    def app_features(self, xyz):
+        return torch.cat(self.vm_features(self.app_plane, self.app_line, xyz), 0).t()
+
+
+class TensorCP(TensorBase):
+    """CANDECOMP/PARAFAC decomposition: every component is the outer product of
+    three lines, one per axis. Smallest model, lower quality than VM.
+    """
+    def __init__(self, bounding_box, resolution, density_n_comp=96, app_n_comp=288, **kwargs):
+        self.density_n_comp = density_n_comp
+        self.app_n_comp = app_n_comp
+        self.app_channels = app_n_comp
+        super(TensorCP, self).__init__(bounding_box, resolution, **kwargs)
+
+    def init_factors(self, res, scale=.2):
+        def lines(n_comp):
+            return nn.ParameterList([nn.Parameter(scale * torch.randn(1, n_comp, res[a], 1)) for a in range(3)])
+        self.density_line = lines(self.density_n_comp)
+        self.app_line = lines(self.app_n_comp)
+
+    def factors(self):
+        return [(lines, a, (a, None)) for lines in [self.density_line, self.app_line] for a in range(3)]
+
+    def cp_features(self, lines, xyz):
+        return self.sample_line(lines[0], xyz[:,0]) * self.sample_line(lines[1], xyz[:,1]) * self.sample_line(lines[2], xyz[:,2])
+
+    def density_features(self, xyz):
+        return self.cp_features(self.density_line, xyz).sum(0)
+
+    def app_features(self, xyz):
+        return self.cp_features(self.app_line, xyz).t()